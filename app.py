@@ -1,26 +1,163 @@
-from flask import Flask, request, jsonify
-from werkzeug.exceptions import BadRequest
+import time
+_MODULE_IMPORT_START = time.perf_counter()
+
+from flask import Flask, Request, Response, request, jsonify, send_file
+from werkzeug.exceptions import BadRequest, RequestEntityTooLarge
 import os
-import requests
+import io
+import contextlib
+import importlib
 import zipfile
 import tempfile
 import re
+import html
+import posixpath
 import shutil
+import xml.etree.ElementTree as ET
 from datetime import datetime
-from pptx import Presentation
-from qcloud_cos import CosConfig, CosS3Client
 import logging
-import time
+import logging.handlers
+import queue
+import random
+import atexit
 from functools import wraps
 import threading
-from urllib.parse import urlparse
+from urllib.parse import urlparse, parse_qs
 import platform
+import sys
+import signal
+import traceback
+import itertools
+import hashlib
+import hmac
+import json
+import struct
+import math
+from collections import deque, OrderedDict
+import multiprocessing
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+try:
+    import fcntl  # 跨进程文件锁，仅在类Unix系统可用
+except ImportError:
+    fcntl = None
 
 # Configure logging
-logging.basicConfig(level=logging.INFO)
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO").upper()  # 日志级别；设为 DEBUG 时输出每个段落的转换明细
+LOG_FORMAT = os.environ.get("LOG_FORMAT", "text")  # text: 与原来相同的 "级别:模块:消息" 格式; json: 每行一个JSON对象
+LOG_QUEUE_SIZE = int(os.environ.get("LOG_QUEUE_SIZE", "10000"))  # 后台日志队列长度，队列满时丢弃新日志而不是阻塞请求；0 表示同步写日志
+LOG_DEBUG_SAMPLE_RATE = float(os.environ.get("LOG_DEBUG_SAMPLE_RATE", "1"))  # DEBUG级别下按幻灯片抽样输出明细的比例（0-1）
+
+class JsonLogFormatter(logging.Formatter):
+    """One JSON object per line; fields passed as extra={"fields": {...}} become top-level keys"""
+
+    def format(self, record):
+        entry = {
+            "ts": datetime.fromtimestamp(record.created).isoformat(timespec='milliseconds'),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+            "pid": record.process,
+            "thread": record.threadName
+        }
+        entry.update(getattr(record, 'fields', None) or {})
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry["exc"] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+class TextLogFormatter(logging.Formatter):
+    """The basicConfig "LEVEL:name:message" format, with structured fields appended as JSON"""
+
+    def __init__(self):
+        super().__init__(logging.BASIC_FORMAT)
+
+    def format(self, record):
+        text = super().format(record)
+        fields = getattr(record, 'fields', None)
+        return f"{text} {json.dumps(fields, ensure_ascii=False, default=str)}" if fields else text
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler that drops records when the queue is full instead of blocking the request"""
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def prepare(self, record):
+        # Keep the structured fields on the record for the listener's formatter
+        fields = getattr(record, 'fields', None)
+        record = super().prepare(record)
+        record.fields = fields
+        return record
+
+_log_queue_handler = None
+_log_listener = None
+
+def _start_log_listener():
+    """(Re)start the background thread that writes queued records to stderr"""
+    global _log_listener
+    _log_queue_handler.queue = queue.Queue(LOG_QUEUE_SIZE)
+    output = logging.StreamHandler()
+    output.setFormatter(JsonLogFormatter() if LOG_FORMAT == 'json' else TextLogFormatter())
+    _log_listener = logging.handlers.QueueListener(_log_queue_handler.queue, output)
+    _log_listener.start()
+
+def _stop_log_listener():
+    """Flush queued records on exit"""
+    if _log_listener is not None:
+        _log_listener.stop()
+
+def configure_logging():
+    """
+    Log to stderr through a bounded queue drained by a background thread
+
+    Request threads only enqueue records; formatting and the stderr write
+    happen on the listener thread. After a fork (gunicorn preload_app) the
+    child gets a fresh queue and listener, since threads do not survive it.
+    Does nothing if the root logger was already configured by the host.
+    """
+    global _log_queue_handler
+    root = logging.getLogger()
+    if root.handlers:
+        return
+    root.setLevel(LOG_LEVEL)
+    if LOG_QUEUE_SIZE <= 0:
+        output = logging.StreamHandler()
+        output.setFormatter(JsonLogFormatter() if LOG_FORMAT == 'json' else TextLogFormatter())
+        root.addHandler(output)
+        return
+
+    _log_queue_handler = DroppingQueueHandler(None)
+    _start_log_listener()
+    root.addHandler(_log_queue_handler)
+    atexit.register(_stop_log_listener)
+    if hasattr(os, 'register_at_fork'):
+        os.register_at_fork(after_in_child=_start_log_listener)
+
+configure_logging()
 logger = logging.getLogger(__name__)
 
-app = Flask(__name__)
+def debug_detail():
+    """
+    Whether to log per-paragraph detail for the current unit of work (e.g. one slide)
+
+    Call once per unit and guard the detail logging with the result, so hot
+    loops pay nothing for it (not even building the messages) unless DEBUG
+    is enabled, and then only for a LOG_DEBUG_SAMPLE_RATE sample.
+    """
+    return logger.isEnabledFor(logging.DEBUG) and (LOG_DEBUG_SAMPLE_RATE >= 1 or random.random() < LOG_DEBUG_SAMPLE_RATE)
+
+# 启动耗时统计（秒）：模块导入、各依赖的延迟导入、COS客户端创建
+STARTUP_TIMINGS = {"core_imports": round(time.perf_counter() - _MODULE_IMPORT_START, 4)}
 
 # Tencent Cloud COS Configuration
 # 请在环境变量中设置以下配置
@@ -36,23 +173,871 @@ MAX_RETRIES = 2  # reduced retries for faster failure
 RETRY_DELAY = 0.5  # seconds - reduced delay
 API_TIMEOUT = 60  # API总超时时间：1分钟
 PROCESSING_TIMEOUT = 45  # 处理超时：45秒，为响应留余量
+UPLOAD_SPOOL_THRESHOLD = 1024 * 1024  # 上传文件小于1MB时保存在内存中，超过后才写入磁盘
+UPLOAD_FORM_OVERHEAD = 64 * 1024  # multipart表单字段和边界的额外字节（nginx.conf 的 client_max_body_size 需不小于 MAX_FILE_SIZE 加此值）
+RESPONSE_MODES = ('url', 'inline')  # url: 上传COS并返回下载链接; inline: 直接在响应体中返回处理后的文件
+INLINE_CHUNK_SIZE = 65536  # inline模式下每次写出的字节数
+PPTX_MIMETYPE = 'application/vnd.openxmlformats-officedocument.presentationml.presentation'
+SINGLE_FLIGHT_DIR = os.environ.get("SINGLE_FLIGHT_DIR", os.path.join(tempfile.gettempdir(), "pptx_processing", "singleflight"))  # 多worker共享的锁目录，设为空字符串则只在进程内合并
+INFLIGHT_DIR = os.environ.get("INFLIGHT_DIR", os.path.join(tempfile.gettempdir(), "pptx_processing", "inflight"))  # 各worker定期写入进行中任务快照的目录，设为空字符串则只能看到当前worker
+INFLIGHT_SNAPSHOT_INTERVAL = float(os.environ.get("INFLIGHT_SNAPSHOT_INTERVAL", "2"))  # 快照写入间隔（秒）
+INFLIGHT_DUMP_SIGNAL = os.environ.get("INFLIGHT_DUMP_SIGNAL", "SIGUSR2")  # 收到该信号时把进行中任务（含线程栈）写入日志；gunicorn worker已占用SIGUSR1
+ADMIN_TOKEN = os.environ.get("ADMIN_TOKEN", "")  # 管理接口的访问令牌（X-Admin-Token）；为空时只允许本机直接访问
+TRACE_FILE = os.environ.get("TRACE_FILE", "")  # 每个请求的trace以OTLP/JSON格式逐行追加到该文件（多worker共用），为空时不写文件
+TRACE_BUFFER_SIZE = int(os.environ.get("TRACE_BUFFER_SIZE", "200"))  # 每个worker在内存中保留的最近trace数量，供 GET /admin/traces 查询；与 TRACE_FILE 均关闭时不记录trace
+TRACE_MIN_DURATION = float(os.environ.get("TRACE_MIN_DURATION", "0"))  # 只保留总耗时不少于该秒数的trace（失败的请求始终保留）
+TRACE_QUEUE_SIZE = 1000  # 等待写入TRACE_FILE的trace数上限，超过时丢弃
+TRACE_SERVICE_NAME = "ppt-hyperlink-converter"
+OUTPUT_CACHE_DIR = os.environ.get("OUTPUT_CACHE_DIR", os.path.join(tempfile.gettempdir(), "pptx_processing", "outputs"))  # 处理结果的本地缓存目录（多worker共享，由nginx直接读取）
+OUTPUT_CACHE_MAX_BYTES = int(os.environ.get("OUTPUT_CACHE_MAX_MB", "1024")) * 1024 * 1024  # 本地缓存总大小上限，超出时删除最久未访问的文件；0 表示关闭
+OUTPUT_CACHE_ACCEL_PREFIX = os.environ.get("OUTPUT_CACHE_ACCEL_PREFIX", "")  # nginx中对应缓存目录的internal location（使用nginx.conf时设为 /_output_cache/）；为空时由Flask直接发送文件
+SINGLE_FLIGHT_RESULT_TTL = 10  # seconds - 共享结果文件的保留时间（只有等待锁期间写入的结果才会被其他worker复用）
+MEMORY_BUDGET = int(os.environ.get("MEMORY_BUDGET_MB", "1024")) * 1024 * 1024  # 每个worker允许同时处理的任务预估内存总量
+MAX_CONCURRENT_JOBS = int(os.environ.get("MAX_CONCURRENT_JOBS", "4"))  # 每个worker同时处理的任务数上限
+ADMISSION_QUEUE_SIZE = int(os.environ.get("ADMISSION_QUEUE_SIZE", "16"))  # 排队等待的任务数上限，超过返回429
+ADMISSION_MAX_WAIT = float(os.environ.get("ADMISSION_MAX_WAIT", "20"))  # seconds - 排队最长等待时间
+XML_MEMORY_FACTOR = 8  # 解析后的lxml对象树约为原始XML大小的倍数（同一时间只解析一个部件）
+BASE_JOB_MEMORY = 20 * 1024 * 1024  # 每个任务的固定开销估计
+MAX_UNCOMPRESSED_SIZE = int(os.environ.get("MAX_UNCOMPRESSED_MB", "512")) * 1024 * 1024  # 解压后总大小上限，防止zip炸弹
+MAX_ZIP_MEMBERS = 5000  # 压缩包内文件数上限
+MAX_COMPRESSION_RATIO = 100  # 单个文件的压缩比上限（仅检查解压后超过1MB的文件）
+HEAVY_SLIDE_COUNT = int(os.environ.get("HEAVY_SLIDE_COUNT", "150"))  # 超过该页数的文件进入重任务通道
+HEAVY_JOB_MEMORY = MEMORY_BUDGET // 4  # 预估内存超过该值的文件进入重任务通道
+REMOTE_PREFLIGHT = os.environ.get("REMOTE_PREFLIGHT", "1") != "0"  # 下载前先用Range请求检查远程文件的zip目录
+REMOTE_PREFLIGHT_TAIL_SIZE = 128 * 1024  # Range请求读取的文件末尾字节数（覆盖EOCD和大多数中央目录）
+HEAVY_MAX_CONCURRENT_JOBS = int(os.environ.get("HEAVY_MAX_CONCURRENT_JOBS", "1"))  # 重任务通道同时处理的任务数
+PART_SCAN_CACHE_SIZE = int(os.environ.get("PART_SCAN_CACHE_SIZE", "20000"))  # 按(CRC32, 大小, 规则版本)缓存的部件扫描结果条数
+SLIDE_REWRITE_CACHE_SIZE = int(os.environ.get("SLIDE_REWRITE_CACHE_SIZE", "5000"))  # 按(幻灯片内容哈希, 链接集合, 规则集)缓存的改写结果条数，修改后重新提交的课件只需处理改动的幻灯片
+SLIDE_REWRITE_CACHE_BYTES = int(os.environ.get("SLIDE_REWRITE_CACHE_MB", "64")) * 1024 * 1024  # 改写结果缓存中幻灯片XML和关系XML的总大小上限（每个worker进程）
+PARALLEL_WORKERS = int(os.environ.get("PARALLEL_WORKERS", "0"))  # 大文件扫描/改写所用进程池大小，0 表示关闭
+PARALLEL_MIN_PARTS = int(os.environ.get("PARALLEL_MIN_PARTS", "200"))  # 需要扫描或改写的部件数达到该值时才使用进程池
+OUTPUT_COMPRESSION = os.environ.get("OUTPUT_COMPRESSION", "default")  # 输出文件压缩方式：default/store_media/fast/max（请求中可用 compression 覆盖）
+VALIDATE_LINKS = os.environ.get("VALIDATE_LINKS", "0") != "0"  # 默认是否检查提取到的链接能否访问（请求中可用 validate_links 覆盖）
+LINK_CHECK_WORKERS = int(os.environ.get("LINK_CHECK_WORKERS", "16"))  # 链接检查的并发线程数
+LINK_CHECK_PER_HOST = int(os.environ.get("LINK_CHECK_PER_HOST", "4"))  # 同一主机同时进行的检查数上限
+LINK_CHECK_DEADLINE = float(os.environ.get("LINK_CHECK_DEADLINE", "8"))  # 整个链接检查阶段的总时限（秒），超时未完成的链接标记为未检查
+LINK_CHECK_TIMEOUT = float(os.environ.get("LINK_CHECK_TIMEOUT", "5"))  # 单个检查请求的超时（秒）
+LINK_CHECK_CACHE_TTL = int(os.environ.get("LINK_CHECK_CACHE_TTL", "600"))  # 检查结果的缓存时间（秒），跨请求共享
+LINK_CHECK_CACHE_SIZE = int(os.environ.get("LINK_CHECK_CACHE_SIZE", "5000"))
+UNCHANGED_UPLOAD_CACHE_SIZE = int(os.environ.get("UNCHANGED_UPLOAD_CACHE_SIZE", "2000"))  # 未转换任何链接的上传文件: 内容哈希 -> 已上传的COS地址
+MAX_SUPPLIED_LINKS = int(os.environ.get("MAX_SUPPLIED_LINKS", "2000"))  # 调用方直接提供的链接（或大纲中的链接）数量上限
+LINK_RULES_FILE = os.environ.get("LINK_RULES_FILE", "")  # 链接分类规则配置文件（JSON，可按租户配置多套规则），为空时使用内置规则
+SCAN_SCOPE = os.environ.get("SCAN_SCOPE", "slides,notes")  # 默认扫描范围：slides/notes/layouts/masters 逗号分隔，或 all 扫描全部部件
+SCAN_SCOPES = ('slides', 'notes', 'layouts', 'masters')
+PML_NS = 'http://schemas.openxmlformats.org/presentationml/2006/main'
+REL_NS = 'http://schemas.openxmlformats.org/officeDocument/2006/relationships'
+RT_SLIDE_MASTER = REL_NS + '/slideMaster'
+RT_SLIDE_LAYOUT = REL_NS + '/slideLayout'
+RT_NOTES_SLIDE = REL_NS + '/notesSlide'
+
+WARM_IMPORTS = os.environ.get("WARM_IMPORTS", "1") != "0"  # 启动后在后台线程预热重量级依赖
+
+class _LazyModule:
+    """
+    Module proxy that imports the real module on first attribute access
 
-# Initialize COS client with error handling
-cos_client = None
-if COS_SECRET_ID and COS_SECRET_KEY and COS_REGION and COS_BUCKET:
+    Keeps heavy dependencies (lxml, the COS SDK, requests) off the
+    import path so the app can serve /health as soon as Flask is loaded.
+    """
+
+    _lock = threading.Lock()
+
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def _load(self, source):
+        if self._module is None:
+            with self._lock:
+                if self._module is None:
+                    import_start = time.perf_counter()
+                    module = importlib.import_module(self._name)
+                    elapsed = time.perf_counter() - import_start
+                    STARTUP_TIMINGS[f"import_{self._name}"] = round(elapsed, 4)
+                    logger.info(f"Imported {self._name} in {elapsed:.3f}s ({source})")
+                    self._module = module
+        return self._module
+
+    def __getattr__(self, attr):
+        return getattr(self._load("on demand"), attr)
+
+requests = _LazyModule('requests')
+etree = _LazyModule('lxml.etree')
+qcloud_cos = _LazyModule('qcloud_cos')
+
+def _warm_imports():
+    """Import heavy dependencies in the background so the first request does not pay for them"""
+    warm_start = time.perf_counter()
+    for module in (requests, etree, qcloud_cos):
+        try:
+            module._load("warm-up")
+        except Exception as e:
+            logger.error(f"Failed to import {module._name}: {str(e)}")
+    if COS_SECRET_ID and COS_SECRET_KEY and COS_REGION and COS_BUCKET:
+        get_cos_client()
+    STARTUP_TIMINGS["warm_up_total"] = round(time.perf_counter() - warm_start, 4)
+    logger.info(f"Startup timing report: {STARTUP_TIMINGS}")
+
+# COS client is created on first use, behind a lock
+_cos_client = None
+_cos_client_initialized = False
+_cos_client_lock = threading.Lock()
+
+def _create_cos_client():
+    """Initialize COS client with error handling; returns None when COS is unavailable"""
+    if not (COS_SECRET_ID and COS_SECRET_KEY and COS_REGION and COS_BUCKET):
+        logger.warning("COS credentials not provided. COS functionality will be disabled.")
+        return None
     try:
-        cos_config = CosConfig(Region=COS_REGION, SecretId=COS_SECRET_ID, SecretKey=COS_SECRET_KEY)
-        cos_client = CosS3Client(cos_config)
+        client_start = time.perf_counter()
+        cos_config = qcloud_cos.CosConfig(Region=COS_REGION, SecretId=COS_SECRET_ID, SecretKey=COS_SECRET_KEY)
+        client = qcloud_cos.CosS3Client(cos_config)
+        STARTUP_TIMINGS["cos_client"] = round(time.perf_counter() - client_start, 4)
         logger.info("COS client initialized successfully")
+        return client
     except Exception as e:
         logger.error(f"Failed to initialize COS client: {str(e)}")
-        cos_client = None
-else:
-    logger.warning("COS credentials not provided. COS functionality will be disabled.")
+        return None
+
+def get_cos_client():
+    """Return the shared COS client, creating it on first use (thread-safe)"""
+    global _cos_client, _cos_client_initialized
+    if not _cos_client_initialized:
+        with _cos_client_lock:
+            if not _cos_client_initialized:
+                _cos_client = _create_cos_client()
+                _cos_client_initialized = True
+    return _cos_client
+
+# Process pool for scanning and rewriting the slides of very large decks
+_part_pool = None
+_part_pool_lock = threading.Lock()
+
+def get_part_pool():
+    """Return the shared process pool, creating it on first use, or None when PARALLEL_WORKERS is 0"""
+    global _part_pool
+    if PARALLEL_WORKERS <= 0:
+        return None
+    if _part_pool is None:
+        with _part_pool_lock:
+            if _part_pool is None:
+                # spawn rather than fork: this process already runs warm-up, timeout and request threads
+                _part_pool = ProcessPoolExecutor(max_workers=PARALLEL_WORKERS,
+                                                 mp_context=multiprocessing.get_context('spawn'))
+                logger.info(f"Started part process pool with {PARALLEL_WORKERS} workers")
+    return _part_pool
+
+def map_parts(func, items):
+    """
+    Apply func to every item, on the part process pool when there are enough items
+
+    Jobs with fewer than PARALLEL_MIN_PARTS items run in this process, since
+    shipping part bytes to the workers costs more than it saves. If the pool
+    breaks (a worker was killed), it is discarded and the work is redone here.
+
+    Args:
+        func (callable): Module-level function, so it can be sent to the workers
+        items (list): Picklable arguments, one call each
+
+    Returns:
+        tuple: (list of results in item order, whether the pool was used)
+    """
+    global _part_pool
+    pool = get_part_pool() if len(items) >= PARALLEL_MIN_PARTS else None
+    if pool is not None:
+        try:
+            chunksize = max(1, math.ceil(len(items) / (PARALLEL_WORKERS * 4)))
+            return list(pool.map(func, items, chunksize=chunksize)), True
+        except BrokenProcessPool as e:
+            logger.warning(f"Part process pool broke, running {len(items)} parts in-process: {str(e)}")
+            with _part_pool_lock:
+                if _part_pool is pool:
+                    _part_pool = None
+    return [func(item) for item in items], False
+
+class _SizeLimitedSpooledFile(tempfile.SpooledTemporaryFile):
+    """Spooled temp file that rejects uploads larger than MAX_FILE_SIZE while they stream in"""
+
+    def __init__(self, max_size=UPLOAD_SPOOL_THRESHOLD, limit=MAX_FILE_SIZE):
+        super().__init__(max_size=max_size, mode='w+b')
+        self._limit = limit
+        self._written = 0
+
+    def write(self, s):
+        self._written += len(s)
+        if self._written > self._limit:
+            raise RequestEntityTooLarge(f"File too large: more than {self._limit} bytes (max: {self._limit})")
+        return super().write(s)
+
+class PPTXRequest(Request):
+    """Request class that streams uploaded files into size-limited spooled temp files"""
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        return _SizeLimitedSpooledFile()
+
+app = Flask(__name__)
+app.request_class = PPTXRequest
 
 class TimeoutException(Exception):
-    """Custom timeout exception"""
-    pass
+    """
+    Custom timeout exception
+
+    When raised by with_timeout(), thread is the abandoned helper thread,
+    which keeps running until its function returns.
+    """
+
+    def __init__(self, message, thread=None):
+        super().__init__(message)
+        self.thread = thread
+
+# Counters a ResourceMeter reports for every stage, in this order
+RESOURCE_COUNTERS = ('net_download_bytes', 'net_upload_bytes', 'xml_parts_scanned', 'xml_parts_parsed', 'runs_touched')
+_resource_meters = threading.local()
+
+def _thread_io_snapshot(baseline=False):
+    """
+    (bytes read, bytes written) by the calling thread through read()/write() calls,
+    from /proc/thread-self/io on Linux; (0, 0) elsewhere
+
+    These are rchar/wchar: every read()/write() call counts, whether it reaches
+    a file (disk or page cache), a pipe or a socket, so log output is included.
+    HTTPS traffic is included too, because OpenSSL reads and writes its socket
+    with read()/write(); plain HTTP through Python's recv()/send() is not. The
+    counters shown do not include this read of the io file itself; a baseline
+    snapshot adds it, so it is not counted as the stage's reads.
+    """
+    try:
+        with open('/proc/thread-self/io', 'rb') as io_file:
+            data = io_file.read()
+    except OSError:
+        return 0, 0
+    fields = dict(line.split(b': ') for line in data.splitlines())
+    return int(fields[b'rchar']) + (len(data) if baseline else 0), int(fields[b'wchar'])
+
+def _rss_kb():
+    """
+    Current resident set size of this process in KB, from /proc/self/statm on Linux; 0 elsewhere
+
+    Unlike the peak (ru_maxrss), which stops moving once a worker has
+    handled its largest deck, this also shows memory given back.
+    """
+    try:
+        with open('/proc/self/statm', 'rb') as statm:
+            resident_pages = int(statm.read().split()[1])
+        return resident_pages * os.sysconf('SC_PAGE_SIZE') // 1024
+    except (OSError, AttributeError, IndexError, ValueError):
+        return 0
+
+class ResourceMeter:
+    """
+    Resource accounting for one request, broken down by pipeline stage
+
+    For each stage it records wall and CPU time, bytes passed through
+    read()/write() (files and HTTPS sockets, see _thread_io_snapshot) and
+    RSS, plus the RESOURCE_COUNTERS the stage code adds through
+    count_resource(). CPU time and read/write bytes cover the request thread
+    and any helper thread that attach()es to the meter (e.g. the with_timeout
+    threads), but not the part process pool or link check threads. RSS is
+    sampled at the start and end of each stage: rss_delta_kb is the change
+    (negative when memory was freed) and rss_kb the RSS at the end. Both
+    are process-wide, so concurrent requests show up in them too.
+
+    The current stage is kept per thread, so a with_timeout thread that
+    keeps running after its request timed out does not move the request
+    thread's later work into its stage, or the other way round.
+    """
+
+    _ids = itertools.count(1)
+
+    def __init__(self, endpoint=None, source=None):
+        self._lock = threading.Lock()
+        self._stages = OrderedDict()
+        self._thread_stages = {}  # thread ident -> current stage
+        # In-flight introspection (see InflightRegistry)
+        self.job_id = f"{os.getpid()}-{next(self._ids)}"
+        self.endpoint = endpoint
+        self.source = source
+        self.started_at = time.time()
+        self.finished = False
+        self.threads = {}  # thread ident -> (thread name, role, stage when it started)
+
+    def _usage(self, stage):
+        usage = self._stages.get(stage)
+        if usage is None:
+            usage = self._stages[stage] = dict.fromkeys(
+                ('wall_time', 'cpu_time', 'rss_delta_kb', 'rss_kb', 'read_bytes', 'write_bytes')
+                + RESOURCE_COUNTERS, 0)
+        return usage
+
+    def _add_thread_usage(self, stage, cpu_start, io_start):
+        read_bytes, write_bytes = _thread_io_snapshot()
+        cpu_time = time.thread_time() - cpu_start
+        with self._lock:
+            usage = self._usage(stage)
+            usage['cpu_time'] += cpu_time
+            usage['read_bytes'] += read_bytes - io_start[0]
+            usage['write_bytes'] += write_bytes - io_start[1]
+
+    def current_stage(self):
+        """Stage the calling thread is in, or None"""
+        with self._lock:
+            return self._thread_stages.get(threading.get_ident())
+
+    def thread_stages(self):
+        """{thread ident: current stage} of the threads working for this request"""
+        with self._lock:
+            return dict(self._thread_stages)
+
+    def _set_thread_stage(self, stage):
+        with self._lock:
+            if stage is None:
+                self._thread_stages.pop(threading.get_ident(), None)
+            else:
+                self._thread_stages[threading.get_ident()] = stage
+
+    @contextlib.contextmanager
+    def activate(self):
+        """Make this the meter count_resource() and stage() report to in the calling thread"""
+        previous = getattr(_resource_meters, 'meter', None)
+        _resource_meters.meter = self
+        try:
+            yield self
+        finally:
+            _resource_meters.meter = previous
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """Account everything the calling thread does inside the block to stage name"""
+        previous = self.current_stage()
+        self._set_thread_stage(name)
+        wall_start, cpu_start, io_start, rss_start = time.time(), time.thread_time(), _thread_io_snapshot(True), _rss_kb()
+        try:
+            yield
+        finally:
+            self._add_thread_usage(name, cpu_start, io_start)
+            rss_end = _rss_kb()
+            with self._lock:
+                usage = self._usage(name)
+                usage['wall_time'] += time.time() - wall_start
+                usage['rss_delta_kb'] += rss_end - rss_start
+                usage['rss_kb'] = max(usage['rss_kb'], rss_end)
+            self._set_thread_stage(previous)
+
+    @contextlib.contextmanager
+    def attach(self, stage=None):
+        """
+        Account a helper thread's CPU time and read/write bytes to stage
+
+        Args:
+            stage (str): The starting thread's current_stage(), taken before
+                the helper thread starts; 'other' when None
+        """
+        stage = stage or 'other'
+        cpu_start, io_start = time.thread_time(), _thread_io_snapshot(True)
+        inflight_jobs.thread_started(self, 'helper', stage)
+        self._set_thread_stage(stage)
+        with self.activate():
+            try:
+                yield
+            finally:
+                self._add_thread_usage(stage, cpu_start, io_start)
+                self._set_thread_stage(None)
+                inflight_jobs.thread_finished(self)
+
+    def count(self, name, amount=1):
+        with self._lock:
+            self._usage(self._thread_stages.get(threading.get_ident()) or 'other')[name] += amount
+
+    def summary(self):
+        """{stage: usage} plus a 'total' entry, times rounded to milliseconds"""
+        with self._lock:
+            stages = {stage: dict(usage) for stage, usage in self._stages.items()}
+        # Stages run one after another, so the total RSS change is the sum of the stages' changes;
+        # the total rss_kb is the highest RSS seen at the end of a stage
+        total = {}
+        for usage in stages.values():
+            for key, value in usage.items():
+                total[key] = max(total.get(key, 0), value) if key == 'rss_kb' else total.get(key, 0) + value
+        stages['total'] = total
+        for usage in stages.values():
+            for key in ('wall_time', 'cpu_time'):
+                if key in usage:
+                    usage[key] = round(usage[key], 3)
+        return stages
+
+    def progress(self):
+        """Totals so far of the byte and part counters; counters move live, read/write bytes at stage ends"""
+        with self._lock:
+            return {key: sum(usage[key] for usage in self._stages.values())
+                    for key in ('read_bytes', 'write_bytes') + RESOURCE_COUNTERS}
+
+class InflightRegistry:
+    """
+    Jobs currently running in this worker, for GET /admin/inflight and the dump signal
+
+    A job is registered for as long as its request runs and any helper
+    thread attached to it is alive. with_timeout threads keep running after
+    their request has timed out and returned; such jobs stay listed with
+    "finished": true until the thread ends, so leaked work is visible.
+
+    While jobs are registered, a background thread writes this worker's
+    snapshot to INFLIGHT_DIR every INFLIGHT_SNAPSHOT_INTERVAL seconds so any
+    worker can report on all of them. A snapshot that stops being refreshed
+    points at a worker that is stuck holding the GIL.
+    """
+
+    def __init__(self, snapshot_dir=INFLIGHT_DIR, interval=INFLIGHT_SNAPSHOT_INTERVAL):
+        self._lock = threading.Lock()
+        self._jobs = OrderedDict()
+        self._snapshot_dir = snapshot_dir
+        self._interval = interval
+        self._writer_pid = None
+
+    def register(self, meter):
+        with self._lock:
+            self._jobs[meter.job_id] = meter
+        self._ensure_writer()
+
+    def finish(self, meter):
+        """The request returned; keep the job listed while helper threads still run"""
+        with self._lock:
+            meter.finished = True
+            meter.threads.pop(threading.get_ident(), None)
+            if not meter.threads:
+                self._jobs.pop(meter.job_id, None)
+
+    def thread_started(self, meter, role, stage=None):
+        thread = threading.current_thread()
+        with self._lock:
+            meter.threads[thread.ident] = (thread.name, role, stage)
+
+    def thread_finished(self, meter):
+        with self._lock:
+            meter.threads.pop(threading.get_ident(), None)
+            if meter.finished and not meter.threads:
+                self._jobs.pop(meter.job_id, None)
+
+    def snapshot(self, include_stacks=True):
+        """List this worker's in-flight jobs as JSON-serializable dicts"""
+        frames = sys._current_frames() if include_stacks else {}
+        now = time.time()
+        with self._lock:
+            jobs = [(meter, dict(meter.threads)) for meter in self._jobs.values()]
+
+        snapshot = []
+        for meter, threads in jobs:
+            stages = meter.thread_stages()
+            # A thread's live stage, else the stage it was started for
+            thread_stage = {ident: stages.get(ident) or stage for ident, (name, role, stage) in threads.items()}
+            request_stage = next((thread_stage[ident] for ident, (name, role, stage) in threads.items()
+                                  if role == 'request'), None)
+            job = {
+                "id": meter.job_id,
+                "pid": os.getpid(),
+                "endpoint": meter.endpoint,
+                "source": meter.source,
+                # Once the request has returned, its orphaned threads tell where the work is
+                "stage": request_stage or next((stage for stage in thread_stage.values() if stage), None),
+                "elapsed": round(now - meter.started_at, 3),
+                "finished": meter.finished,
+                "progress": meter.progress(),
+                "threads": []
+            }
+            for ident, (name, role, stage) in threads.items():
+                thread = {"ident": ident, "name": name, "role": role, "stage": thread_stage[ident]}
+                if include_stacks and ident in frames:
+                    thread["stack"] = traceback.format_stack(frames[ident])
+                job["threads"].append(thread)
+            snapshot.append(job)
+        return snapshot
+
+    def _ensure_writer(self):
+        """Start the snapshot writer thread once per worker process (threads do not survive fork)"""
+        if not self._snapshot_dir or self._writer_pid == os.getpid():
+            return
+        with self._lock:
+            if self._writer_pid == os.getpid():
+                return
+            self._writer_pid = os.getpid()
+        threading.Thread(target=self._write_snapshots, name="inflight-snapshot", daemon=True).start()
+
+    def _snapshot_path(self, pid):
+        return os.path.join(self._snapshot_dir, f"{pid}.json")
+
+    def _write_snapshots(self):
+        path = self._snapshot_path(os.getpid())
+        while True:
+            try:
+                jobs = self.snapshot()
+                if jobs:
+                    os.makedirs(self._snapshot_dir, exist_ok=True)
+                    temp_path = f"{path}.tmp"
+                    with open(temp_path, 'w', encoding='utf-8') as snapshot_file:
+                        json.dump({"pid": os.getpid(), "written_at": time.time(), "jobs": jobs}, snapshot_file)
+                    os.replace(temp_path, path)
+                elif os.path.exists(path):
+                    os.unlink(path)
+            except Exception as e:
+                logger.warning(f"Could not write in-flight snapshot: {str(e)}")
+            time.sleep(self._interval)
+
+    def all_workers(self, include_stacks=True):
+        """
+        This worker's live snapshot plus the latest snapshot file of every other worker
+
+        Files left by workers that no longer exist are removed.
+
+        Returns:
+            list: One {pid, snapshot_age, jobs} dict per worker with jobs in flight
+        """
+        workers = [{"pid": os.getpid(), "snapshot_age": 0.0, "jobs": self.snapshot(include_stacks)}]
+        if not self._snapshot_dir or not os.path.isdir(self._snapshot_dir):
+            return workers
+
+        with os.scandir(self._snapshot_dir) as scan:
+            for entry in scan:
+                pid_text = entry.name[:-len('.json')]
+                if not entry.name.endswith('.json') or not pid_text.isdigit() or int(pid_text) == os.getpid():
+                    continue
+                try:
+                    os.kill(int(pid_text), 0)
+                except ProcessLookupError:
+                    with contextlib.suppress(OSError):
+                        os.unlink(entry.path)
+                    continue
+                except PermissionError:
+                    pass
+                try:
+                    with open(entry.path, encoding='utf-8') as snapshot_file:
+                        data = json.load(snapshot_file)
+                except (OSError, ValueError):
+                    continue  # being replaced right now
+                jobs = data.get("jobs", [])
+                if not include_stacks:
+                    for job in jobs:
+                        for thread in job.get("threads", []):
+                            thread.pop("stack", None)
+                workers.append({"pid": data.get("pid"), "snapshot_age": round(time.time() - data.get("written_at", 0), 3),
+                                "jobs": jobs})
+        return workers
+
+inflight_jobs = InflightRegistry()
+
+def dump_inflight_jobs(signum=None, frame=None):
+    """INFLIGHT_DUMP_SIGNAL handler: log the in-flight jobs from a new thread, never inside the handler
+    (the interrupted code may hold the logging locks)"""
+    threading.Thread(target=log_inflight_jobs, name="inflight-dump", daemon=True).start()
+
+def log_inflight_jobs():
+    """Log this worker's in-flight jobs with thread stacks"""
+    jobs = inflight_jobs.snapshot()
+    logger.warning(f"{len(jobs)} in-flight jobs in worker {os.getpid()}")
+    for job in jobs:
+        threads = job.pop("threads")
+        logger.warning("In-flight job", extra={"fields": job})
+        for thread in threads:
+            logger.warning(f"  Thread {thread['name']} ({thread['role']}, stage {thread['stage']}):\n"
+                           + ''.join(thread.get("stack", [])))
+
+def install_inflight_dump_signal():
+    """
+    Install dump_inflight_jobs() as the INFLIGHT_DUMP_SIGNAL handler
+
+    Must run in the main thread of each worker. Under gunicorn, call it from
+    a post_worker_init hook: workers reset their signal handlers at start-up.
+    """
+    if not INFLIGHT_DUMP_SIGNAL or not hasattr(signal, INFLIGHT_DUMP_SIGNAL):
+        return False
+    try:
+        signal.signal(getattr(signal, INFLIGHT_DUMP_SIGNAL), dump_inflight_jobs)
+    except ValueError as e:  # not the main thread
+        logger.warning(f"Could not install {INFLIGHT_DUMP_SIGNAL} handler: {str(e)}")
+        return False
+    return True
+
+def current_resource_meter():
+    """The ResourceMeter active in this thread, or None"""
+    return getattr(_resource_meters, 'meter', None)
+
+def count_resource(name, amount=1):
+    """Add to one of the RESOURCE_COUNTERS of the current request's current stage, if it is being metered"""
+    meter = getattr(_resource_meters, 'meter', None)
+    if meter is not None:
+        meter.count(name, amount)
+
+def resource_stage(name):
+    """meter.stage(name) for the current request's meter, or a no-op when not metered"""
+    meter = current_resource_meter()
+    return meter.stage(name) if meter is not None else contextlib.nullcontext()
+
+SPAN_KIND_INTERNAL, SPAN_KIND_SERVER, SPAN_KIND_CLIENT = 1, 2, 3  # OTLP SpanKind values
+STATUS_CODE_ERROR = 2  # OTLP StatusCode; spans that did not fail are left UNSET
+_trace_context = threading.local()
+
+class Span:
+    """
+    One timed operation of a request's trace
+
+    Spans are recorded into their Trace and exported with it when the root
+    span ends; see TraceCollector.
+    """
+
+    __slots__ = ('trace', 'name', 'span_id', 'parent_id', 'kind', 'start_ns', 'end_ns', 'attributes', 'events', 'error')
+
+    def __init__(self, trace, name, parent_id=None, kind=SPAN_KIND_INTERNAL, attributes=None, start_ns=None):
+        self.trace = trace
+        self.name = name
+        self.span_id = os.urandom(8).hex()
+        self.parent_id = parent_id
+        self.kind = kind
+        self.start_ns = start_ns or time.time_ns()
+        self.end_ns = None
+        self.attributes = dict(attributes or {})
+        self.events = []
+        self.error = None
+
+    @property
+    def trace_id(self):
+        return self.trace.trace_id
+
+    def set_attribute(self, key, value):
+        if value is not None:
+            self.attributes[key] = value
+
+    def set_attributes(self, **attributes):
+        for key, value in attributes.items():
+            self.set_attribute(key, value)
+
+    def record_exception(self, e):
+        """Mark the span failed and attach the exception as an OTLP "exception" event"""
+        self.error = f"{type(e).__name__}: {str(e)}"
+        self.events.append({"name": "exception", "time_ns": time.time_ns(),
+                            "attributes": {"exception.type": type(e).__name__, "exception.message": str(e)}})
+
+    def end(self, end_ns=None):
+        self.end_ns = end_ns or time.time_ns()
+        if self is self.trace.root:
+            self.trace.collector.finish(self.trace)
+
+    def to_otlp(self, now_ns):
+        """The span as an OTLP/JSON Span object; spans still open are closed at now_ns"""
+        span = {
+            "traceId": self.trace.trace_id,
+            "spanId": self.span_id,
+            "name": self.name,
+            "kind": self.kind,
+            "startTimeUnixNano": str(self.start_ns),
+            "endTimeUnixNano": str(self.end_ns or now_ns),
+            "attributes": _otlp_attributes(dict(self.attributes, **({} if self.end_ns else {"unfinished": True})))
+        }
+        if self.parent_id:
+            span["parentSpanId"] = self.parent_id
+        if self.events:
+            span["events"] = [{"name": event["name"], "timeUnixNano": str(event["time_ns"]),
+                               "attributes": _otlp_attributes(event["attributes"])} for event in self.events]
+        if self.error:
+            span["status"] = {"code": STATUS_CODE_ERROR, "message": self.error}
+        return span
+
+class _NoopSpan:
+    """Stands in for a Span when the request is not traced, so call sites need no checks"""
+
+    trace_id = None
+
+    def set_attribute(self, key, value):
+        pass
+
+    def set_attributes(self, **attributes):
+        pass
+
+    def record_exception(self, e):
+        pass
+
+    def end(self, end_ns=None):
+        pass
+
+NOOP_SPAN = _NoopSpan()
+
+def _otlp_value(value):
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}  # int64 is a decimal string in OTLP/JSON
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+def _otlp_attributes(attributes):
+    return [{"key": key, "value": _otlp_value(value)} for key, value in attributes.items()]
+
+class Trace:
+    """The spans of one request; helper threads add spans concurrently"""
+
+    def __init__(self, collector):
+        self.collector = collector
+        self.trace_id = os.urandom(16).hex()
+        self.root = None
+        self.spans = []
+        self.exported = False
+        self._lock = threading.Lock()
+
+    def start_span(self, name, parent=None, kind=SPAN_KIND_INTERNAL, attributes=None, start_ns=None):
+        span = Span(self, name, parent.span_id if parent is not None else None, kind, attributes, start_ns)
+        with self._lock:
+            if self.root is None:
+                self.root = span
+            self.spans.append(span)
+        return span
+
+    def to_otlp(self):
+        """The whole trace as one OTLP/JSON ExportTraceServiceRequest"""
+        now_ns = time.time_ns()
+        with self._lock:
+            spans = [span.to_otlp(now_ns) for span in self.spans]
+        return {"resourceSpans": [{
+            "resource": {"attributes": _otlp_attributes({"service.name": TRACE_SERVICE_NAME, "process.pid": os.getpid()})},
+            "scopeSpans": [{"scope": {"name": __name__}, "spans": spans}]
+        }]}
+
+class TraceCollector:
+    """
+    Collects the traces of finished requests in this worker
+
+    A trace is exported when its root span ends, in the OTLP/JSON format:
+    kept in memory (the last TRACE_BUFFER_SIZE traces, for GET /admin/traces)
+    and, when TRACE_FILE is set, appended to it as one line per trace by a
+    background thread. Spans of helper threads still running at that point
+    (e.g. after a timeout) are exported as they are, flagged "unfinished".
+    Traces shorter than TRACE_MIN_DURATION seconds are dropped unless the
+    request failed.
+    """
+
+    def __init__(self, trace_file=TRACE_FILE, buffer_size=TRACE_BUFFER_SIZE, min_duration=TRACE_MIN_DURATION):
+        self._lock = threading.Lock()
+        self._trace_file = trace_file
+        self._recent = deque(maxlen=max(buffer_size, 0))
+        self._min_duration_ns = int(min_duration * 1e9)
+        self.enabled = bool(trace_file) or buffer_size > 0
+        self._queue = None
+        self._writer_pid = None
+        self.exported = 0
+        self.dropped = 0
+
+    def start_trace(self, name, attributes=None):
+        """Root span of a new trace, or NOOP_SPAN when tracing is off"""
+        if not self.enabled:
+            return NOOP_SPAN
+        return Trace(self).start_span(name, kind=SPAN_KIND_SERVER, attributes=attributes)
+
+    def finish(self, trace):
+        root = trace.root
+        if trace.exported or (root.end_ns - root.start_ns < self._min_duration_ns and not root.error):
+            return
+        trace.exported = True
+        document = trace.to_otlp()
+        with self._lock:
+            self._recent.append((trace.trace_id, root.end_ns - root.start_ns, root.error is not None, document))
+            self.exported += 1
+        if self._trace_file:
+            self._ensure_writer()
+            try:
+                self._queue.put_nowait(document)
+            except queue.Full:
+                self.dropped += 1
+
+    def _ensure_writer(self):
+        """Start the file writer thread once per worker process (threads do not survive fork)"""
+        if self._writer_pid == os.getpid():
+            return
+        with self._lock:
+            if self._writer_pid == os.getpid():
+                return
+            self._queue = queue.Queue(TRACE_QUEUE_SIZE)
+            self._writer_pid = os.getpid()
+        threading.Thread(target=self._write_traces, args=(self._queue,), name="trace-writer", daemon=True).start()
+
+    def _write_traces(self, trace_queue):
+        while True:
+            document = trace_queue.get()
+            try:
+                os.makedirs(os.path.dirname(os.path.abspath(self._trace_file)), exist_ok=True)
+                # One write() per line on an O_APPEND file, so workers sharing the file do not interleave
+                fd = os.open(self._trace_file, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+                try:
+                    os.write(fd, (json.dumps(document, ensure_ascii=False, separators=(',', ':')) + '\n').encode('utf-8'))
+                finally:
+                    os.close(fd)
+            except Exception as e:
+                self.dropped += 1
+                logger.warning(f"Could not write trace to {self._trace_file}: {str(e)}")
+
+    def recent(self, trace_id=None, min_duration=0.0, errors_only=False, limit=20):
+        """OTLP documents of the most recent traces kept in memory, newest first"""
+        with self._lock:
+            traces = list(self._recent)
+        documents = []
+        for recent_id, duration_ns, failed, document in reversed(traces):
+            if trace_id and recent_id != trace_id:
+                continue
+            if duration_ns < min_duration * 1e9 or (errors_only and not failed):
+                continue
+            documents.append(document)
+            if len(documents) >= limit:
+                break
+        return documents
+
+    def metrics(self):
+        with self._lock:
+            return {"enabled": self.enabled, "buffered": len(self._recent), "exported": self.exported,
+                    "dropped": self.dropped, "file": self._trace_file or None}
+
+trace_collector = TraceCollector()
+
+def current_span():
+    """The span active in this thread, or NOOP_SPAN"""
+    return getattr(_trace_context, 'span', None) or NOOP_SPAN
+
+@contextlib.contextmanager
+def activate_span(span):
+    """Make span the parent of the spans the calling thread starts inside the block"""
+    previous = getattr(_trace_context, 'span', None)
+    _trace_context.span = span
+    try:
+        yield span
+    finally:
+        _trace_context.span = previous
+
+@contextlib.contextmanager
+def trace_span(name, kind=SPAN_KIND_INTERNAL, **attributes):
+    """
+    Child span of the current span for the block; exceptions leaving the block
+    mark it failed. Yields NOOP_SPAN when the current request is not traced.
+    """
+    parent = current_span()
+    if parent is NOOP_SPAN:
+        yield NOOP_SPAN
+        return
+    span = parent.trace.start_span(name, parent, kind, attributes)
+    try:
+        with activate_span(span):
+            yield span
+    except BaseException as e:
+        span.record_exception(e)
+        raise
+    finally:
+        span.end()
+
+def record_span(name, start_ns, end_ns, **attributes):
+    """Add a finished child span of the current span, for work timed elsewhere (e.g. in the part process pool)"""
+    parent = current_span()
+    if parent is not NOOP_SPAN:
+        parent.trace.start_span(name, parent, attributes=attributes, start_ns=start_ns).end(end_ns)
+
+@contextlib.contextmanager
+def pipeline_stage(name, **attributes):
+    """resource_stage(name) plus a span of the same name; yields the span"""
+    with resource_stage(name), trace_span(name, **attributes) as span:
+        yield span
 
 def with_timeout(seconds):
     """Decorator to add timeout to functions (Windows compatible)"""
@@ -61,10 +1046,14 @@ def with_timeout(seconds):
         def wrapper(*args, **kwargs):
             result = [None]
             exception = [None]
+            meter = current_resource_meter()
+            stage = meter.current_stage() if meter is not None else None
+            span = current_span()
 
             def target():
                 try:
-                    result[0] = func(*args, **kwargs)
+                    with meter.attach(stage) if meter is not None else contextlib.nullcontext(), activate_span(span):
+                        result[0] = func(*args, **kwargs)
                 except Exception as e:
                     exception[0] = e
 
@@ -75,7 +1064,7 @@ def with_timeout(seconds):
 
             if thread.is_alive():
                 logger.warning(f"Operation timed out after {seconds} seconds")
-                raise TimeoutException("Operation timed out")
+                raise TimeoutException("Operation timed out", thread)
 
             if exception[0]:
                 raise exception[0]
@@ -84,231 +1073,2034 @@ def with_timeout(seconds):
         return wrapper
     return decorator
 
-def download_file_with_retry(url, filepath, max_retries=MAX_RETRIES):
-    """Download file with retry mechanism and proper error handling"""
-    for attempt in range(max_retries):
-        try:
-            logger.info(f"Downloading file (attempt {attempt + 1}/{max_retries})")
+class _Flight:
+    """One in-flight computation that other callers can wait on"""
 
-            # Validate URL
-            parsed_url = urlparse(url)
-            if not parsed_url.scheme or not parsed_url.netloc:
-                raise ValueError(f"Invalid URL: {url}")
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
 
-            # Make request with timeout and streaming - optimized for speed
-            response = requests.get(
-                url,
-                stream=True,
-                timeout=(5, REQUEST_TIMEOUT),  # (connect_timeout, read_timeout) - faster connect
-                headers={
-                    'User-Agent': 'PPT-Hyperlink-Converter/1.0',
-                    'Accept-Encoding': 'gzip, deflate'  # Enable compression
-                }
-            )
-            response.raise_for_status()
-
-            # Check content length
-            content_length = response.headers.get('content-length')
-            if content_length and int(content_length) > MAX_FILE_SIZE:
-                raise ValueError(f"File too large: {content_length} bytes (max: {MAX_FILE_SIZE})")
-
-            # Download with size checking - optimized chunk size
-            total_size = 0
-            with open(filepath, 'wb') as f:
-                for chunk in response.iter_content(chunk_size=65536):  # 64KB chunks for faster download
-                    if chunk:
-                        total_size += len(chunk)
-                        if total_size > MAX_FILE_SIZE:
-                            raise ValueError(f"File too large: {total_size} bytes (max: {MAX_FILE_SIZE})")
-                        f.write(chunk)
+class SingleFlight:
+    """
+    Coalesce concurrent calls for the same key into a single computation
 
-            logger.info(f"File downloaded successfully: {total_size} bytes")
-            return total_size
+    Within a worker, callers for a key that is already running wait for the
+    leader and receive its result (or its exception). Across workers, leaders
+    serialize on an flock() in lock_dir, and successful JSON results are left
+    in the directory so workers that were waiting on the lock can reuse them
+    instead of recomputing. A result is only reused if it was written while
+    the worker was blocked on the lock: a request arriving after the leader
+    finished computes afresh, so a deck re-published to the same URL is not
+    answered with the old output. Result files are swept after
+    SINGLE_FLIGHT_RESULT_TTL seconds.
+    """
 
-        except (requests.RequestException, ValueError) as e:
-            logger.warning(f"Download attempt {attempt + 1} failed: {str(e)}")
-            if attempt == max_retries - 1:
-                raise
-            time.sleep(RETRY_DELAY * (attempt + 1))  # Exponential backoff
+    def __init__(self, lock_dir=None, result_ttl=SINGLE_FLIGHT_RESULT_TTL, wait_timeout=API_TIMEOUT):
+        self._lock = threading.Lock()
+        self._flights = {}
+        self._lock_dir = lock_dir if (lock_dir and fcntl is not None) else None
+        self._result_ttl = result_ttl
+        self._wait_timeout = wait_timeout
+
+    def do(self, key, fn, shareable=lambda result: True):
+        """
+        Run fn() once per key among concurrent callers
+
+        Args:
+            key (str): Coalescing key, e.g. the source URL or content hash
+            fn (callable): Computation to run if no identical call is in flight
+            shareable (callable): Whether a result may be handed to other workers through lock_dir;
+                it must then be JSON serializable
+
+        Returns:
+            tuple: (result, coalesced) where coalesced is True if another call computed the result
+        """
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight()
+
+        if not leader:
+            logger.info(f"Waiting for in-flight request with the same key: {key}")
+            if not flight.done.wait(self._wait_timeout):
+                raise TimeoutException("Timed out waiting for an identical in-flight request")
+            if flight.error is not None:
+                raise flight.error
+            return flight.result, True
+
+        coalesced = False
+        try:
+            flight.result, coalesced = self._run_across_processes(key, fn, shareable)
+            return flight.result, coalesced
         except Exception as e:
-            logger.error(f"Unexpected error during download: {str(e)}")
+            flight.error = e
             raise
+        finally:
+            with self._lock:
+                del self._flights[key]
+            flight.done.set()
 
-@with_timeout(20)  # 20 seconds timeout for extraction
-def extract_links_from_pptx(pptx_path):
+    def _run_across_processes(self, key, fn, shareable):
+        if not self._lock_dir:
+            return fn(), False
+
+        digest = hashlib.sha256(key.encode('utf-8')).hexdigest()
+        lock_path = os.path.join(self._lock_dir, f"{digest}.lock")
+        result_path = os.path.join(self._lock_dir, f"{digest}.json")
+        try:
+            os.makedirs(self._lock_dir, exist_ok=True)
+            lock_file = open(lock_path, 'a')
+        except OSError as e:
+            logger.warning(f"Single-flight lock directory unavailable, running without it: {str(e)}")
+            return fn(), False
+
+        with lock_file:
+            # flock() has no timeout, so poll with LOCK_NB until the deadline
+            wait_start_ns = time.time_ns()
+            deadline = time.time() + self._wait_timeout
+            locked = False
+            waited = False
+            while True:
+                try:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    locked = True
+                    break
+                except BlockingIOError:
+                    waited = True
+                    if time.time() >= deadline:
+                        logger.warning(f"Timed out waiting for another worker on {key}, processing independently")
+                        break
+                    time.sleep(0.05)
+
+            try:
+                # Only a leader that held the lock while we waited can have produced our result
+                cached = self._read_result(result_path, wait_start_ns) if waited else None
+                if cached is not None:
+                    logger.info(f"Reusing result computed by another worker for: {key}")
+                    return cached, True
+
+                result = fn()
+                if shareable(result):
+                    self._write_result(result_path, result)
+                return result, False
+            finally:
+                if locked:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _read_result(self, result_path, written_after_ns):
+        """The shared result, if it was written at or after written_after_ns (a coarse mtime only rejects more)"""
+        try:
+            if os.stat(result_path).st_mtime_ns < written_after_ns:
+                return None
+            with open(result_path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _write_result(self, result_path, result):
+        try:
+            tmp_path = f"{result_path}.{os.getpid()}.tmp"
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(result, f, ensure_ascii=False)
+            os.replace(tmp_path, result_path)
+            self._sweep_expired_results()
+        except (OSError, TypeError, ValueError) as e:
+            logger.warning(f"Could not share single-flight result: {str(e)}")
+
+    def _sweep_expired_results(self):
+        now = time.time()
+        for name in os.listdir(self._lock_dir):
+            if not name.endswith('.json'):
+                continue
+            path = os.path.join(self._lock_dir, name)
+            try:
+                if now - os.path.getmtime(path) > self._result_ttl:
+                    os.remove(path)
+            except OSError:
+                pass
+
+pipeline_flight = SingleFlight(SINGLE_FLIGHT_DIR)
+
+class LRUCache:
     """
-    Extract media and game links from PPTX file by examining its XML content
+    Small thread-safe LRU cache with hit/miss counters
 
-    Args:
-        pptx_path (str): Path to the PPTX file
+    Bounded by entry count and, when max_bytes is given, by the sum of
+    sizeof(value) over all entries. A value larger than max_bytes on its
+    own is not stored.
+    """
+
+    def __init__(self, maxsize, max_bytes=None, sizeof=None):
+        self.maxsize = maxsize
+        self.max_bytes = max_bytes
+        self._sizeof = sizeof
+        self._lock = threading.Lock()
+        self._data = OrderedDict()
+        self._sizes = {}
+        self._bytes = 0
+        self._hits = 0
+        self._misses = 0
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                self._data.move_to_end(key)
+            except KeyError:
+                self._misses += 1
+                return default
+            self._hits += 1
+            return self._data[key]
+
+    def put(self, key, value):
+        size = self._sizeof(value) if self.max_bytes is not None else 0
+        with self._lock:
+            if self.max_bytes is not None and size > self.max_bytes:
+                return
+            self._bytes -= self._sizes.pop(key, 0)
+            self._data[key] = value
+            self._data.move_to_end(key)
+            if size:
+                self._sizes[key] = size
+                self._bytes += size
+            while len(self._data) > self.maxsize or (self.max_bytes is not None and self._bytes > self.max_bytes):
+                evicted, _ = self._data.popitem(last=False)
+                self._bytes -= self._sizes.pop(evicted, 0)
+
+    def metrics(self):
+        with self._lock:
+            lookups = self._hits + self._misses
+            metrics = {
+                "size": len(self._data),
+                "maxsize": self.maxsize,
+                "hits": self._hits,
+                "misses": self._misses,
+                "hit_rate": round(self._hits / lookups, 4) if lookups else 0.0
+            }
+            if self.max_bytes is not None:
+                metrics["bytes"] = self._bytes
+                metrics["max_bytes"] = self.max_bytes
+            return metrics
+
+class OutputCache:
+    """
+    Size-bounded directory of processed outputs, shared by all workers
+
+    Files are named by their content hash and replaced atomically, so
+    workers never see partial files and concurrent puts of the same key
+    are harmless. A file's mtime doubles as its last-access time: hits
+    touch it, and when the directory grows past max_bytes the least
+    recently touched files are deleted first. Files are served by nginx
+    (X-Accel-Redirect), which keeps reading an evicted file it has open.
+    """
+
+    KEY_REGEX = re.compile(r'^[0-9a-f]{64}\.pptx$')
+
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+
+    @property
+    def enabled(self):
+        return bool(self.directory) and self.max_bytes > 0
+
+    def path(self, key):
+        """Local path of a cached file, or None if key is not a valid cache key"""
+        if not self.enabled or not self.KEY_REGEX.match(key):
+            return None
+        return os.path.join(self.directory, key)
+
+    def get(self, key):
+        """Path of a cached file, marking it recently used, or None on a miss"""
+        path = self.path(key)
+        try:
+            if path is None:
+                raise FileNotFoundError(key)
+            os.utime(path)
+        except OSError:
+            with self._lock:
+                self._misses += 1
+            return None
+        with self._lock:
+            self._hits += 1
+        return path
+
+    def put(self, key, source):
+        """
+        Copy a file into the cache under key, evicting old files as needed
+
+        Args:
+            key (str): '<sha256>.pptx'
+            source (str or file): Local file path, or a seekable file object
+
+        Returns:
+            bool: True if the file is now in the cache
+        """
+        path = self.path(key)
+        if path is None:
+            return False
+        try:
+            if _source_size(source) > self.max_bytes:
+                return False
+            if os.path.exists(path):
+                os.utime(path)
+                return True
+            os.makedirs(self.directory, exist_ok=True)
+            fd, temp_path = tempfile.mkstemp(dir=self.directory, prefix='.tmp-')
+            try:
+                with os.fdopen(fd, 'wb') as cache_file:
+                    if isinstance(source, str):
+                        with open(source, 'rb') as source_file:
+                            shutil.copyfileobj(source_file, cache_file)
+                    else:
+                        _rewind(source)
+                        shutil.copyfileobj(source, cache_file)
+                os.chmod(temp_path, 0o644)  # nginx usually runs as another user
+                os.replace(temp_path, path)
+            except BaseException:
+                with contextlib.suppress(OSError):
+                    os.unlink(temp_path)
+                raise
+        except OSError as e:
+            logger.warning(f"Could not add {key} to the local output cache: {str(e)}")
+            return False
+        self._evict()
+        return True
+
+    def _evict(self):
+        """Delete least recently used files until the directory fits in max_bytes"""
+        entries = []
+        total = 0
+        with os.scandir(self.directory) as scan:
+            for entry in scan:
+                if not self.KEY_REGEX.match(entry.name):
+                    continue
+                try:
+                    stat = entry.stat()
+                except OSError:
+                    continue  # evicted by another worker meanwhile
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+                total += stat.st_size
+        if total <= self.max_bytes:
+            return
+        entries.sort()
+        for mtime, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            with contextlib.suppress(FileNotFoundError):
+                os.unlink(path)
+                with self._lock:
+                    self._evictions += 1
+            total -= size
+
+    def metrics(self):
+        files = 0
+        total = 0
+        if self.enabled and os.path.isdir(self.directory):
+            with os.scandir(self.directory) as scan:
+                for entry in scan:
+                    if self.KEY_REGEX.match(entry.name):
+                        with contextlib.suppress(OSError):
+                            total += entry.stat().st_size
+                            files += 1
+        with self._lock:
+            lookups = self._hits + self._misses
+            return {
+                "enabled": self.enabled,
+                "files": files,
+                "bytes": total,
+                "max_bytes": self.max_bytes,
+                "hits": self._hits,
+                "misses": self._misses,
+                "evictions": self._evictions,
+                "hit_rate": round(self._hits / lookups, 4) if lookups else 0.0
+            }
+
+output_cache = OutputCache(OUTPUT_CACHE_DIR, OUTPUT_CACHE_MAX_BYTES)
+
+class AdmissionRejected(Exception):
+    """Raised when a job cannot be admitted; retry_after is a hint in seconds"""
+
+    def __init__(self, message, retry_after):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+class AdmissionController:
+    """
+    Admit processing jobs against a per-worker memory and concurrency budget
+
+    Jobs that do not fit wait in a bounded FIFO queue. A job whose estimate
+    exceeds the whole budget is charged the full budget, so it runs alone
+    instead of never running. When the queue is full, or a job waits longer
+    than max_wait, AdmissionRejected is raised.
+
+    A job that leaves its with-block through a with_timeout() TimeoutException
+    has only been abandoned: its helper thread still holds the deck's memory.
+    Its slot is released when that thread exits, not when the request returns.
+    """
+
+    def __init__(self, memory_budget=MEMORY_BUDGET, max_concurrent=MAX_CONCURRENT_JOBS,
+                 max_queue=ADMISSION_QUEUE_SIZE, max_wait=ADMISSION_MAX_WAIT):
+        self.memory_budget = memory_budget
+        self.max_concurrent = max_concurrent
+        self.max_queue = max_queue
+        self.max_wait = max_wait
+        self._cond = threading.Condition()
+        self._queue = deque()
+        self._running = 0
+        self._memory_in_use = 0
+        self._admitted = 0
+        self._rejected_queue_full = 0
+        self._rejected_timeout = 0
+        self._abandoned = 0
+        self._wait_times = deque(maxlen=1000)
+        self._job_times = deque(maxlen=100)
+
+    def _fits(self, cost):
+        return self._running < self.max_concurrent and self._memory_in_use + cost <= self.memory_budget
+
+    def _retry_after(self):
+        """Rough time until a slot frees up, from recent job durations"""
+        average_job = sum(self._job_times) / len(self._job_times) if self._job_times else 5.0
+        batches = (len(self._queue) + 1) / max(self.max_concurrent, 1)
+        return max(1, math.ceil(average_job * batches))
+
+    @contextlib.contextmanager
+    def admit(self, estimated_memory):
+        """
+        Hold a slot for the duration of the with-block
+
+        Args:
+            estimated_memory (int): Estimated peak memory of the job in bytes
+
+        Yields:
+            float: Seconds spent waiting in the queue
+        """
+        cost = min(estimated_memory, self.memory_budget)
+        wait_start = time.time()
+
+        with self._cond:
+            if self._queue or not self._fits(cost):
+                if len(self._queue) >= self.max_queue:
+                    self._rejected_queue_full += 1
+                    raise AdmissionRejected("Server is busy: processing queue is full", self._retry_after())
+
+                ticket = object()
+                self._queue.append(ticket)
+                deadline = wait_start + self.max_wait
+                while not (self._queue[0] is ticket and self._fits(cost)):
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        self._queue.remove(ticket)
+                        self._rejected_timeout += 1
+                        self._cond.notify_all()
+                        raise AdmissionRejected(
+                            f"Server is busy: waited {self.max_wait:.0f}s for a processing slot", self._retry_after())
+                    self._cond.wait(remaining)
+                self._queue.popleft()
+                # The next job in line may fit as well
+                self._cond.notify_all()
+
+            self._running += 1
+            self._memory_in_use += cost
+            self._admitted += 1
+            wait_time = time.time() - wait_start
+            self._wait_times.append(wait_time)
+
+        if wait_time > 0.01:
+            logger.info(f"Job admitted after waiting {wait_time:.2f}s in queue (estimated memory: {estimated_memory} bytes)")
+
+        job_start = time.time()
+        release = True
+        try:
+            yield wait_time
+        except TimeoutException as e:
+            if e.thread is not None and e.thread.is_alive():
+                release = False
+                with self._cond:
+                    self._abandoned += 1
+                logger.warning(f"Timed-out job is still running, keeping its slot until it finishes "
+                               f"(estimated memory: {estimated_memory} bytes)")
+                threading.Thread(target=self._release_after, args=(e.thread, cost, job_start),
+                                 name="admission-release", daemon=True).start()
+            raise
+        finally:
+            if release:
+                self._release(cost, job_start)
+
+    def _release(self, cost, job_start):
+        with self._cond:
+            self._running -= 1
+            self._memory_in_use -= cost
+            self._job_times.append(time.time() - job_start)
+            self._cond.notify_all()
+
+    def _release_after(self, thread, cost, job_start):
+        """Release an abandoned job's slot once its helper thread has exited"""
+        thread.join()
+        with self._cond:
+            self._abandoned -= 1
+        self._release(cost, job_start)
+
+    def metrics(self):
+        """Snapshot of queue depth, budget usage and wait-time statistics"""
+        with self._cond:
+            wait_times = sorted(self._wait_times)
+            return {
+                "queue_depth": len(self._queue),
+                "running_jobs": self._running,
+                "abandoned_jobs": self._abandoned,
+                "memory_in_use": self._memory_in_use,
+                "memory_budget": self.memory_budget,
+                "max_concurrent_jobs": self.max_concurrent,
+                "max_queue": self.max_queue,
+                "admitted_total": self._admitted,
+                "rejected_queue_full_total": self._rejected_queue_full,
+                "rejected_timeout_total": self._rejected_timeout,
+                "wait_time": {
+                    "samples": len(wait_times),
+                    "avg": round(sum(wait_times) / len(wait_times), 4) if wait_times else 0.0,
+                    "p50": round(wait_times[len(wait_times) // 2], 4) if wait_times else 0.0,
+                    "p95": round(wait_times[int(len(wait_times) * 0.95)], 4) if wait_times else 0.0,
+                    "max": round(wait_times[-1], 4) if wait_times else 0.0
+                }
+            }
+
+admission_controller = AdmissionController()
+
+# 重任务通道：大文件先在这里排队，再和普通任务一起占用内存预算
+heavy_lane_controller = AdmissionController(memory_budget=MEMORY_BUDGET, max_concurrent=HEAVY_MAX_CONCURRENT_JOBS,
+                                            max_queue=max(ADMISSION_QUEUE_SIZE // 4, 1))
+
+def _source_size(pptx_source):
+    """Size in bytes of a PPTX path or seekable file object"""
+    if hasattr(pptx_source, 'seek'):
+        pptx_source.seek(0, os.SEEK_END)
+        size = pptx_source.tell()
+        pptx_source.seek(0)
+        return size
+    return os.path.getsize(pptx_source)
+
+class PreflightRejected(ValueError):
+    """Raised when the zip central directory shows a file we should not parse"""
+    pass
+
+SLIDE_NAME_REGEX = re.compile(r'^ppt/slides/slide\d+\.xml$')
+SLIDE_RELS_NAME_REGEX = re.compile(r'^ppt/slides/_rels/slide\d+\.xml\.rels$')
+
+def summarize_zip_entries(entries, file_size):
+    """
+    Compute preflight statistics from zip central directory entries
+
+    Args:
+        entries (list): (name, compressed size, uncompressed size) per member
+        file_size (int): Size of the whole package in bytes
+
+    Returns:
+        dict: Sizes, member and slide counts, compression ratios, media share
+            and the estimated peak memory of processing the package
+    """
+    total_compressed = sum(compressed for name, compressed, uncompressed in entries)
+    total_uncompressed = sum(uncompressed for name, compressed, uncompressed in entries)
+    xml_size = sum(uncompressed for name, compressed, uncompressed in entries if name.endswith(('.xml', '.rels')))
+    slide_xml_size = sum(uncompressed for name, compressed, uncompressed in entries
+                         if SLIDE_NAME_REGEX.match(name) or SLIDE_RELS_NAME_REGEX.match(name))
+    largest_member = max((uncompressed for name, compressed, uncompressed in entries), default=0)
+    largest_xml = max((uncompressed for name, compressed, uncompressed in entries
+                       if name.endswith(('.xml', '.rels'))), default=0)
+    media_size = sum(uncompressed for name, compressed, uncompressed in entries if name.startswith('ppt/media/'))
+    names = {name for name, compressed, uncompressed in entries}
+
+    # Largest expansion among members big enough to matter
+    max_member_ratio = max(
+        (uncompressed / max(compressed, 1) for name, compressed, uncompressed in entries if uncompressed > 1024 * 1024),
+        default=0.0)
+
+    return {
+        "file_size": file_size,
+        "total_compressed": total_compressed,
+        "total_uncompressed": total_uncompressed,
+        "member_count": len(entries),
+        "slide_count": sum(1 for name in names if SLIDE_NAME_REGEX.match(name)),
+        "xml_size": xml_size,
+        "media_size": media_size,
+        "media_share": round(media_size / total_uncompressed, 4) if total_uncompressed else 0.0,
+        "compression_ratio": round(total_uncompressed / max(total_compressed, 1), 2),
+        "max_member_ratio": round(max_member_ratio, 2),
+        "is_pptx": 'ppt/presentation.xml' in names and '[Content_Types].xml' in names,
+        # The package is streamed part by part: one copy of the file (in-memory
+        # sources and inline outputs), the largest member read whole while it
+        # is copied, candidate slides held as input and rewritten bytes until
+        # the save, and the lxml tree of the one part being parsed
+        "estimated_memory": (BASE_JOB_MEMORY + file_size + largest_member + 2 * slide_xml_size
+                             + largest_xml * XML_MEMORY_FACTOR)
+    }
+
+def classify_preflight(summary):
+    """
+    Decide how to handle a package from its preflight summary
+
+    Returns:
+        tuple: (decision, reason) where decision is 'reject', 'heavy' or 'fast'
+    """
+    if not summary["is_pptx"]:
+        return 'reject', "Not a PPTX package (missing ppt/presentation.xml or [Content_Types].xml)"
+    if summary["member_count"] > MAX_ZIP_MEMBERS:
+        return 'reject', f"Too many files in package: {summary['member_count']} (max: {MAX_ZIP_MEMBERS})"
+    if summary["total_uncompressed"] > MAX_UNCOMPRESSED_SIZE:
+        return 'reject', (f"Package expands to {summary['total_uncompressed']} bytes "
+                          f"(max: {MAX_UNCOMPRESSED_SIZE})")
+    if summary["max_member_ratio"] > MAX_COMPRESSION_RATIO:
+        return 'reject', (f"Suspicious compression ratio {summary['max_member_ratio']} "
+                          f"(max: {MAX_COMPRESSION_RATIO})")
+    if summary["slide_count"] > HEAVY_SLIDE_COUNT or summary["estimated_memory"] > HEAVY_JOB_MEMORY:
+        return 'heavy', f"{summary['slide_count']} slides, estimated memory {summary['estimated_memory']} bytes"
+    return 'fast', "within normal limits"
+
+def preflight_pptx(pptx_source):
+    """
+    Inspect a PPTX using only its zip central directory, before anything parses it
+
+    Args:
+        pptx_source (str or file): Path to the PPTX file, or a seekable file object
+
+    Returns:
+        dict: summarize_zip_entries() statistics plus 'decision' and 'reason'
+
+    Raises:
+        PreflightRejected: If the file is not a zip, not a PPTX, or would expand
+            beyond the configured limits
+    """
+    file_size = _source_size(pptx_source)
+    try:
+        _rewind(pptx_source)
+        with zipfile.ZipFile(pptx_source, 'r') as zip_file:
+            entries = [(info.filename, info.compress_size, info.file_size) for info in zip_file.infolist()]
+    except zipfile.BadZipFile as e:
+        raise PreflightRejected(f"Not a valid PPTX (zip) file: {str(e)}")
+    finally:
+        _rewind(pptx_source)
+
+    summary = summarize_zip_entries(entries, file_size)
+    summary["decision"], summary["reason"] = classify_preflight(summary)
+    logger.info(f"Preflight: {summary['decision']} ({summary['reason']}); {summary['slide_count']} slides, "
+                f"{summary['total_uncompressed']} bytes uncompressed, ratio {summary['compression_ratio']}")
+
+    if summary["decision"] == 'reject':
+        raise PreflightRejected(summary["reason"])
+    return summary
+
+ZIP_EOCD_SIGNATURE = b'PK\x05\x06'
+ZIP64_EOCD_LOCATOR_SIGNATURE = b'PK\x06\x07'
+ZIP64_EOCD_SIGNATURE = b'PK\x06\x06'
+ZIP_CENTRAL_HEADER = struct.Struct('<4s6H3L5H2L')
+
+def _fetch_range(url, range_header):
+    """
+    GET a byte range; returns (body, total size) or None if the server does not honour ranges
+
+    Non-PPTX HTML responses (error pages) are rejected straight away.
+    """
+    response = requests.get(
+        url,
+        stream=True,
+        timeout=(5, REQUEST_TIMEOUT),
+        headers={
+            'User-Agent': 'PPT-Hyperlink-Converter/1.0',
+            'Accept-Encoding': 'identity',  # ranges must apply to the raw bytes
+            'Range': range_header
+        }
+    )
+    with response:
+        content_type = response.headers.get('content-type', '').lower()
+        if response.status_code in (200, 206) and content_type.startswith('text/html'):
+            raise PreflightRejected(f"URL returned an HTML page ({content_type}), not a PPTX file")
+        if response.status_code != 206:
+            return None
+
+        content_range = response.headers.get('content-range', '')
+        total = content_range.rsplit('/', 1)[-1] if '/' in content_range else ''
+        if not total.isdigit():
+            return None
+
+        body = response.raw.read(REMOTE_PREFLIGHT_TAIL_SIZE + MAX_ZIP_MEMBERS * 256, decode_content=False)
+        count_resource('net_download_bytes', len(body))
+        return body, int(total)
+
+def _parse_central_directory(data, entry_count):
+    """Parse zip central directory records into (name, compressed size, uncompressed size) entries"""
+    entries = []
+    offset = 0
+    for _ in range(entry_count):
+        if data[offset:offset + 4] != b'PK\x01\x02':
+            raise PreflightRejected("Corrupt zip central directory")
+        fields = ZIP_CENTRAL_HEADER.unpack_from(data, offset)
+        compressed, uncompressed = fields[8], fields[9]
+        name_len, extra_len, comment_len = fields[10], fields[11], fields[12]
+        name_start = offset + ZIP_CENTRAL_HEADER.size
+        name = data[name_start:name_start + name_len].decode('utf-8', errors='replace')
+
+        # Zip64 sizes live in extra field 0x0001, in order, only for fields set to 0xFFFFFFFF
+        if 0xFFFFFFFF in (compressed, uncompressed):
+            extra = data[name_start + name_len:name_start + name_len + extra_len]
+            pos = 0
+            while pos + 4 <= len(extra):
+                header_id, size = struct.unpack_from('<HH', extra, pos)
+                if header_id == 0x0001:
+                    values = list(struct.unpack_from(f'<{size // 8}Q', extra, pos + 4))
+                    if uncompressed == 0xFFFFFFFF and values:
+                        uncompressed = values.pop(0)
+                    if compressed == 0xFFFFFFFF and values:
+                        compressed = values.pop(0)
+                    break
+                pos += 4 + size
+
+        entries.append((name, compressed, uncompressed))
+        offset = name_start + name_len + extra_len + comment_len
+    return entries
+
+def remote_preflight(url):
+    """
+    Preflight a remote PPTX with HTTP Range requests, before downloading it
+
+    Fetches the end of the file (end-of-central-directory record and usually
+    the whole central directory), plus the central directory itself if it
+    did not fit, and applies the same checks as preflight_pptx().
+
+    Args:
+        url (str): Source URL of the PPTX
+
+    Returns:
+        dict or None: Preflight summary, or None if the server does not support
+            Range requests or returned less of the central directory than
+            needed (the normal download path then applies)
+
+    Raises:
+        PreflightRejected: If the remote file is not a PPTX or would be rejected
+        ValueError: If the remote file is larger than MAX_FILE_SIZE
+    """
+    fetched = _fetch_range(url, f"bytes=-{REMOTE_PREFLIGHT_TAIL_SIZE}")
+    if fetched is None:
+        logger.info("Source does not support Range requests, skipping remote preflight")
+        return None
+    tail, total_size = fetched
+
+    if total_size > MAX_FILE_SIZE:
+        raise ValueError(f"File too large: {total_size} bytes (max: {MAX_FILE_SIZE})")
+
+    eocd = tail.rfind(ZIP_EOCD_SIGNATURE)
+    if eocd == -1 or len(tail) - eocd < 22:
+        raise PreflightRejected("Remote file is not a PPTX (zip) file")
+    entry_count, cd_size, cd_offset = struct.unpack_from('<HLL', tail, eocd + 10)
+
+    if 0xFFFFFFFF in (cd_size, cd_offset) or entry_count == 0xFFFF:
+        # Zip64: the locator sits right before the EOCD and points at the zip64 EOCD record
+        locator = eocd - 20
+        if locator < 0 or tail[locator:locator + 4] != ZIP64_EOCD_LOCATOR_SIGNATURE:
+            raise PreflightRejected("Corrupt zip64 end of central directory")
+        zip64_eocd = struct.unpack_from('<Q', tail, locator + 8)[0] - (total_size - len(tail))
+        if zip64_eocd < 0 or tail[zip64_eocd:zip64_eocd + 4] != ZIP64_EOCD_SIGNATURE:
+            return None
+        entry_count, cd_size, cd_offset = struct.unpack_from('<QQQ', tail, zip64_eocd + 32)
+
+    if entry_count > MAX_ZIP_MEMBERS:
+        raise PreflightRejected(f"Too many files in package: {entry_count} (max: {MAX_ZIP_MEMBERS})")
+
+    tail_start = total_size - len(tail)
+    if cd_offset >= tail_start:
+        central_directory = tail[cd_offset - tail_start:cd_offset - tail_start + cd_size]
+    else:
+        fetched = _fetch_range(url, f"bytes={cd_offset}-{cd_offset + cd_size - 1}")
+        if fetched is None:
+            return None
+        central_directory = fetched[0]
+    if len(central_directory) < cd_size:
+        # Capped read or a short server response: let the local preflight decide after the download
+        logger.info(f"Remote central directory incomplete ({len(central_directory)} of {cd_size} bytes), "
+                    f"skipping remote preflight")
+        return None
+
+    summary = summarize_zip_entries(_parse_central_directory(central_directory, entry_count), total_size)
+    summary["decision"], summary["reason"] = classify_preflight(summary)
+    logger.info(f"Remote preflight: {summary['decision']} ({summary['reason']}); {summary['slide_count']} slides, "
+                f"{total_size} bytes")
+
+    if summary["decision"] == 'reject':
+        raise PreflightRejected(summary["reason"])
+    return summary
+
+def run_remote_preflight(url):
+    """
+    remote_preflight() as the 'remote_preflight' stage, when REMOTE_PREFLIGHT is on
+
+    Failures other than a rejection are logged and ignored: the download
+    and local preflight then apply as usual.
+
+    Returns:
+        tuple: (preflight summary or None, seconds spent)
+    """
+    if not REMOTE_PREFLIGHT:
+        return None, 0.0
+    remote_preflight_start = time.time()
+    remote_summary = None
+    try:
+        with pipeline_stage('remote_preflight') as span:
+            remote_summary = remote_preflight(url)
+            if remote_summary is not None:
+                span.set_attributes(decision=remote_summary["decision"], bytes=remote_summary["file_size"],
+                                    slide_count=remote_summary["slide_count"])
+    except (PreflightRejected, ValueError):
+        raise
+    except Exception as e:
+        logger.warning(f"Remote preflight failed, continuing with download: {str(e)}")
+    return remote_summary, time.time() - remote_preflight_start
+
+def _open_download_target(filepath):
+    """Open a path for writing, or reset an in-memory buffer so each attempt starts clean"""
+    if hasattr(filepath, 'write'):
+        filepath.seek(0)
+        filepath.truncate()
+        return contextlib.nullcontext(filepath)
+    return open(filepath, 'wb')
+
+def download_file_with_retry(url, filepath, max_retries=MAX_RETRIES):
+    """Download file (to a path or a writable buffer) with retry mechanism and proper error handling"""
+    for attempt in range(max_retries):
+        try:
+            logger.info(f"Downloading file (attempt {attempt + 1}/{max_retries})")
+
+            # Validate URL
+            parsed_url = urlparse(url)
+            if not parsed_url.scheme or not parsed_url.netloc:
+                raise ValueError(f"Invalid URL: {url}")
+
+            with trace_span('download.attempt', SPAN_KIND_CLIENT, attempt=attempt + 1) as span:
+                attempt_start_ns = time.time_ns()
+                # Make request with timeout and streaming - optimized for speed
+                response = requests.get(
+                    url,
+                    stream=True,
+                    timeout=(5, REQUEST_TIMEOUT),  # (connect_timeout, read_timeout) - faster connect
+                    headers={
+                        'User-Agent': 'PPT-Hyperlink-Converter/1.0',
+                        'Accept-Encoding': 'gzip, deflate'  # Enable compression
+                    }
+                )
+                span.set_attribute('http.response.status_code', response.status_code)
+                response.raise_for_status()
+
+                # Check content length
+                content_length = response.headers.get('content-length')
+                if content_length and int(content_length) > MAX_FILE_SIZE:
+                    raise ValueError(f"File too large: {content_length} bytes (max: {MAX_FILE_SIZE})")
+
+                # Download with size checking - optimized chunk size
+                total_size = 0
+                first_byte_ns = None
+                with _open_download_target(filepath) as f:
+                    for chunk in response.iter_content(chunk_size=65536):  # 64KB chunks for faster download
+                        if chunk:
+                            first_byte_ns = first_byte_ns or time.time_ns()
+                            total_size += len(chunk)
+                            if total_size > MAX_FILE_SIZE:
+                                raise ValueError(f"File too large: {total_size} bytes (max: {MAX_FILE_SIZE})")
+                            f.write(chunk)
+                            count_resource('net_download_bytes', len(chunk))
+                span.set_attribute('bytes', total_size)
+                if first_byte_ns:
+                    span.set_attribute('time_to_first_byte_ms', round((first_byte_ns - attempt_start_ns) / 1e6, 1))
+
+            logger.info(f"File downloaded successfully: {total_size} bytes")
+            return total_size
+
+        except (requests.RequestException, ValueError) as e:
+            logger.warning(f"Download attempt {attempt + 1} failed: {str(e)}")
+            if attempt == max_retries - 1:
+                raise
+            time.sleep(RETRY_DELAY * (attempt + 1))  # Exponential backoff
+        except Exception as e:
+            logger.error(f"Unexpected error during download: {str(e)}")
+            raise
+
+# Link patterns, run as one scanner over the raw UTF-8 bytes of each part:
+# - media: http(s) URL ending in a media extension, no spaces or (half/fullwidth) parentheses
+# - game: index.html?data_url=*.json, optionally followed by &studentId=* and other parameters
+# - other: any other http(s) URL (classified, but not converted)
+MEDIA_EXTENSIONS = 'mp3|mp4|wav|avi|mov|wmv|flv|ogg|webm'
+
+# The patterns used to run on decoded text, where \s also matches Unicode
+# spaces (NBSP, ideographic space, ...); they still end a URL here
+URL_DELIMITERS = ''.join(c for c in map(chr, range(0x3001)) if c.isspace())
+
+def _ascii_char_except(excluded):
+    """Bytes regex matching one byte that is not an ASCII excluded character (multi-byte ones are ignored)"""
+    return b'[^' + b''.join(re.escape(char.encode()) for char in sorted(set(excluded)) if char < '\x80') + b']'
+
+def _utf8_char_except(excluded):
+    """
+    Bytes regex matching one byte of UTF-8 text that is not part of an excluded character
+
+    Multi-byte excluded characters are refused at their lead byte with a
+    lookahead, so runs stop at e.g. fullwidth parentheses without decoding.
+    """
+    single = []
+    tails_by_lead = {}
+    for char in sorted(set(excluded)):
+        encoded = char.encode('utf-8')
+        if len(encoded) == 1:
+            single.append(encoded)
+        else:
+            tails_by_lead.setdefault(encoded[:1], []).append(encoded[1:])
+
+    alternatives = [b'[^' + b''.join(re.escape(byte) for byte in single + list(tails_by_lead)) + b']']
+    for lead, tails in tails_by_lead.items():
+        alternatives.append(re.escape(lead) + b'(?!' + b'|'.join(re.escape(tail) for tail in tails) + b')')
+    return b'(?:' + b'|'.join(alternatives) + b')'
+
+def _compile_link_scanner(char_except):
+    """
+    Compile the fused link pattern
+
+    Alternatives are tried in order at each http(s):// position: game links
+    first (the more specific rule), then media links, then any other URL.
+
+    Args:
+        char_except (callable): Returns the bytes regex for one URL byte
+            that is none of the given delimiter characters
+    """
+    url_char = char_except(URL_DELIMITERS)
+    media_url_char = char_except(URL_DELIMITERS + '()（）')
+    data_url_char = char_except(URL_DELIMITERS + '&')
+    other_url_char = char_except(URL_DELIMITERS + '()（）<>"\'')
+    return re.compile(
+        rb'https?://(?:'
+        rb'(?P<game>' + url_char + rb'+/index\.html\?data_url=https?://' + data_url_char + rb'+\.json(?:&' + url_char + rb'*)?)'
+        rb'|(?P<media>' + media_url_char + rb'+\.(?:' + MEDIA_EXTENSIONS.encode() + rb'))'
+        rb'|(?P<other>' + other_url_char + rb'+))',
+        re.IGNORECASE)
+
+# Plain byte classes are several times faster than per-byte lookaheads, so
+# scanning uses ASCII delimiters only; the few matches that contain a
+# multi-byte delimiter are redone with the exact pattern
+LINK_SCANNER_REGEX = _compile_link_scanner(_ascii_char_except)
+EXACT_LINK_SCANNER_REGEX = _compile_link_scanner(_utf8_char_except)
+MULTIBYTE_DELIMITER_REGEX = re.compile(b'|'.join(
+    re.escape(char.encode()) for char in sorted(set(URL_DELIMITERS + '（）')) if char >= '\x80'))
+
+XML_TAG_REGEX = re.compile(rb'<[^>]*>')
+XML_ENTITY_REGEX = re.compile(r'&(?:amp|lt|gt|quot|apos|#[0-9]+|#x[0-9a-fA-F]+);')
+SHAPE_PROPS_REGEX = re.compile(rb'<p:cNvPr\b[^>]*>')
+XML_ATTR_REGEX = re.compile(rb'(\w+)="([^"]*)"')
+
+def _clean_link(span):
+    """
+    Turn a matched span into a link: drop XML tags, decode the text and its XML entities
+
+    Args:
+        span (bytes): Raw bytes matched by the link scanner
+
+    Returns:
+        str or None: The link, or None if nothing usable is left
+    """
+    cleaned_link = XML_TAG_REGEX.sub(b'', span).decode('utf-8', errors='ignore')
+    if '&' in cleaned_link:
+        cleaned_link = XML_ENTITY_REGEX.sub(lambda entity: html.unescape(entity.group(0)), cleaned_link)
+    cleaned_link = cleaned_link.strip()
+    if cleaned_link.startswith('http'):
+        return cleaned_link
+    return None
+
+def scan_links(content):
+    """
+    Find and classify every http(s) URL in one part in a single pass
+
+    Args:
+        content (bytes): Raw UTF-8 part content
+
+    Yields:
+        tuple: (kind, start offset, url) with kind 'game', 'media' or 'other'
+    """
+    position = 0
+    while True:
+        match = LINK_SCANNER_REGEX.search(content, position)
+        if match is None:
+            return
+        # The exact pattern can only match where the fast one does, never earlier
+        if MULTIBYTE_DELIMITER_REGEX.search(content, match.start(), match.end() + 2):
+            match = EXACT_LINK_SCANNER_REGEX.search(content, match.start())
+            if match is None:
+                return
+        position = match.end()
+
+        url = _clean_link(match.group(0))
+        if url:
+            yield match.lastgroup, match.start(), url
+
+# Bump whenever the link patterns or cleaning change, so cached part scans are not reused
+LINK_RULES_VERSION = 2
+
+# Per-part scan results keyed by (CRC32, uncompressed size, LINK_RULES_VERSION).
+# Decks built from the same templates share masters, layouts, themes and whole slides.
+part_scan_cache = LRUCache(PART_SCAN_CACHE_SIZE)
+
+def _scan_part(content):
+    """
+    Find media and game links in one part
+
+    Args:
+        content (bytes): Raw UTF-8 part content
+
+    Returns:
+        tuple: ((url, shape id, shape name), ...) in order of appearance, one
+            entry per distinct (url, shape)
+    """
+    hits = []
+    seen = set()
+    for kind, start, url in scan_links(content):
+        if kind == 'other':
+            continue
+        shape_id, shape_name = _shape_at(content, start)
+        if (url, shape_id) in seen:
+            continue
+        seen.add((url, shape_id))
+        hits.append((url, shape_id, shape_name))
+    return tuple(hits)
+
+def get_scan_scope(value):
+    """
+    Validate a requested scan scope, defaulting to SCAN_SCOPE
+
+    Args:
+        value (str or list): 'all', or scope names ('slides', 'notes',
+            'layouts', 'masters') as a list or comma separated string
+
+    Returns:
+        str or tuple: 'all', or the sorted tuple of scope names
+    """
+    if value is None or value == '':
+        value = SCAN_SCOPE
+    if isinstance(value, str):
+        value = value.split(',')
+    if not isinstance(value, (list, tuple)) or not all(isinstance(item, str) for item in value):
+        raise BadRequest("Invalid 'scan_scope': expected a list or comma separated string")
+
+    names = {item.strip().lower() for item in value if item.strip()}
+    if names == {'all'}:
+        return 'all'
+    unknown = names - set(SCAN_SCOPES)
+    if unknown or not names:
+        raise BadRequest(f"Invalid 'scan_scope': {', '.join(sorted(unknown)) or 'empty'} "
+                         f"(expected 'all' or any of: {', '.join(SCAN_SCOPES)})")
+    return tuple(sorted(names))
+
+def _links_key(supplied_links):
+    """Short stable digest of caller-supplied links for single-flight keys ('extract' when there are none)"""
+    if supplied_links is None:
+        return 'extract'
+    return hashlib.sha256('\n'.join(supplied_links).encode('utf-8')).hexdigest()[:16]
+
+def _scope_key(scan_scope):
+    """Stable string form of a get_scan_scope() result, for cache and single-flight keys"""
+    return scan_scope if scan_scope == 'all' else ','.join(scan_scope)
+
+def _reachable_text_parts(zip_file, scan_scope):
+    """
+    Walk the relationship graph from presentation.xml to the text parts in scope
+
+    presentation.xml references the slides and slide masters; each slide
+    references its notes slide and layout, and masters reference their
+    layouts. Only the relationships parts needed to reach the requested
+    scope are read.
+
+    Returns:
+        list: Part names in scope, slides first in presentation order
+    """
+    presentation_rels = _read_relationship_entries(zip_file, 'ppt/_rels/presentation.xml.rels')
+    masters = [target for rid, rel_type, target, external in presentation_rels
+               if not external and rel_type == RT_SLIDE_MASTER]
+
+    parts = []
+    for slide_part in _slide_parts_in_order(zip_file):
+        if not slide_part:
+            continue
+        if 'slides' in scan_scope:
+            parts.append(slide_part)
+        if 'notes' in scan_scope or 'layouts' in scan_scope:
+            for rid, rel_type, target, external in _read_relationship_entries(zip_file, _rels_name_for(slide_part)):
+                if external:
+                    continue
+                if (rel_type == RT_NOTES_SLIDE and 'notes' in scan_scope) or \
+                        (rel_type == RT_SLIDE_LAYOUT and 'layouts' in scan_scope):
+                    parts.append(target)
+
+    if 'layouts' in scan_scope:
+        # Layouts no slide uses are still reachable from their master
+        for master_part in masters:
+            parts.extend(target for rid, rel_type, target, external
+                         in _read_relationship_entries(zip_file, _rels_name_for(master_part))
+                         if not external and rel_type == RT_SLIDE_LAYOUT)
+    if 'masters' in scan_scope:
+        parts.extend(masters)
+
+    # Layouts are shared between slides: keep the first occurrence only
+    return list(dict.fromkeys(parts))
+
+def _read_scan_content(zip_file, info, external_targets_only=False):
+    """
+    Read one part's raw bytes for _scan_part()
+
+    Args:
+        zip_file (ZipFile): Open PPTX package
+        info (ZipInfo): The part to read
+        external_targets_only (bool): For relationships parts, return only the
+            targets of external relationships instead of the whole XML
+
+    Returns:
+        bytes: Part content, or None if the part could not be read
+    """
+    try:
+        if external_targets_only:
+            return '\n'.join(target for rid, rel_type, target, external
+                             in _read_relationship_entries(zip_file, info.filename) if external).encode('utf-8')
+        return zip_file.read(info.filename)
+    except Exception as e:
+        logger.warning(f"Error reading file {info.filename}: {str(e)}")
+        return None
+
+def _parts_to_scan(zip_file, scan_scope):
+    """List (ZipInfo, external targets only) for the parts scan_pptx_parts() visits"""
+    if scan_scope == 'all':
+        return [(info, False) for info in zip_file.infolist()
+                if info.filename.endswith('.xml') or info.filename.endswith('.rels')]
+
+    parts = []
+    for part_name in _reachable_text_parts(zip_file, scan_scope):
+        for name, external_targets_only in ((part_name, False), (_rels_name_for(part_name), True)):
+            try:
+                parts.append((zip_file.getinfo(name), external_targets_only))
+            except KeyError:
+                continue
+    return parts
+
+def scan_pptx_parts(zip_file, scan_scope='all'):
+    """
+    Scan the XML and relationship parts of an open PPTX package for media and game links
+
+    Parts are read straight from the archive in memory, nothing is extracted
+    to disk. The zip central directory gives each part's CRC32 and size for
+    free, so parts already scanned (in this or any earlier deck) are served
+    from part_scan_cache without being decompressed.
+
+    With scan_scope 'all' every .xml and .rels part is scanned. Otherwise
+    only the parts reachable from presentation.xml in that scope are visited
+    (see _reachable_text_parts), together with the external relationship
+    targets (hyperlinks) of each of them. Theme, chart, docProps and custom
+    XML parts are never read.
+
+    Parts missing from the cache are scanned together, on the part process
+    pool once there are at least PARALLEL_MIN_PARTS of them (see map_parts).
+
+    Args:
+        zip_file (ZipFile): Open PPTX package
+        scan_scope (str or tuple): 'all', or a get_scan_scope() tuple
+
+    Yields:
+        tuple: (part name, _scan_part() hits)
+    """
+    parts = _parts_to_scan(zip_file, scan_scope)
+    hits_by_part = {}
+    misses = []
+    for info, external_targets_only in parts:
+        cache_key = (info.CRC, info.file_size, LINK_RULES_VERSION, external_targets_only)
+        hits = part_scan_cache.get(cache_key)
+        if hits is None:
+            misses.append((info, external_targets_only, cache_key))
+        else:
+            hits_by_part[info.filename] = hits
+
+    # Decompression stays here (the archive is not shareable); regex scanning
+    # of the parts moves to the process pool on very large decks
+    contents = []
+    for info, external_targets_only, cache_key in misses:
+        content = _read_scan_content(zip_file, info, external_targets_only)
+        if content is not None:
+            contents.append((info.filename, cache_key, content))
+    results, parallel = map_parts(_scan_part, [content for name, cache_key, content in contents])
+    count_resource('xml_parts_scanned', len(contents))
+    if parallel:
+        logger.info(f"Scanned {len(contents)} parts on the process pool")
+    for (name, cache_key, content), hits in zip(contents, results):
+        part_scan_cache.put(cache_key, hits)
+        hits_by_part[name] = hits
+
+    for info, external_targets_only in parts:
+        if info.filename in hits_by_part:
+            yield info.filename, hits_by_part[info.filename]
+
+@with_timeout(20)  # 20 seconds timeout for extraction
+def extract_links_from_pptx(pptx_path, scan_scope='all'):
+    """
+    Extract media and game links from PPTX file by examining its XML content
+
+    Args:
+        pptx_path (str or file): Path to the PPTX file, or a seekable file object
+        scan_scope (str or tuple): 'all', or a get_scan_scope() tuple of parts to visit
+
+    Returns:
+        set: Set of unique links found in the PPTX file
+    """
+    links = set()
+
+    try:
+        # PPTX is a ZIP file; scan its parts in memory (links come back cleaned of XML tags and entities)
+        with zipfile.ZipFile(pptx_path, 'r') as zip_file:
+            for part_name, hits in scan_pptx_parts(zip_file, scan_scope):
+                links.update(url for url, shape_id, shape_name in hits)
+
+    except Exception as e:
+        logger.error(f"Error extracting links from PPTX: {str(e)}")
+        raise
+
+    return links
+
+def _read_relationship_entries(zip_file, rels_name):
+    """
+    Parse a relationships part
+
+    Internal targets are resolved to part names; external targets (URLs)
+    are returned as written.
+
+    Returns:
+        list: (rId, relationship type, target, is external) per relationship
+    """
+    try:
+        root = ET.fromstring(zip_file.read(rels_name))
+    except KeyError:
+        return []
+    count_resource('xml_parts_parsed')
+
+    # ppt/slides/_rels/slide1.xml.rels -> targets are relative to ppt/slides/
+    base_dir = posixpath.dirname(posixpath.dirname(rels_name))
+    records = []
+    for rel in root:
+        target = rel.get('Target', '')
+        external = rel.get('TargetMode') == 'External'
+        if not external:
+            if target.startswith('/'):
+                target = target.lstrip('/')
+            else:
+                target = posixpath.normpath(posixpath.join(base_dir, target))
+        records.append((rel.get('Id'), rel.get('Type', ''), target, external))
+    return records
+
+def _read_relationships(zip_file, rels_name):
+    """Return {rId: target part name} for a relationships part, resolving relative targets"""
+    return {rid: target for rid, rel_type, target, external
+            in _read_relationship_entries(zip_file, rels_name) if not external}
+
+def _rels_name_for(part_name):
+    """Relationships part name for a part, e.g. ppt/slides/_rels/slide1.xml.rels"""
+    return posixpath.join(posixpath.dirname(part_name), '_rels', posixpath.basename(part_name) + '.rels')
+
+def _slide_parts_in_order(zip_file):
+    """
+    List slide part names in presentation order (the sldIdLst of presentation.xml)
+
+    Returns:
+        list: Slide part names, e.g. ['ppt/slides/slide1.xml', ...]
+    """
+    try:
+        presentation = ET.fromstring(zip_file.read('ppt/presentation.xml'))
+    except KeyError:
+        return []
+    count_resource('xml_parts_parsed')
+
+    presentation_rels = _read_relationships(zip_file, 'ppt/_rels/presentation.xml.rels')
+    slide_ids = presentation.find(f'{{{PML_NS}}}sldIdLst')
+    if slide_ids is None:
+        return []
+    return [presentation_rels.get(slide_id.get(f'{{{REL_NS}}}id')) for slide_id in slide_ids]
+
+def _slide_numbers_by_part(zip_file):
+    """
+    Map slide and notes slide part names to their 1-based slide number in presentation order
+
+    Returns:
+        dict: {part name: slide number}
+    """
+    numbers = {}
+    for slide_number, slide_part in enumerate(_slide_parts_in_order(zip_file), start=1):
+        if not slide_part:
+            continue
+        numbers[slide_part] = slide_number
+
+        # Notes slides belong to the slide that references them
+        for target in _read_relationships(zip_file, _rels_name_for(slide_part)).values():
+            if '/notesSlides/' in target:
+                numbers[target] = slide_number
+    return numbers
+
+def _shape_at(content, position):
+    """Return (shape id, shape name) of the closest shape declared before position in a slide part"""
+    tag_start = content.rfind(b'<p:cNvPr', 0, position)
+    if tag_start == -1:
+        return None, None
+    tag = SHAPE_PROPS_REGEX.match(content, tag_start)
+    if not tag:
+        return None, None
+    attrs = {name.decode(): value.decode('utf-8', errors='ignore') for name, value in XML_ATTR_REGEX.findall(tag.group(0))}
+    shape_id = attrs.get('id')
+    return (int(shape_id) if shape_id and shape_id.isdigit() else shape_id), html.unescape(attrs.get('name', ''))
+
+@with_timeout(20)  # 20 seconds timeout for extraction
+def locate_links_in_pptx(pptx_path, scan_scope='all', rule_set='default'):
+    """
+    Find media and game links in a PPTX together with where they appear
+
+    Runs only the scanning stage: nothing is rewritten, saved or uploaded.
+
+    Args:
+        pptx_path (str or file): Path to the PPTX file, or a seekable file object
+        scan_scope (str or tuple): 'all', or a get_scan_scope() tuple of parts to visit
+        rule_set (str): Link rule set that classifies each link
+
+    Returns:
+        list: One dict per distinct (link, part, shape) occurrence with keys
+            url, kind, display_text, part, slide, shape_id and shape_name
+    """
+    locations = []
+
+    try:
+        with zipfile.ZipFile(pptx_path, 'r') as zip_file:
+            slide_numbers = _slide_numbers_by_part(zip_file)
+
+            for part_name, hits in scan_pptx_parts(zip_file, scan_scope):
+                # Relationship parts (hyperlink targets) are attributed to their source part
+                source_part = part_name
+                if part_name.endswith('.rels'):
+                    source_part = posixpath.join(posixpath.dirname(posixpath.dirname(part_name)),
+                                                 posixpath.basename(part_name)[:-len('.rels')])
+
+                for url, shape_id, shape_name in hits:
+                    kind, display_text = classify_link(url, rule_set)
+                    locations.append({
+                        "url": url,
+                        "kind": kind,
+                        "display_text": display_text,
+                        "part": part_name,
+                        "slide": slide_numbers.get(source_part),
+                        "shape_id": shape_id,
+                        "shape_name": shape_name
+                    })
+
+    except Exception as e:
+        logger.error(f"Error locating links in PPTX: {str(e)}")
+        raise
+
+    return locations
+
+# Built-in link classification rules: the first matching rule gives the link's kind and display text
+DEFAULT_LINK_RULES = {
+    "rules": [
+        # Game links: index.html?data_url=*.json, optionally with &studentId=*
+        {"kind": "game", "label": "点击游戏", "contains": ["index.html?data_url=", ".json"]},
+        {"kind": "audio", "label": "点击音频", "extensions": ["mp3", "wav", "ogg"]},
+        {"kind": "video", "label": "点击视频", "extensions": ["mp4", "avi", "mov", "wmv", "flv", "webm"]}
+    ],
+    # Shouldn't happen with the current link patterns
+    "fallback": {"kind": "link", "label": "点击链接"}
+}
+
+LINK_CLASSIFICATION_CACHE_SIZE = 10000
+
+class LinkRuleSet:
+    """
+    A set of link classification rules compiled into a single regex
+
+    Each rule becomes one alternative made of lookaheads (every 'contains'
+    substring, any of the 'extensions', an optional 'pattern'), anchored at
+    the start of the URL, so the first rule that matches wins in one regex
+    call. Results are memoized per URL.
+    """
+
+    def __init__(self, name, config):
+        rules = config.get("rules")
+        if not isinstance(rules, list) or not rules:
+            raise ValueError(f"Link rule set '{name}' has no rules")
+
+        branches = []
+        self._results = []
+        for index, rule in enumerate(rules):
+            conditions = [rf'(?=.*?{re.escape(text)})' for text in rule.get("contains", [])]
+            if rule.get("extensions"):
+                extensions = '|'.join(re.escape(extension.lstrip('.')) for extension in rule["extensions"])
+                conditions.append(rf'(?=.*?\.(?:{extensions}))')
+            if rule.get("pattern"):
+                conditions.append(rf'(?=.*?(?:{rule["pattern"]}))')
+            if not conditions or "label" not in rule:
+                raise ValueError(f"Link rule {index} of set '{name}' needs a label and at least one condition")
+            branches.append(f'(?P<rule{index}>{"".join(conditions)})')
+            self._results.append((rule.get("kind", "link"), rule["label"]))
+
+        fallback = config.get("fallback", DEFAULT_LINK_RULES["fallback"])
+        self.name = name
+        self._fallback = (fallback.get("kind", "link"), fallback["label"])
+        self._regex = re.compile('|'.join(branches), re.IGNORECASE | re.DOTALL)
+        self.cache = LRUCache(LINK_CLASSIFICATION_CACHE_SIZE)
+
+    def classify(self, link):
+        """Return (kind, display text) for a link"""
+        result = self.cache.get(link)
+        if result is None:
+            match = self._regex.match(link)
+            result = self._results[int(match.lastgroup[len('rule'):])] if match else self._fallback
+            self.cache.put(link, result)
+        return result
+
+def load_link_rule_sets(path=LINK_RULES_FILE):
+    """
+    Compile the built-in rules plus any rule sets from a JSON config file
+
+    The file maps rule set names (e.g. one per tenant) to rule sets in the
+    format of DEFAULT_LINK_RULES; a "default" entry replaces the built-in
+    rules. A file that cannot be loaded is logged and ignored.
+
+    Returns:
+        dict: {rule set name: LinkRuleSet}
+    """
+    configs = {"default": DEFAULT_LINK_RULES}
+    if path:
+        try:
+            with open(path, encoding='utf-8') as f:
+                configs.update(json.load(f))
+            rule_sets = {name: LinkRuleSet(name, config) for name, config in configs.items()}
+            logger.info(f"Loaded link rule sets from {path}: {', '.join(sorted(rule_sets))}")
+            return rule_sets
+        except Exception as e:
+            logger.error(f"Failed to load link rules from {path}, using built-in rules: {str(e)}")
+    return {"default": LinkRuleSet("default", DEFAULT_LINK_RULES)}
+
+link_rule_sets = load_link_rule_sets()
+
+def get_rule_set(value):
+    """Validate the requested link rule set name, defaulting to 'default'"""
+    name = value or 'default'
+    if name not in link_rule_sets:
+        raise BadRequest(f"Unknown 'rule_set': {name} (available: {', '.join(sorted(link_rule_sets))})")
+    return name
+
+def classify_link(link, rule_set='default'):
+    """
+    Classify a link with a link rule set
+
+    Args:
+        link (str): The link URL
+        rule_set (str): Name of the rule set to use
+
+    Returns:
+        tuple: (kind, display text), e.g. ('audio', '点击音频')
+    """
+    return link_rule_sets[rule_set].classify(link)
+
+def get_friendly_link_text(link, rule_set='default'):
+    """
+    Convert a link URL to friendly display text
+
+    Args:
+        link (str): The original link URL
+        rule_set (str): Name of the link rule set to use
+
+    Returns:
+        str: Friendly display text like "点击音频", "点击视频", "点击游戏"
+    """
+    return classify_link(link, rule_set)[1]
+
+def _outline_urls(outline):
+    """Yield the url of every node in a course outline (nested nodes with 'url' and 'children')"""
+    # Accept the full API response ({"data": {"result": {...}}}) as well as the root node
+    if isinstance(outline, dict) and isinstance(outline.get("data"), dict) and "result" in outline["data"]:
+        outline = outline["data"]["result"]
+
+    stack = [outline]
+    while stack:
+        node = stack.pop()
+        if isinstance(node, list):
+            stack.extend(reversed(node))
+        elif isinstance(node, dict):
+            if isinstance(node.get("url"), str):
+                yield node["url"]
+            stack.extend(reversed(node.get("children") or []))
+
+def get_supplied_links(links=None, outline=None):
+    """
+    Validate links supplied by the caller, so extraction can be skipped
+
+    Either an explicit list of links or the course outline JSON the deck was
+    generated from may be given. Every URL goes through the same link rules
+    as text found in a deck, so images and other non media/game URLs are
+    ignored. The caller's order is kept: when a paragraph mentions several
+    links, the first one listed wins.
+
+    Args:
+        links (list or str): Link URLs, or a JSON array of them
+        outline (dict, list or str): Course outline, or its JSON text
+
+    Returns:
+        tuple: (list of links, or None to extract them from the deck; link source
+            'links', 'outline' or 'extracted')
+    """
+    if links in (None, '') and outline in (None, ''):
+        return None, 'extracted'
+    if links not in (None, '') and outline not in (None, ''):
+        raise BadRequest("Provide either 'links' or 'outline', not both")
+
+    source = 'links' if links not in (None, '') else 'outline'
+    value = links if source == 'links' else outline
+    if isinstance(value, str):
+        try:
+            value = json.loads(value)
+        except ValueError:
+            raise BadRequest(f"Invalid '{source}': not valid JSON")
+
+    if source == 'links':
+        if not isinstance(value, list) or not all(isinstance(url, str) for url in value):
+            raise BadRequest("Invalid 'links': expected an array of URL strings")
+        urls = value
+    else:
+        if not isinstance(value, (dict, list)):
+            raise BadRequest("Invalid 'outline': expected a JSON object")
+        urls = list(_outline_urls(value))
+    if len(urls) > MAX_SUPPLIED_LINKS:
+        raise BadRequest(f"Too many links in '{source}': {len(urls)} (max: {MAX_SUPPLIED_LINKS})")
+
+    supplied = []
+    for url in urls:
+        supplied.extend(link for kind, start, link in scan_links(url.strip().encode('utf-8')) if kind != 'other')
+    return list(dict.fromkeys(supplied)), source
+
+# Link reachability checks: shared across requests, limited per host
+link_check_executor = ThreadPoolExecutor(max_workers=LINK_CHECK_WORKERS, thread_name_prefix='link-check')
+link_check_cache = LRUCache(LINK_CHECK_CACHE_SIZE)  # checked URL -> (expires at, result)
+_host_semaphores = {}
+_host_semaphores_lock = threading.Lock()
+_link_check_sessions = threading.local()
+
+def get_validate_links(value):
+    """Parse the optional validate_links flag, defaulting to VALIDATE_LINKS"""
+    if value is None or value == '':
+        return VALIDATE_LINKS
+    if isinstance(value, bool):
+        return value
+    if str(value).lower() in ('1', 'true', 'yes'):
+        return True
+    if str(value).lower() in ('0', 'false', 'no'):
+        return False
+    raise BadRequest(f"Invalid 'validate_links': {value} (expected true or false)")
+
+def _link_check_target(link):
+    """URL to check for a link: the data_url JSON for game links, the link itself otherwise"""
+    data_urls = parse_qs(urlparse(link).query).get('data_url')
+    if data_urls and data_urls[0].lower().startswith(('http://', 'https://')):
+        return data_urls[0]
+    return link
+
+def _host_semaphore(host):
+    with _host_semaphores_lock:
+        semaphore = _host_semaphores.get(host)
+        if semaphore is None:
+            semaphore = _host_semaphores[host] = threading.BoundedSemaphore(LINK_CHECK_PER_HOST)
+        return semaphore
+
+def _link_check_session():
+    """Per-thread requests session, so checks against the same host reuse connections"""
+    session = getattr(_link_check_sessions, 'session', None)
+    if session is None:
+        session = _link_check_sessions.session = requests.Session()
+        session.headers['User-Agent'] = 'PPT-Hyperlink-Converter/1.0'
+    return session
+
+def check_url(url, deadline):
+    """
+    Check whether a URL resolves: HEAD first, then a one-byte ranged GET if HEAD is refused
+
+    Args:
+        url (str): URL to check
+        deadline (float): time.time() by which the check must finish
+
+    Returns:
+        dict: reachable (bool, or None if not checked in time), status_code and error
+    """
+    semaphore = _host_semaphore(urlparse(url).netloc.lower())
+    if not semaphore.acquire(timeout=max(0.0, deadline - time.time())):
+        return {"reachable": None, "status_code": None, "error": "deadline exceeded"}
+    try:
+        session = _link_check_session()
+        response = None
+        for method in ('HEAD', 'GET'):
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return {"reachable": None, "status_code": None, "error": "deadline exceeded"}
+            timeout = min(LINK_CHECK_TIMEOUT, remaining)
+            if method == 'HEAD':
+                response = session.head(url, allow_redirects=True, timeout=timeout)
+            else:
+                # Some servers and CDNs refuse HEAD; ask for the first byte only
+                response = session.get(url, allow_redirects=True, stream=True, timeout=timeout,
+                                       headers={'Range': 'bytes=0-0', 'Accept-Encoding': 'identity'})
+            response.close()
+            if response.status_code < 400:
+                break
+        return {"reachable": response.status_code < 400, "status_code": response.status_code, "error": None}
+    except requests.Timeout:
+        return {"reachable": None, "status_code": None, "error": "timeout"}
+    except requests.RequestException as e:
+        return {"reachable": False, "status_code": None, "error": type(e).__name__}
+    finally:
+        semaphore.release()
+
+def _cached_check_url(url, deadline):
+    """check_url() through link_check_cache; inconclusive results (timeouts) are not cached"""
+    result = check_url(url, deadline)
+    if result["reachable"] is not None:
+        link_check_cache.put(url, (time.time() + LINK_CHECK_CACHE_TTL, result))
+    return result
+
+def _check_host_lane(lane, deadline):
+    """Check some of one host's URLs one after another; lane maps each URL to its Future"""
+    for url, future in lane.items():
+        if not future.set_running_or_notify_cancel():
+            continue  # collect_link_checks() gave up on it at the deadline
+        try:
+            future.set_result(_cached_check_url(url, deadline))
+        except Exception as e:
+            future.set_exception(e)
+
+def start_link_checks(links):
+    """
+    Start reachability checks for links in the background
+
+    Cached results (younger than LINK_CHECK_CACHE_TTL) are used as they are.
+    The other distinct URLs are grouped by host and split into at most
+    LINK_CHECK_PER_HOST lanes per host; each lane is one link_check_executor
+    task checking its URLs in turn. A slow host therefore holds at most
+    LINK_CHECK_PER_HOST executor threads, instead of every thread blocking on
+    its semaphore while checks for other hosts wait in the queue. The
+    semaphore still caps a host across concurrent requests. All checks share
+    one deadline, LINK_CHECK_DEADLINE seconds from now.
+
+    Args:
+        links (iterable): Links found in the deck
+
+    Returns:
+        dict: Pending checks, to pass to collect_link_checks()
+    """
+    deadline = time.time() + LINK_CHECK_DEADLINE
+    targets = {link: _link_check_target(link) for link in links}
+    checks = {}
+    by_host = {}
+    for target in dict.fromkeys(targets.values()):
+        cached = link_check_cache.get(target)
+        if cached is not None and cached[0] > time.time():
+            checks[target] = dict(cached[1], cached=True)
+        else:
+            checks[target] = Future()
+            by_host.setdefault(urlparse(target).netloc.lower(), []).append(target)
+    for urls in by_host.values():
+        for lane_number in range(min(LINK_CHECK_PER_HOST, len(urls))):
+            lane = {url: checks[url] for url in urls[lane_number::LINK_CHECK_PER_HOST]}
+            link_check_executor.submit(_check_host_lane, lane, deadline)
+    return {"deadline": deadline, "targets": targets, "checks": checks}
+
+def collect_link_checks(pending):
+    """
+    Wait (until the shared deadline at most) for checks started by start_link_checks()
+
+    Returns:
+        list: One dict per link with url, checked_url, reachable (True, False,
+            or None when it could not be checked in time), status_code, error and cached
+    """
+    statuses = {}
+    for target, check in pending["checks"].items():
+        if isinstance(check, dict):
+            statuses[target] = check
+            continue
+        try:
+            statuses[target] = dict(check.result(timeout=max(0.0, pending["deadline"] - time.time())), cached=False)
+        except Exception as e:
+            # Still queued or running at the deadline: report it unchecked
+            check.cancel()
+            statuses[target] = {"reachable": None, "status_code": None,
+                                "error": "deadline exceeded" if isinstance(e, TimeoutError) else str(e), "cached": False}
+
+    return [dict({"url": link, "checked_url": target}, **statuses[target])
+            for link, target in pending["targets"].items()]
+
+def find_matching_link(paragraph_text, links):
+    """
+    Find the link a paragraph refers to
+
+    Tries an exact (case-insensitive) match first, then falls back to matching
+    game links by domain plus index.html, and media links by domain plus extension.
+
+    Args:
+        paragraph_text (str): Full text of the paragraph
+        links (iterable): Candidate links
+
+    Returns:
+        str or None: The matched link
+    """
+    # Improved link matching - check if paragraph contains link-like content
+    paragraph_lower = paragraph_text.lower()
+
+    # Try exact match first
+    for link in links:
+        if link.lower() in paragraph_lower:
+            return link
+
+    # If no exact match, try partial matching for links
+    for link in links:
+        # Extract domain and key parts for matching
+        if 'index.html' in link and 'index.html' in paragraph_lower:
+            # For game links, match by domain and index.html
+            link_domain = link.split('/')[2] if '://' in link else ''
+            if link_domain and link_domain in paragraph_lower:
+                return link
+        elif any(ext in link for ext in ['.mp4', '.mp3', '.wav']) and any(ext in paragraph_lower for ext in ['.mp4', '.mp3', '.wav']):
+            # For media links, match by domain and extension
+            link_domain = link.split('/')[2] if '://' in link else ''
+            if link_domain and link_domain in paragraph_lower:
+                return link
+
+    return None
+
+# A paragraph can only match a link if its text contains one of these (see find_matching_link),
+# so slides whose text has none of them are never parsed. The text is searched with all tags
+# removed: a paragraph's runs are joined before matching, so "ht" + "tps://..." in two runs
+# still counts. Namespace declarations like xmlns:a="http://..." are inside tags and do not.
+SLIDE_CANDIDATE_REGEX = re.compile(rb'http|index\.html|\.mp[34]|\.wav', re.IGNORECASE)
+
+def _is_candidate_slide(slide_xml):
+    """Whether any paragraph of a slide part can contain a link (cheap bytes check before parsing)"""
+    return SLIDE_CANDIDATE_REGEX.search(XML_TAG_REGEX.sub(b'', slide_xml)) is not None
+
+A_NS = 'http://schemas.openxmlformats.org/drawingml/2006/main'
+PKG_REL_NS = 'http://schemas.openxmlformats.org/package/2006/relationships'
+RT_HYPERLINK = 'http://schemas.openxmlformats.org/officeDocument/2006/relationships/hyperlink'
+SHAPE_TAGS = {f'{{{PML_NS}}}{tag}' for tag in ('sp', 'grpSp', 'graphicFrame', 'cxnSp', 'pic', 'contentPart')}
+
+def _paragraph_text(paragraph):
+    """Text of an a:p element: runs and fields contribute their text, line breaks a vertical tab"""
+    parts = []
+    for child in paragraph:
+        if child.tag == f'{{{A_NS}}}br':
+            parts.append('\v')
+        elif child.tag in (f'{{{A_NS}}}r', f'{{{A_NS}}}fld'):
+            t = child.find(f'{{{A_NS}}}t')
+            if t is not None and t.text:
+                parts.append(t.text)
+    return ''.join(parts)
+
+def _get_or_add_hyperlink_rel(rels_root, url):
+    """Return the rId of the external hyperlink relationship to url, adding it if needed"""
+    for rel in rels_root:
+        if rel.get('Type') == RT_HYPERLINK and rel.get('TargetMode') == 'External' and rel.get('Target') == url:
+            return rel.get('Id')
+
+    # Same numbering as python-pptx: highest free rIdN counting down from len + 1
+    existing = {rel.get('Id') for rel in rels_root}
+    rId = next(f'rId{n}' for n in range(len(existing) + 1, 0, -1) if f'rId{n}' not in existing)
+    etree.SubElement(rels_root, f'{{{PKG_REL_NS}}}Relationship',
+                     Id=rId, Type=RT_HYPERLINK, Target=url, TargetMode='External')
+    return rId
+
+def rewrite_slide_xml(slide_xml, rels_xml, links, slide_number, rule_set='default'):
+    """
+    Replace paragraphs that mention a link with a single hyperlinked run
+
+    Args:
+        slide_xml (bytes): Slide part XML
+        rels_xml (bytes or None): The slide's relationships part XML, if any
+        links (iterable): Links to convert
+        slide_number (int): 1-based slide number, for logging
+        rule_set (str): Link rule set that gives the display text
+
+    Returns:
+        tuple: (new slide XML, new rels XML, conversions, runs touched) - XML is
+            None when nothing changed; runs touched counts the runs, breaks and
+            fields removed plus the hyperlinked runs added
+    """
+    root = etree.fromstring(slide_xml)
+    if rels_xml:
+        rels_root = etree.fromstring(rels_xml)
+    else:
+        rels_root = etree.Element(f'{{{PKG_REL_NS}}}Relationships', nsmap={None: PKG_REL_NS})
+
+    conversions_made = 0
+    runs_touched = 0
+    detail = debug_detail()
+    sp_tree = root.find(f'{{{PML_NS}}}cSld/{{{PML_NS}}}spTree')
+    shapes = [child for child in sp_tree if child.tag in SHAPE_TAGS] if sp_tree is not None else []
+
+    # Iterate through all shapes in the slide
+    for shape_idx, shape in enumerate(shapes):
+        # Only autoshapes carry a text frame
+        tx_body = shape.find(f'{{{PML_NS}}}txBody') if shape.tag == f'{{{PML_NS}}}sp' else None
+        if tx_body is None:
+            continue
+
+        # Iterate through all paragraphs in the text frame
+        for para_idx, paragraph in enumerate(tx_body.iterfind(f'{{{A_NS}}}p')):
+            matched_link = find_matching_link(_paragraph_text(paragraph), links)
+            if not matched_link:
+                continue
+
+            if detail:
+                logger.debug(f"Found link '{matched_link}' in slide {slide_number}, shape {shape_idx + 1}, paragraph {para_idx + 1}")
+
+            # Get friendly display text for the link
+            friendly_text = get_friendly_link_text(matched_link, rule_set)
+
+            # Clear existing runs, line breaks and fields (paragraph properties stay)
+            for child in list(paragraph):
+                if child.tag in (f'{{{A_NS}}}r', f'{{{A_NS}}}br', f'{{{A_NS}}}fld'):
+                    paragraph.remove(child)
+                    runs_touched += 1
+
+            # Add new run with hyperlink using friendly text, before a:endParaRPr
+            run = etree.SubElement(paragraph, f'{{{A_NS}}}r')
+            run_props = etree.SubElement(run, f'{{{A_NS}}}rPr')
+            etree.SubElement(run_props, f'{{{A_NS}}}hlinkClick',
+                             {f'{{{REL_NS}}}id': _get_or_add_hyperlink_rel(rels_root, matched_link)})
+            etree.SubElement(run, f'{{{A_NS}}}t').text = friendly_text
+            end_props = paragraph.find(f'{{{A_NS}}}endParaRPr')
+            if end_props is not None:
+                end_props.addprevious(run)
+
+            if detail:
+                logger.debug(f"Converted '{matched_link}' to display text '{friendly_text}'")
+            conversions_made += 1
+            runs_touched += 1
+
+    if not conversions_made:
+        return None, None, 0, 0
+    return (etree.tostring(root, xml_declaration=True, encoding='UTF-8', standalone=True),
+            etree.tostring(rels_root, xml_declaration=True, encoding='UTF-8', standalone=True),
+            conversions_made, runs_touched)
+
+def _rewrite_slide_job(job):
+    """
+    rewrite_slide_xml() on one (slide_xml, rels_xml, links, slide_number, rule_set) tuple, for map_parts()
 
-    Returns:
-        set: Set of unique links found in the PPTX file
+    Returns the result with the wall clock start and end (ns) and the pid it
+    ran in, so the caller can record a span for slides rewritten in the pool.
     """
-    links = set()
+    start_ns = time.time_ns()
+    result = rewrite_slide_xml(*job)
+    return result, start_ns, time.time_ns(), os.getpid()
 
-    # Improved link patterns with better performance
-    # Optimized patterns with pre-compilation - fixed to handle complex URLs
-    media_extensions = 'mp3|mp4|wav|avi|mov|wmv|flv|ogg|webm'
-    media_pattern = fr'https?://[^\s\)\(\（\）]+\.(?:{media_extensions})'
+# Bump whenever rewrite_slide_xml() output changes, so cached slide rewrites are not reused
+SLIDE_REWRITE_VERSION = 1
 
-    # Game link pattern (optimized) - supports both formats:
-    # 1. index.html?data_url=*.json
-    # 2. index.html?data_url=*.json&studentId=*
-    # Simplified to handle complex URLs with encoding
-    game_pattern = r'https?://[^\s]+/index\.html\?data_url=https?://[^\s&]+\.json(?:&[^\s]*)?'
+# Per-slide rewrite results keyed by a digest of the slide and rels XML plus the
+# link list and rule set. An edited deck resubmitted only re-parses the slides
+# that changed; the slide number is only used for logging so it is not part of the key.
+# Only rewritten slides keep their XML, and the cache is bounded by the size of that
+# XML; slides without conversions share the SLIDE_UNCHANGED marker.
+SLIDE_UNCHANGED = (None, None, 0, 0)
 
-    # Pre-compile regex patterns for better performance
-    media_regex = re.compile(media_pattern, re.IGNORECASE)
-    game_regex = re.compile(game_pattern, re.IGNORECASE)
+def _slide_rewrite_size(result):
+    return len(result[0] or b'') + len(result[1] or b'')
 
-    try:
-        # Extract PPTX file (which is essentially a ZIP file)
-        with tempfile.TemporaryDirectory() as temp_dir:
-            with zipfile.ZipFile(pptx_path, 'r') as zip_file:
-                zip_file.extractall(temp_dir)
-
-            # Walk through all files in the extracted directory
-            for root, dirs, files in os.walk(temp_dir):
-                for file in files:
-                    if file.endswith('.xml') or file.endswith('.rels'):
-                        file_path = os.path.join(root, file)
-                        try:
-                            with open(file_path, 'r', encoding='utf-8', errors='ignore') as f:
-                                content = f.read()
-
-                                # Find media links (improved performance with compiled regex)
-                                media_matches = media_regex.findall(content)
-                                links.update(media_matches)
-
-                                # Find game links (compiled regex)
-                                game_matches = game_regex.findall(content)
-                                links.update(game_matches)
-
-                        except Exception as e:
-                            logger.warning(f"Error reading file {file_path}: {str(e)}")
-                            continue
+slide_rewrite_cache = LRUCache(SLIDE_REWRITE_CACHE_SIZE, SLIDE_REWRITE_CACHE_BYTES, _slide_rewrite_size)
 
-    except Exception as e:
-        logger.error(f"Error extracting links from PPTX: {str(e)}")
-        raise
+def _slide_rewrite_key(slide_xml, rels_xml, links_key, rule_set):
+    digest = hashlib.blake2b(slide_xml, digest_size=16)
+    digest.update(b'\0' + (rels_xml or b''))
+    return (digest.hexdigest(), links_key, rule_set, LINK_RULES_VERSION, SLIDE_REWRITE_VERSION)
 
-    # Clean up links by removing XML tags and entities
-    cleaned_links = set()
-    for link in links:
-        # Remove XML tags and entities
-        cleaned_link = re.sub(r'<[^>]*>', '', link)  # Remove XML tags
-        cleaned_link = re.sub(r'&amp;', '&', cleaned_link)  # Replace &amp; with &
-        cleaned_link = cleaned_link.strip()
-        if cleaned_link.startswith('http'):
-            cleaned_links.add(cleaned_link)
+# Output compression profiles:
+# - default: keep each part's original compression, at zlib's default level
+# - store_media: store already-compressed media (deflating it again gains nothing), deflate the rest
+# - fast: store media, deflate the rest at level 1 - lowest latency, e.g. for LAN consumers
+# - max: deflate everything at level 9 - smallest files, e.g. to save COS egress
+COMPRESSION_PROFILES = ('default', 'store_media', 'fast', 'max')
+COMPRESSED_MEDIA_EXTENSIONS = {
+    '.png', '.jpg', '.jpeg', '.jfif', '.gif', '.wdp', '.mp3', '.m4a', '.wma', '.ogg',
+    '.mp4', '.m4v', '.mov', '.wmv', '.avi', '.webm', '.zip'
+}
 
-    return cleaned_links
+def get_compression_profile(value):
+    """Validate the requested output compression profile, defaulting to OUTPUT_COMPRESSION"""
+    profile = value or OUTPUT_COMPRESSION
+    if profile not in COMPRESSION_PROFILES:
+        raise BadRequest(f"Invalid 'compression': {profile} (expected one of: {', '.join(COMPRESSION_PROFILES)})")
+    return profile
 
-def get_friendly_link_text(link):
+def _part_compression(part_name, source_compress_type, profile):
+    """Return (compress_type, compresslevel) for one output part under a compression profile"""
+    if profile == 'max':
+        return zipfile.ZIP_DEFLATED, 9
+    if profile == 'default':
+        return source_compress_type, None
+    if posixpath.splitext(part_name)[1].lower() in COMPRESSED_MEDIA_EXTENSIONS:
+        return zipfile.ZIP_STORED, None
+    return zipfile.ZIP_DEFLATED, 1 if profile == 'fast' else None
+
+def write_pptx_package(zip_in, output_path, replaced_parts, compression='default'):
     """
-    Convert a link URL to friendly display text
+    Write a copy of an open PPTX package with some parts replaced
+
+    Untouched parts are copied through unchanged, in their original order.
 
     Args:
-        link (str): The original link URL
+        zip_in (ZipFile): Source package
+        output_path (str or file): Path or writable file object for the output
+        replaced_parts (dict): {part name: new bytes}; names not in the source are appended
+        compression (str): Output compression profile, see COMPRESSION_PROFILES
 
     Returns:
-        str: Friendly display text like "点击音频", "点击视频", "点击游戏"
+        int: Size of the written package in bytes
     """
-    link_lower = link.lower()
-
-    # Check for game links first (more specific pattern)
-    # Support both formats: index.html?data_url=*.json and index.html?data_url=*.json&studentId=*
-    if 'index.html?data_url=' in link_lower and '.json' in link_lower:
-        return "点击游戏"
-
-    # Check for audio files
-    audio_extensions = ['.mp3', '.wav', '.ogg']
-    if any(ext in link_lower for ext in audio_extensions):
-        return "点击音频"
-
-    # Check for video files
-    video_extensions = ['.mp4', '.avi', '.mov', '.wmv', '.flv', '.webm']
-    if any(ext in link_lower for ext in video_extensions):
-        return "点击视频"
+    replaced_parts = dict(replaced_parts)
+    with zipfile.ZipFile(output_path, 'w', zipfile.ZIP_DEFLATED) as zip_out:
+        for info in zip_in.infolist():
+            data = replaced_parts.pop(info.filename, None)
+            if data is None:
+                data = zip_in.read(info.filename)
+            out_info = zipfile.ZipInfo(info.filename, date_time=info.date_time)
+            out_info.compress_type, compresslevel = _part_compression(info.filename, info.compress_type, compression)
+            out_info.external_attr = info.external_attr
+            zip_out.writestr(out_info, data, compresslevel=compresslevel)
+        for part_name, data in replaced_parts.items():
+            compress_type, compresslevel = _part_compression(part_name, zipfile.ZIP_DEFLATED, compression)
+            zip_out.writestr(part_name, data, compress_type=compress_type, compresslevel=compresslevel)
 
-    # Default fallback - shouldn't happen with current regex patterns
-    return "点击链接"
+    if isinstance(output_path, str):
+        return os.path.getsize(output_path)
+    return output_path.tell()
 
 @with_timeout(15)  # 15 seconds timeout for hyperlink addition
-def add_hyperlinks_to_pptx(pptx_path, links, output_path):
+def add_hyperlinks_to_pptx(pptx_path, links, output_path, rule_set='default', compression='default',
+                           skip_if_unchanged=False):
     """
     Add hyperlinks to text in PPTX file that matches the extracted links
 
+    Works on the package directly: each slide part's raw bytes are checked
+    for link-like text first, only matching slides are parsed and rewritten,
+    and every other part is copied to the output unchanged. When at least
+    PARALLEL_MIN_PARTS slides match, they are rewritten on the part process
+    pool and the results reassembled here. Slides rewritten before with the
+    same links and rule set are taken from slide_rewrite_cache.
+
     Args:
-        pptx_path (str): Path to the input PPTX file
+        pptx_path (str or file): Path to the input PPTX file, or a seekable file object
         links (set): Set of links to convert to hyperlinks
-        output_path (str): Path for the output PPTX file
+        output_path (str or file): Path or writable file object for the output PPTX file
+        rule_set (str): Link rule set that gives the display text of each link
+        compression (str): Output compression profile, see COMPRESSION_PROFILES
+        skip_if_unchanged (bool): Do not write output_path at all when no
+            paragraph was converted (the output would equal the input)
+
+    Returns:
+        dict: conversions, slides_total, slides_parsed, slides_reused
+            (candidate slides taken from the rewrite cache), parallel
+            (whether the slides were rewritten on the part process pool),
+            save_time, output_size (None when the save was skipped) and unchanged
     """
     try:
-        # Load the presentation
-        prs = Presentation(pptx_path)
-
-        # Track conversions for logging
-        conversions_made = 0
-
-        # Iterate through all slides
-        for slide_idx, slide in enumerate(prs.slides):
-            # Iterate through all shapes in the slide
-            for shape_idx, shape in enumerate(slide.shapes):
-                # Check if shape has text frame
-                if hasattr(shape, 'text_frame') and shape.has_text_frame:
-                    # Iterate through all paragraphs in the text frame
-                    for para_idx, paragraph in enumerate(shape.text_frame.paragraphs):
-                        paragraph_text = paragraph.text
-
-                        # Improved link matching - check if paragraph contains link-like content
-                        paragraph_lower = paragraph_text.lower()
-                        matched_link = None
-
-                        # Try exact match first
-                        for link in links:
-                            if link.lower() in paragraph_lower:
-                                matched_link = link
-                                break
-
-                        # If no exact match, try partial matching for links
-                        if not matched_link:
-                            for link in links:
-                                # Extract domain and key parts for matching
-                                if 'index.html' in link and 'index.html' in paragraph_lower:
-                                    # For game links, match by domain and index.html
-                                    link_domain = link.split('/')[2] if '://' in link else ''
-                                    if link_domain and link_domain in paragraph_lower:
-                                        matched_link = link
-                                        break
-                                elif any(ext in link for ext in ['.mp4', '.mp3', '.wav']) and any(ext in paragraph_lower for ext in ['.mp4', '.mp3', '.wav']):
-                                    # For media links, match by domain and extension
-                                    link_domain = link.split('/')[2] if '://' in link else ''
-                                    if link_domain and link_domain in paragraph_lower:
-                                        matched_link = link
-                                        break
-
-                        if matched_link:
-                            logger.info(f"Found link '{matched_link}' in slide {slide_idx + 1}, shape {shape_idx + 1}, paragraph {para_idx + 1}")
-
-                            # Get friendly display text for the link
-                            friendly_text = get_friendly_link_text(matched_link)
-
-                            # Clear existing runs
-                            paragraph.clear()
-
-                            # Add new run with hyperlink using friendly text
-                            run = paragraph.add_run()
-                            run.text = friendly_text
-                            run.hyperlink.address = matched_link
-
-                            logger.info(f"Converted '{matched_link}' to display text '{friendly_text}'")
-                            conversions_made += 1
-
-        # Save the modified presentation
-        prs.save(output_path)
-        logger.info(f"Successfully processed PPTX file. Made {conversions_made} hyperlink conversions.")
+        with zipfile.ZipFile(pptx_path, 'r') as zip_in:
+            slide_parts = _slide_parts_in_order(zip_in)
+            replaced_parts = {}
+
+            # Track conversions for logging
+            conversions_made = 0
+
+            # Links go to the workers as a list: a set would iterate in a different
+            # order there (per-process string hashing) and could pick another match.
+            # Supplied links keep the caller's order; extracted links are a set, so
+            # sort them, or the cache keys and the output bytes would change with
+            # the hash seed of each worker and restart
+            link_order = list(links) if isinstance(links, (list, tuple)) else sorted(links)
+            links_key = _links_key(link_order)
+
+            # Collect the slides with candidate text, skipping all others
+            jobs = []
+            job_parts = []
+            job_keys = []
+            slides_reused = 0
+            for slide_idx, slide_part in enumerate(slide_parts):
+                if not slide_part:
+                    continue
+                slide_xml = zip_in.read(slide_part)
+                if not _is_candidate_slide(slide_xml):
+                    continue
+
+                rels_part = _rels_name_for(slide_part)
+                try:
+                    rels_xml = zip_in.read(rels_part)
+                except KeyError:
+                    rels_xml = None
+
+                cache_key = _slide_rewrite_key(slide_xml, rels_xml, links_key, rule_set)
+                cached = slide_rewrite_cache.get(cache_key)
+                if cached is not None:
+                    slides_reused += 1
+                    new_slide_xml, new_rels_xml, conversions, runs_touched = cached
+                    if conversions:
+                        replaced_parts[slide_part] = new_slide_xml
+                        replaced_parts[rels_part] = new_rels_xml
+                        conversions_made += conversions
+                    continue
+
+                jobs.append((slide_xml, rels_xml, link_order, slide_idx + 1, rule_set))
+                job_parts.append((slide_part, rels_part))
+                job_keys.append(cache_key)
+
+            # Each slide has its own relationships part, so new rIds never
+            # collide and slides can be rewritten independently
+            results, parallel = map_parts(_rewrite_slide_job, jobs)
+            slides_parsed = len(jobs)
+            count_resource('xml_parts_parsed', sum(1 + bool(job[1]) for job in jobs))
+            for job, (slide_part, rels_part), cache_key, (result, start_ns, end_ns, pid) in zip(
+                    jobs, job_parts, job_keys, results):
+                new_slide_xml, new_rels_xml, conversions, runs_touched = result
+                slide_rewrite_cache.put(cache_key, result if conversions else SLIDE_UNCHANGED)
+                count_resource('runs_touched', runs_touched)
+                record_span('rewrite_slide', start_ns, end_ns, slide_number=job[3], slide_xml_bytes=len(job[0]),
+                            conversions=conversions, runs_touched=runs_touched,
+                            **({'process.pid': pid} if parallel else {}))
+                if conversions:
+                    replaced_parts[slide_part] = new_slide_xml
+                    replaced_parts[rels_part] = new_rels_xml
+                    conversions_made += conversions
+
+            # Save the modified presentation
+            save_start = time.time()
+            output_size = None
+            if conversions_made or not skip_if_unchanged:
+                with trace_span('save', compression=compression, parts_replaced=len(replaced_parts)) as span:
+                    output_size = write_pptx_package(zip_in, output_path, replaced_parts, compression)
+                    span.set_attribute('bytes', output_size)
+            save_time = time.time() - save_start
+
+        logger.info(f"Successfully processed PPTX file. Made {conversions_made} hyperlink conversions "
+                    f"({slides_parsed}/{len(slide_parts)} slides parsed, {slides_reused} reused"
+                    f"{', in parallel' if parallel else ''}).")
+        return {
+            "conversions": conversions_made,
+            "slides_total": len(slide_parts),
+            "slides_parsed": slides_parsed,
+            "slides_reused": slides_reused,
+            "parallel": parallel,
+            "save_time": save_time,
+            "output_size": output_size,
+            "unchanged": not conversions_made
+        }
 
     except Exception as e:
         logger.error(f"Error adding hyperlinks to PPTX: {str(e)}")
@@ -316,7 +3108,7 @@ def add_hyperlinks_to_pptx(pptx_path, links, output_path):
 
 def validate_cos_config():
     """Validate COS configuration"""
-    if not cos_client:
+    if not get_cos_client():
         raise RuntimeError("COS client not initialized")
 
     if not all([COS_SECRET_ID, COS_SECRET_KEY, COS_REGION, COS_BUCKET]):
@@ -332,7 +3124,7 @@ def upload_to_cos(file_path, cos_key, max_retries=MAX_RETRIES):
     Upload file to Tencent Cloud COS
 
     Args:
-        file_path (str): Local file path
+        file_path (str or file): Local file path, or a seekable file object
         cos_key (str): Key (path) in COS bucket
 
     Returns:
@@ -345,24 +3137,28 @@ def upload_to_cos(file_path, cos_key, max_retries=MAX_RETRIES):
             logger.info(f"Uploading to COS (attempt {attempt + 1}/{max_retries})")
 
             # Check file exists and size
-            if not os.path.exists(file_path):
+            if isinstance(file_path, str) and not os.path.exists(file_path):
                 raise FileNotFoundError(f"File not found: {file_path}")
 
-            file_size = os.path.getsize(file_path)
+            file_size = _source_size(file_path)
             if file_size > MAX_FILE_SIZE:
                 raise ValueError(f"File too large for upload: {file_size} bytes")
 
             # Upload file to COS
-            with open(file_path, 'rb') as file_data:
-                cos_client.put_object(
+            _rewind(file_path)
+            with trace_span('upload.attempt', SPAN_KIND_CLIENT, attempt=attempt + 1, bytes=file_size), \
+                    (open(file_path, 'rb') if isinstance(file_path, str) else contextlib.nullcontext(file_path)) as file_data:
+                get_cos_client().put_object(
                     Bucket=COS_BUCKET,
                     Body=file_data,
                     Key=cos_key,
                     StorageClass='STANDARD'
                 )
 
+            count_resource('net_upload_bytes', file_size)
+
             # Construct download URL
-            download_url = f"https://{COS_BUCKET}.cos.{COS_REGION}.myqcloud.com/{cos_key}"
+            download_url = _cos_url(cos_key)
             logger.info(f"File uploaded to COS successfully: {download_url}")
 
             return download_url
@@ -374,6 +3170,524 @@ def upload_to_cos(file_path, cos_key, max_retries=MAX_RETRIES):
                 raise
             time.sleep(RETRY_DELAY * (attempt + 1))
 
+def _cos_url(cos_key):
+    """Public download URL of an object in COS_BUCKET"""
+    return f"https://{COS_BUCKET}.cos.{COS_REGION}.myqcloud.com/{cos_key}"
+
+def cos_object_exists(cos_key):
+    """HEAD an object in COS; errors count as 'not there' so the caller simply uploads"""
+    try:
+        with trace_span('cos.head_object', SPAN_KIND_CLIENT, key=cos_key) as span:
+            exists = bool(get_cos_client().object_exists(Bucket=COS_BUCKET, Key=cos_key))
+            span.set_attribute('exists', exists)
+            return exists
+    except Exception as e:
+        logger.warning(f"COS existence check failed for {cos_key}: {str(e)}")
+        return False
+
+def upload_content_addressed(file_path, content_hash=None, max_retries=MAX_RETRIES):
+    """
+    Upload a PPTX to COS under a key derived from its SHA-256
+
+    Identical files always map to the same object, so concurrent requests
+    cannot overwrite each other's output, and the PUT is skipped entirely
+    when a HEAD shows the object is already there.
+
+    Args:
+        file_path (str or file): Local file path, or a seekable file object
+        content_hash (str): SHA-256 hex digest of the file, if already known
+        max_retries (int): Upload attempts, see upload_to_cos()
+
+    Returns:
+        tuple: (COS download URL, True if the object already existed, content hash)
+    """
+    validate_cos_config()
+
+    if content_hash is None:
+        if isinstance(file_path, str):
+            with open(file_path, 'rb') as file_data:
+                content_hash = _hash_stream(file_data)
+        else:
+            content_hash = _hash_stream(file_path)
+
+    cos_key = f"processed_pptx/{content_hash}.pptx"
+    if cos_object_exists(cos_key):
+        download_url = _cos_url(cos_key)
+        logger.info(f"Identical file already in COS, skipping upload: {download_url}")
+        return download_url, True, content_hash
+    return upload_to_cos(file_path, cos_key, max_retries), False, content_hash
+
+def _hash_stream(stream, chunk_size=65536):
+    """SHA-256 of a seekable stream's contents, leaving it rewound"""
+    digest = hashlib.sha256()
+    stream.seek(0)
+    for chunk in iter(lambda: stream.read(chunk_size), b''):
+        digest.update(chunk)
+    stream.seek(0)
+    return digest.hexdigest()
+
+def _rewind(pptx_source):
+    """Seek file-like PPTX sources back to the start before the next stage reads them"""
+    if hasattr(pptx_source, 'seek'):
+        pptx_source.seek(0)
+
+def get_response_mode(value):
+    """Validate the requested response mode, defaulting to 'url'"""
+    mode = value or 'url'
+    if mode not in RESPONSE_MODES:
+        raise BadRequest(f"Invalid 'response_mode': {mode} (expected one of: {', '.join(RESPONSE_MODES)})")
+    return mode
+
+def run_preflight(pptx_source):
+    """preflight_pptx() as the 'preflight' stage; returns (preflight summary, seconds spent)"""
+    preflight_start = time.time()
+    with pipeline_stage('preflight') as span:
+        preflight = preflight_pptx(pptx_source)
+        span.set_attributes(decision=preflight["decision"], bytes=preflight["file_size"],
+                            slide_count=preflight["slide_count"], member_count=preflight["member_count"],
+                            total_uncompressed=preflight["total_uncompressed"],
+                            estimated_memory=preflight["estimated_memory"])
+    return preflight, time.time() - preflight_start
+
+def admit_job(admission, preflight):
+    """
+    Admit a job on its preflight summary: through the heavy-job lane first if
+    preflight routed it there, then admission_controller with its estimated
+    memory. Both slots are held until the admission ExitStack closes.
+
+    Returns:
+        float: Seconds spent waiting for the slots
+    """
+    heavy_wait_time = 0.0
+    with trace_span('admission', heavy=preflight["decision"] == 'heavy') as span:
+        if preflight["decision"] == 'heavy':
+            logger.info(f"Routing to heavy-job lane: {preflight['reason']}")
+            heavy_wait_time = admission.enter_context(heavy_lane_controller.admit(0))
+        queue_wait_time = heavy_wait_time + admission.enter_context(
+            admission_controller.admit(preflight["estimated_memory"]))
+        span.set_attribute('queue_wait_time', round(queue_wait_time, 3))
+    return queue_wait_time
+
+def run_hyperlink_pipeline(pptx_source, temp_dir, start_time, download_time=0.0, response_mode='url',
+                           scan_scope='all', rule_set='default', validate_links=False,
+                           supplied_links=None, link_source='extracted', compression='default',
+                           source_url=None, source_hash=None, queue_wait_time=None):
+    """
+    Run the extract, hyperlink and upload stages on a PPTX that is already local
+
+    The package is preflighted from its zip central directory first, and
+    rejected (PreflightRejected) if it would expand beyond our limits. It
+    is then admitted by admission_controller based on its estimated memory
+    cost, after first passing the heavy-job lane if preflight routed it there.
+    It may queue or be rejected with AdmissionRejected. Callers that admitted
+    the job before downloading it (on the remote preflight) pass their
+    queue_wait_time, and the job is not admitted a second time.
+
+    When no paragraph is converted the output would equal the input, so
+    nothing is saved or uploaded: the payload is flagged "unchanged" and
+    points at the source itself (source_url, or the source uploaded once
+    per source_hash, or the original bytes for inline responses).
+
+    Args:
+        pptx_source (str or file): Path to the PPTX file, or a seekable file object
+        temp_dir (str): Working directory for the output file
+        start_time (float): Request start time, used for total timing
+        download_time (float): Time spent fetching the source, reported in performance
+        response_mode (str): 'url' uploads the result to COS; 'inline' keeps it
+            in memory so it can be returned in the response body
+        scan_scope (str or tuple): Parts to scan for links, see get_scan_scope()
+        rule_set (str): Link rule set for the display text, see get_rule_set()
+        validate_links (bool): Check that the links found are reachable, while
+            the deck is being rewritten, and report per-link status
+        supplied_links (list): Links given by the caller (see get_supplied_links());
+            when set, the extraction stage is skipped
+        link_source (str): Where supplied_links came from, reported in the payload
+        compression (str): Output compression profile, see get_compression_profile()
+        source_url (str): Where the source PPTX was downloaded from, if anywhere
+        source_hash (str): SHA-256 of the source PPTX, if already known
+        queue_wait_time (float): Admission wait if the caller holds the admission
+            slots already, else None
+
+    Returns:
+        tuple: (response payload dict, HTTP status code, output buffer or None)
+    """
+    preflight, preflight_time = run_preflight(pptx_source)
+
+    with contextlib.ExitStack() as admission:
+        if queue_wait_time is None:
+            queue_wait_time = admit_job(admission, preflight)
+        payload, status, output_buffer = _run_pipeline_stages(
+            pptx_source, temp_dir, start_time, download_time, response_mode, queue_wait_time, scan_scope, rule_set,
+            validate_links, supplied_links, compression, source_url, source_hash)
+
+    if "performance" in payload:
+        payload["performance"]["preflight_time"] = round(preflight_time, 3)
+    payload["preflight"] = {key: preflight[key] for key in (
+        "decision", "slide_count", "member_count", "total_uncompressed", "compression_ratio", "media_share")}
+    payload["scan_scope"] = _scope_key(scan_scope)
+    payload["link_source"] = link_source
+    return payload, status, output_buffer
+
+def _run_pipeline_stages(pptx_source, temp_dir, start_time, download_time, response_mode, queue_wait_time,
+                         scan_scope, rule_set, validate_links, supplied_links, compression, source_url, source_hash):
+    """Extract, hyperlink and upload/return stages of run_hyperlink_pipeline, run once admitted"""
+    if supplied_links is not None:
+        # The caller already knows the deck's links: no extraction stage
+        links = supplied_links
+        extract_time = 0.0
+        logger.info(f"Using {len(links)} caller-supplied links")
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(f"Caller-supplied links: {links}")
+        if not links:
+            return {
+                "success": False,
+                "message": "No media or game links in the supplied links"
+            }, 400, None
+    else:
+        # Extract links from PPTX
+        logger.info("Extracting links from PPTX...")
+        extract_start = time.time()
+        _rewind(pptx_source)
+        with pipeline_stage('extract', scan_scope=_scope_key(scan_scope)) as span:
+            links = extract_links_from_pptx(pptx_source, scan_scope)
+            span.set_attribute('links_found', len(links))
+        extract_time = time.time() - extract_start
+        logger.info(f"Found {len(links)} links in {extract_time:.2f}s")
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(f"Links found: {list(links)}")
+
+        if not links:
+            logger.warning("No links found in PPTX file")
+            return {
+                "success": False,
+                "message": "No media or game links found in the PPTX file"
+            }, 400, None
+
+    # Reachability checks run in the background while the deck is rewritten and uploaded
+    link_checks = start_link_checks(links) if validate_links else None
+
+    # Add hyperlinks to PPTX
+    logger.info("Adding hyperlinks to PPTX...")
+    hyperlink_start = time.time()
+    if response_mode == 'inline':
+        # Save straight into memory; the buffer becomes the response body
+        output_pptx = io.BytesIO()
+    else:
+        output_pptx = os.path.join(temp_dir, "output.pptx")
+    _rewind(pptx_source)
+    with pipeline_stage('hyperlink', links=len(links), rule_set=rule_set) as span:
+        rewrite_stats = add_hyperlinks_to_pptx(pptx_source, links, output_pptx, rule_set, compression,
+                                               skip_if_unchanged=True)
+        span.set_attributes(**{key: rewrite_stats[key] for key in (
+            "conversions", "slides_total", "slides_parsed", "slides_reused", "parallel", "unchanged")})
+    hyperlink_time = time.time() - hyperlink_start
+    unchanged = rewrite_stats["unchanged"]
+    if unchanged:
+        logger.info(f"No paragraphs converted in {hyperlink_time:.2f}s, skipping save and upload")
+    else:
+        logger.info(f"Added hyperlinks in {hyperlink_time:.2f}s")
+
+    # Generate unique filename for COS
+    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+    output_filename = f"hyperlink_converted_{timestamp}.pptx"
+
+    performance = {
+        "download_time": round(download_time, 2),
+        "queue_wait_time": round(queue_wait_time, 2),
+        "extract_time": round(extract_time, 2),
+        "hyperlink_time": round(hyperlink_time, 2),
+        "slides_parsed": rewrite_stats["slides_parsed"],
+        "slides_reused": rewrite_stats["slides_reused"],
+        "slides_total": rewrite_stats["slides_total"],
+        "parallel_rewrite": rewrite_stats["parallel"],
+        "compression": compression,
+        "save_time": round(rewrite_stats["save_time"], 2),
+        "output_size": rewrite_stats["output_size"]
+    }
+
+    if response_mode == 'inline':
+        if unchanged:
+            # The "output" is the source deck itself
+            output_pptx = _source_buffer(pptx_source)
+        link_status, link_check_wait_time = _finish_link_checks(link_checks)
+        total_time = time.time() - start_time
+        logger.info(f"Returning processed PPTX inline ({output_pptx.getbuffer().nbytes} bytes)")
+        logger.info(f"Total processing time: {total_time:.2f}s")
+        performance["total_time"] = round(total_time, 2)
+        return _with_link_status({
+            "success": True,
+            "filename": output_filename,
+            "links_found": list(links),
+            "links_converted": 0 if unchanged else len(links),
+            "unchanged": unchanged,
+            "processing_time": round(total_time, 2),
+            "performance": performance
+        }, link_status, link_check_wait_time), 200, output_pptx
+
+    upload_start = time.time()
+    local_url = None
+    with pipeline_stage('upload', unchanged=unchanged) as span:
+        if unchanged:
+            download_url, upload_skipped = _unchanged_source_url(pptx_source, source_url, source_hash)
+        else:
+            # Upload to COS
+            logger.info("Uploading processed PPTX to COS...")
+            download_url, upload_skipped, output_hash = upload_content_addressed(output_pptx)
+            logger.info(f"Uploaded to COS in {time.time() - upload_start:.2f}s")
+
+            # Keep a local copy for consumers that can fetch it from us (GET /files/<key>)
+            if output_cache.put(f"{output_hash}.pptx", output_pptx):
+                local_url = f"/files/{output_hash}.pptx"
+        span.set_attribute('skipped', upload_skipped)
+    upload_time = time.time() - upload_start
+    link_status, link_check_wait_time = _finish_link_checks(link_checks)
+    total_time = time.time() - start_time
+    logger.info(f"Total processing time: {total_time:.2f}s")
+    performance["upload_time"] = round(upload_time, 2)
+    performance["upload_skipped"] = upload_skipped
+    performance["total_time"] = round(total_time, 2)
+
+    return _with_link_status({
+        "success": True,
+        "message": ("No hyperlinks needed adding; returning the original PPTX" if unchanged
+                    else "PPTX file processed successfully"),
+        "download_url": download_url,
+        "local_url": local_url,
+        "links_found": list(links),
+        "links_converted": 0 if unchanged else len(links),
+        "unchanged": unchanged,
+        "processing_time": round(total_time, 2),
+        "performance": performance
+    }, link_status, link_check_wait_time), 200, None
+
+# Sources that came back unchanged and had to be uploaded: content hash -> COS URL
+unchanged_upload_cache = LRUCache(UNCHANGED_UPLOAD_CACHE_SIZE)
+
+def _unchanged_source_url(pptx_source, source_url, source_hash):
+    """
+    Download URL for a deck the rewrite left unchanged, and whether no PUT was needed
+
+    The source URL is returned as-is when there is one. Uploaded decks have
+    no URL of their own, so they are stored content-addressed and the COS
+    URL is reused for later submissions with the same content hash.
+    """
+    if source_url:
+        return source_url, True
+
+    if source_hash:
+        cached_url = unchanged_upload_cache.get(source_hash)
+        if cached_url is not None:
+            logger.info(f"Unchanged upload already in COS: {cached_url}")
+            return cached_url, True
+
+    logger.info("Uploading unchanged source PPTX to COS...")
+    download_url, upload_skipped, source_hash = upload_content_addressed(pptx_source, source_hash)
+    if source_hash:
+        unchanged_upload_cache.put(source_hash, download_url)
+    return download_url, upload_skipped
+
+def _source_buffer(pptx_source):
+    """Copy a PPTX path or file object into a BytesIO for an inline response"""
+    if not hasattr(pptx_source, 'read'):
+        with open(pptx_source, 'rb') as source_file:
+            return io.BytesIO(source_file.read())
+    _rewind(pptx_source)
+    buffer = io.BytesIO()
+    shutil.copyfileobj(pptx_source, buffer)
+    return buffer
+
+def run_metered(endpoint, source, process):
+    """
+    Run a request's pipeline under a new ResourceMeter and the root span of a new trace
+
+    Adds the per-stage usage to performance.resources and logs it as one
+    JSON record per request (also when the pipeline raises), so expensive
+    decks can be found from the logs. The trace id is returned in
+    performance.trace_id and the log record, to look the trace up in
+    TRACE_FILE or GET /admin/traces.
+
+    Args:
+        endpoint (str): Route name for the log record
+        source (str): Source URL, or 'sha256:<hash>' for uploads
+        process (callable): Returns (payload, status, output buffer or None)
+
+    Returns:
+        tuple: process()'s result
+    """
+    meter = ResourceMeter(endpoint, source)
+    root_span = trace_collector.start_trace(endpoint, {"source": source})
+    record = {"event": "request_resources", "endpoint": endpoint, "source": source, "trace_id": root_span.trace_id}
+    inflight_jobs.register(meter)
+    inflight_jobs.thread_started(meter, 'request')
+    try:
+        with meter.activate(), activate_span(root_span):
+            payload, status, output_buffer = process()
+    except Exception as e:
+        record.update(status=None, error=type(e).__name__, resources=meter.summary())
+        logger.info("request_resources", extra={"fields": record})
+        root_span.record_exception(e)
+        root_span.end()
+        raise
+    finally:
+        inflight_jobs.finish(meter)
+
+    resources = meter.summary()
+    if "performance" in payload:
+        payload["performance"]["resources"] = resources
+        payload["performance"]["trace_id"] = root_span.trace_id
+    root_span.set_attributes(**{'http.response.status_code': status,
+                                'links_found': len(payload.get("links_found", [])),
+                                'links_converted': payload.get("links_converted", 0)})
+    root_span.end()
+    record.update(
+        status=status,
+        slides_total=payload.get("preflight", {}).get("slide_count"),
+        links_found=len(payload.get("links_found", [])),
+        links_converted=payload.get("links_converted", 0),
+        total_time=payload.get("processing_time"),
+        resources=resources)
+    logger.info("request_resources", extra={"fields": record})
+    return payload, status, output_buffer
+
+def _finish_link_checks(link_checks):
+    """Collect checks started by start_link_checks(); returns (link status list or None, seconds waited)"""
+    if link_checks is None:
+        return None, 0.0
+    wait_start = time.time()
+    with pipeline_stage('link_checks', links=len(link_checks["targets"])) as span:
+        link_status = collect_link_checks(link_checks)
+        span.set_attribute('unreachable', sum(status["reachable"] is False for status in link_status))
+    unreachable = [status["url"] for status in link_status if status["reachable"] is False]
+    if unreachable:
+        logger.warning(f"{len(unreachable)} of {len(link_status)} links are not reachable: {unreachable}")
+    return link_status, time.time() - wait_start
+
+def _with_link_status(payload, link_status, link_check_wait_time):
+    """Add per-link reachability to a pipeline payload when links were validated"""
+    if link_status is not None:
+        payload["link_status"] = link_status
+        payload["performance"]["link_check_wait_time"] = round(link_check_wait_time, 2)
+    return payload
+
+def _stream_buffer(buffer, chunk_size=INLINE_CHUNK_SIZE):
+    """Yield the contents of an in-memory buffer in chunks without copying it whole"""
+    view = buffer.getbuffer()
+    try:
+        for offset in range(0, len(view), chunk_size):
+            yield bytes(view[offset:offset + chunk_size])
+    finally:
+        view.release()
+
+def _is_shareable_result(result):
+    """Only successful JSON results are handed to other workers"""
+    payload, status, output_buffer = result
+    return status == 200 and output_buffer is None
+
+# performance fields that describe the request which ran the pipeline (see run_metered)
+COALESCED_DROPPED_FIELDS = ('trace_id', 'resources')
+
+def build_pipeline_response(payload, status, output_buffer=None, coalesced=False):
+    """
+    Turn a pipeline result into a Flask response
+
+    JSON results are returned as-is. Inline results stream the output buffer
+    as the response body, with the summary fields carried in headers.
+    Results shared by a single-flight leader, in this worker or another, are
+    marked as coalesced and lose the leader's per-request trace_id and
+    resources: this request ran no pipeline of its own to report.
+    """
+    if coalesced:
+        payload = dict(payload, coalesced=True)
+        if "performance" in payload:
+            payload["performance"] = {key: value for key, value in payload["performance"].items()
+                                      if key not in COALESCED_DROPPED_FIELDS}
+
+    if output_buffer is None:
+        return jsonify(payload), status
+
+    size = output_buffer.getbuffer().nbytes
+    response = Response(_stream_buffer(output_buffer), status=status, mimetype=PPTX_MIMETYPE, direct_passthrough=True)
+    response.headers['Content-Length'] = str(size)
+    response.headers['Content-Disposition'] = f'attachment; filename="{payload["filename"]}"'
+    response.headers['X-Links-Converted'] = str(payload["links_converted"])
+    response.headers['X-Processing-Time'] = str(payload["processing_time"])
+    if payload.get("unchanged"):
+        response.headers['X-Unchanged'] = 'true'
+    if "link_status" in payload:
+        # Per-link details do not fit in headers; callers needing them use response_mode 'url'
+        response.headers['X-Links-Unreachable'] = str(
+            sum(1 for status in payload["link_status"] if status["reachable"] is False))
+    if coalesced:
+        response.headers['X-Coalesced'] = 'true'
+    return response
+
+def _error_response(e):
+    """Map a pipeline exception to the JSON error response returned by the API"""
+    if isinstance(e, BadRequest):
+        logger.error(f"Invalid request: {e.description}")
+        return jsonify({
+            "success": False,
+            "message": e.description,
+            "error_type": "invalid_request"
+        }), 400
+
+    if isinstance(e, RequestEntityTooLarge):
+        logger.error(f"Uploaded file rejected: {str(e)}")
+        return jsonify({
+            "success": False,
+            "message": f"File too large (max: {MAX_FILE_SIZE} bytes)",
+            "error_type": "file_too_large"
+        }), 413
+
+    if isinstance(e, AdmissionRejected):
+        logger.warning(f"Job rejected by admission control: {str(e)}")
+        response = jsonify({
+            "success": False,
+            "message": str(e),
+            "error_type": "server_busy"
+        })
+        response.headers['Retry-After'] = str(e.retry_after)
+        return response, 429
+
+    if isinstance(e, PreflightRejected):
+        logger.warning(f"File rejected by preflight: {str(e)}")
+        return jsonify({
+            "success": False,
+            "message": f"File rejected: {str(e)}",
+            "error_type": "preflight_rejected"
+        }), 422
+
+    if isinstance(e, (requests.RequestException, ValueError)):
+        logger.error(f"Error downloading PPTX file: {str(e)}")
+        return jsonify({
+            "success": False,
+            "message": f"Error downloading PPTX file: {str(e)}",
+            "error_type": "download_error"
+        }), 400
+
+    if isinstance(e, TimeoutException):
+        logger.error(f"Operation timed out: {str(e)}")
+        return jsonify({
+            "success": False,
+            "message": "Operation timed out. Please try again with a smaller file.",
+            "error_type": "timeout_error"
+        }), 408
+
+    if isinstance(e, RuntimeError):
+        logger.error(f"Configuration error: {str(e)}")
+        return jsonify({
+            "success": False,
+            "message": f"Server configuration error: {str(e)}",
+            "error_type": "config_error"
+        }), 500
+
+    logger.error(f"Unexpected error processing PPTX: {str(e)}")
+    return jsonify({
+        "success": False,
+        "message": f"Unexpected error: {str(e)}",
+        "error_type": "server_error"
+    }), 500
+
 @app.route('/process_pptx', methods=['POST'])
 def process_pptx():
     """
@@ -381,11 +3695,19 @@ def process_pptx():
 
     Expected JSON payload:
     {
-        "pptx_url": "https://example.com/file.pptx"
+        "pptx_url": "https://example.com/file.pptx",
+        "response_mode": "url",  # optional, "url" (default) or "inline"
+        "scan_scope": "slides,notes",  # optional, parts to scan (see SCAN_SCOPE)
+        "rule_set": "default",  # optional, link rule set for the display text (see LINK_RULES_FILE)
+        "validate_links": false,  # optional, check that the links are reachable (see VALIDATE_LINKS)
+        "links": ["https://example.com/a.mp3"],  # optional, skip extraction and use these links
+        "outline": {...},  # optional, or the course outline JSON the deck was generated from
+        "compression": "default"  # optional, output compression profile (see OUTPUT_COMPRESSION)
     }
 
     Returns:
-        JSON response with COS download URL
+        JSON response with COS download URL, or the processed PPTX itself
+        when response_mode is "inline"
     """
     try:
         # Get request data
@@ -394,6 +3716,12 @@ def process_pptx():
             raise BadRequest("Missing 'pptx_url' in request body")
 
         pptx_url = data['pptx_url']
+        response_mode = get_response_mode(data.get('response_mode'))
+        scan_scope = get_scan_scope(data.get('scan_scope'))
+        rule_set = get_rule_set(data.get('rule_set'))
+        validate_links = get_validate_links(data.get('validate_links'))
+        supplied_links, link_source = get_supplied_links(data.get('links'), data.get('outline'))
+        compression = get_compression_profile(data.get('compression'))
         start_time = time.time()
         logger.info(f"Processing PPTX from URL: {pptx_url}")
         logger.info(f"API timeout limit: {API_TIMEOUT} seconds")
@@ -410,118 +3738,383 @@ def process_pptx():
                 return True
             return False
 
-        # Validate COS configuration first
-        validate_cos_config()
+        # Validate COS configuration first (inline responses never touch COS)
+        if response_mode == 'url':
+            validate_cos_config()
 
-        # Create temporary directory for processing
-        with tempfile.TemporaryDirectory() as temp_dir:
-            # Download PPTX file with retry mechanism
-            logger.info("Downloading PPTX file...")
-            input_pptx_path = os.path.join(temp_dir, "input.pptx")
+        def download_and_process():
+            # Inspect the remote zip directory first, so bad or huge files are
+            # rejected before paying for the full download
+            remote_summary, remote_preflight_time = run_remote_preflight(pptx_url)
 
-            try:
-                download_start = time.time()
-                file_size = download_file_with_retry(pptx_url, input_pptx_path)
-                download_time = time.time() - download_start
-                logger.info(f"Downloaded PPTX file to: {input_pptx_path} ({file_size} bytes) in {download_time:.2f}s")
+            with contextlib.ExitStack() as admission:
+                # With a remote preflight the job is admitted (and routed to the heavy-job
+                # lane) before the download; otherwise after it, on the local preflight
+                queue_wait_time = admit_job(admission, remote_summary) if remote_summary is not None else None
 
-                # Check if we have enough time left
-                elapsed_time = time.time() - start_time
-                if elapsed_time > API_TIMEOUT * 0.3:  # If download took more than 30% of time
-                    logger.warning(f"Download took {download_time:.2f}s, may not have enough time for processing")
+                # Create temporary directory for processing
+                with tempfile.TemporaryDirectory() as temp_dir:
+                    # Download PPTX file with retry mechanism
+                    logger.info("Downloading PPTX file...")
+                    input_pptx_path = os.path.join(temp_dir, "input.pptx")
 
-            except Exception as e:
-                logger.error(f"Failed to download file: {str(e)}")
-                raise
+                    try:
+                        download_start = time.time()
+                        with pipeline_stage('download', **{'url.full': pptx_url}) as span:
+                            file_size = download_file_with_retry(pptx_url, input_pptx_path)
+                            span.set_attribute('bytes', file_size)
+                        download_time = time.time() - download_start
+                        logger.info(f"Downloaded PPTX file to: {input_pptx_path} ({file_size} bytes) in {download_time:.2f}s")
 
-            # Extract links from PPTX
-            logger.info("Extracting links from PPTX...")
-            extract_start = time.time()
-            links = extract_links_from_pptx(input_pptx_path)
-            extract_time = time.time() - extract_start
-            logger.info(f"Found {len(links)} links in {extract_time:.2f}s: {list(links)}")
-
-            if not links:
-                logger.warning("No links found in PPTX file")
-                return jsonify({
-                    "success": False,
-                    "message": "No media or game links found in the PPTX file"
-                }), 400
-
-            # Add hyperlinks to PPTX
-            logger.info("Adding hyperlinks to PPTX...")
-            hyperlink_start = time.time()
-            output_pptx_path = os.path.join(temp_dir, "output.pptx")
-            add_hyperlinks_to_pptx(input_pptx_path, links, output_pptx_path)
-            hyperlink_time = time.time() - hyperlink_start
-            logger.info(f"Added hyperlinks in {hyperlink_time:.2f}s")
-
-            # Generate unique filename for COS
-            timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-            cos_key = f"processed_pptx/hyperlink_converted_{timestamp}.pptx"
+                        # Check if we have enough time left
+                        elapsed_time = time.time() - start_time
+                        if elapsed_time > API_TIMEOUT * 0.3:  # If download took more than 30% of time
+                            logger.warning(f"Download took {download_time:.2f}s, may not have enough time for processing")
 
-            # Upload to COS
-            logger.info("Uploading processed PPTX to COS...")
-            upload_start = time.time()
-            download_url = upload_to_cos(output_pptx_path, cos_key)
-            upload_time = time.time() - upload_start
-            total_time = time.time() - start_time
-            logger.info(f"Uploaded to COS in {upload_time:.2f}s")
-            logger.info(f"Total processing time: {total_time:.2f}s")
-
-            return jsonify({
-                "success": True,
-                "message": "PPTX file processed successfully",
-                "download_url": download_url,
-                "links_found": list(links),
-                "links_converted": len(links),
-                "processing_time": round(total_time, 2),
-                "performance": {
-                    "download_time": round(download_time, 2),
-                    "extract_time": round(extract_time, 2),
-                    "hyperlink_time": round(hyperlink_time, 2),
-                    "upload_time": round(upload_time, 2),
-                    "total_time": round(total_time, 2)
-                }
-            })
+                    except Exception as e:
+                        logger.error(f"Failed to download file: {str(e)}")
+                        raise
 
-    except (requests.RequestException, ValueError) as e:
-        logger.error(f"Error downloading PPTX file: {str(e)}")
+                    payload, status, output_buffer = run_hyperlink_pipeline(
+                        input_pptx_path, temp_dir, start_time, download_time, response_mode, scan_scope, rule_set,
+                        validate_links, supplied_links, link_source, compression, source_url=pptx_url,
+                        queue_wait_time=queue_wait_time)
+                    if remote_summary is not None and "performance" in payload:
+                        payload["performance"]["remote_preflight_time"] = round(remote_preflight_time, 3)
+                    return payload, status, output_buffer
+
+        # Concurrent requests for the same URL share one download/process/upload
+        result, coalesced = pipeline_flight.do(
+            f"url:{response_mode}:{_scope_key(scan_scope)}:{rule_set}:{int(validate_links)}:"
+            f"{_links_key(supplied_links)}:{compression}:{pptx_url}",
+            lambda: run_metered('process_pptx', pptx_url, download_and_process), shareable=_is_shareable_result)
+        return build_pipeline_response(*result, coalesced=coalesced)
+
+    except Exception as e:
+        return _error_response(e)
+
+@app.route('/process_pptx_upload', methods=['POST'])
+def process_pptx_upload():
+    """
+    Process an uploaded PPTX file: extract links, add hyperlinks, upload to COS
+
+    Skips the source download by accepting the deck directly as
+    multipart/form-data. The upload is streamed into a spooled temp file
+    that stays in memory below UPLOAD_SPOOL_THRESHOLD, and is rejected
+    with 413 as soon as it exceeds MAX_FILE_SIZE.
+
+    Expected form data:
+        file: the PPTX file
+        response_mode: optional, "url" (default) or "inline"
+        scan_scope: optional, parts to scan (see SCAN_SCOPE)
+        rule_set: optional, link rule set for the display text (see LINK_RULES_FILE)
+        validate_links: optional, "true" to check that the links are reachable
+        links: optional, JSON array of links to use instead of extracting them
+        outline: optional, course outline JSON to take the links from
+        compression: optional, output compression profile (see OUTPUT_COMPRESSION)
+
+    Returns:
+        JSON response with COS download URL, or the processed PPTX itself
+        when response_mode is "inline"
+    """
+    try:
+        start_time = time.time()
+
+        # Reject oversized bodies before reading any of the stream
+        if request.content_length and request.content_length > MAX_FILE_SIZE + UPLOAD_FORM_OVERHEAD:
+            raise RequestEntityTooLarge(f"Request body too large: {request.content_length} bytes")
+
+        upload = request.files.get('file')
+        if upload is None:
+            raise BadRequest("Missing 'file' in multipart form data")
+
+        response_mode = get_response_mode(request.form.get('response_mode'))
+        scan_scope = get_scan_scope(request.form.get('scan_scope'))
+        rule_set = get_rule_set(request.form.get('rule_set'))
+        validate_links = get_validate_links(request.form.get('validate_links'))
+        supplied_links, link_source = get_supplied_links(request.form.get('links'), request.form.get('outline'))
+        compression = get_compression_profile(request.form.get('compression'))
+        logger.info(f"Processing uploaded PPTX: {upload.filename}")
+
+        # Validate COS configuration first (inline responses never touch COS)
+        if response_mode == 'url':
+            validate_cos_config()
+
+        upload_time = time.time() - start_time
+
+        def process_upload():
+            with tempfile.TemporaryDirectory() as temp_dir:
+                return run_hyperlink_pipeline(upload.stream, temp_dir, start_time, upload_time, response_mode,
+                                              scan_scope, rule_set, validate_links, supplied_links, link_source,
+                                              compression, source_hash=content_hash)
+
+        # Identical uploads in flight at the same time are processed once
+        content_hash = _hash_stream(upload.stream)
+        result, coalesced = pipeline_flight.do(
+            f"sha256:{response_mode}:{_scope_key(scan_scope)}:{rule_set}:{int(validate_links)}:"
+            f"{_links_key(supplied_links)}:{compression}:{content_hash}",
+            lambda: run_metered('process_pptx_upload', f"sha256:{content_hash}", process_upload),
+            shareable=_is_shareable_result)
+        return build_pipeline_response(*result, coalesced=coalesced)
+
+    except Exception as e:
+        return _error_response(e)
+
+@app.route('/extract_links', methods=['POST'])
+def extract_links():
+    """
+    Extract-only fast path: list the links in a PPTX and where they appear
+
+    Runs just the scanning stage in memory. Nothing is rewritten, saved or
+    uploaded, so COS is not required. Otherwise the deck goes through the
+    same remote preflight, admission, single-flight and metering as
+    /process_pptx.
+
+    Accepts either a JSON payload:
+    {
+        "pptx_url": "https://example.com/file.pptx",
+        "scan_scope": "slides,notes",  # optional, parts to scan (see SCAN_SCOPE)
+        "rule_set": "default",  # optional, link rule set (see LINK_RULES_FILE)
+        "validate_links": false  # optional, check that the links are reachable
+    }
+    or multipart/form-data with the deck in the 'file' field (and optional
+    'scan_scope', 'rule_set' and 'validate_links' fields).
+
+    Returns:
+        JSON response with links_found and per-link slide/shape locations
+    """
+    try:
+        start_time = time.time()
+
+        if request.mimetype == 'multipart/form-data':
+            if request.content_length and request.content_length > MAX_FILE_SIZE + UPLOAD_FORM_OVERHEAD:
+                raise RequestEntityTooLarge(f"Request body too large: {request.content_length} bytes")
+            upload = request.files.get('file')
+            if upload is None:
+                raise BadRequest("Missing 'file' in multipart form data")
+            scan_scope = get_scan_scope(request.form.get('scan_scope'))
+            rule_set = get_rule_set(request.form.get('rule_set'))
+            validate_links = get_validate_links(request.form.get('validate_links'))
+            logger.info(f"Extracting links from uploaded PPTX: {upload.filename}")
+            upload_time = time.time() - start_time
+
+            def process():
+                with contextlib.ExitStack() as admission:
+                    return _locate_links_job(upload.stream, admission, start_time, upload_time, scan_scope,
+                                             rule_set, validate_links)
+
+            content_hash = _hash_stream(upload.stream)
+            source = f"sha256:{content_hash}"
+        else:
+            data = request.get_json(silent=True)
+            if not data or 'pptx_url' not in data:
+                raise BadRequest("Missing 'pptx_url' in request body")
+            pptx_url = data['pptx_url']
+            scan_scope = get_scan_scope(data.get('scan_scope'))
+            rule_set = get_rule_set(data.get('rule_set'))
+            validate_links = get_validate_links(data.get('validate_links'))
+            logger.info(f"Extracting links from PPTX URL: {pptx_url}")
+
+            def process():
+                remote_summary, remote_preflight_time = run_remote_preflight(pptx_url)
+                with contextlib.ExitStack() as admission:
+                    # With a remote preflight the slot is taken before the deck is downloaded into memory
+                    queue_wait_time = admit_job(admission, remote_summary) if remote_summary is not None else None
+                    pptx_source = io.BytesIO()
+                    download_start = time.time()
+                    with pipeline_stage('download', **{'url.full': pptx_url}) as span:
+                        span.set_attribute('bytes', download_file_with_retry(pptx_url, pptx_source))
+                    download_time = time.time() - download_start
+                    payload, status, output_buffer = _locate_links_job(
+                        pptx_source, admission, start_time, download_time, scan_scope, rule_set, validate_links,
+                        queue_wait_time)
+                if remote_summary is not None and "performance" in payload:
+                    payload["performance"]["remote_preflight_time"] = round(remote_preflight_time, 3)
+                return payload, status, output_buffer
+
+            source = pptx_url
+
+        result, coalesced = pipeline_flight.do(
+            f"extract:{_scope_key(scan_scope)}:{rule_set}:{int(validate_links)}:{source}",
+            lambda: run_metered('extract_links', source, process), shareable=_is_shareable_result)
+        return build_pipeline_response(*result, coalesced=coalesced)
+
+    except Exception as e:
+        return _error_response(e)
+
+def _locate_links_job(pptx_source, admission, start_time, download_time, scan_scope, rule_set, validate_links,
+                      queue_wait_time=None):
+    """
+    Preflight, admit (unless already admitted) and locate the links of a deck for /extract_links
+
+    Args:
+        pptx_source (file): Seekable file object holding the PPTX
+        admission (contextlib.ExitStack): Holds the admission slots, see admit_job()
+        start_time (float): Request start time, used for total timing
+        download_time (float): Time spent fetching the source
+        scan_scope (str or tuple): Parts to scan for links, see get_scan_scope()
+        rule_set (str): Link rule set, see get_rule_set()
+        validate_links (bool): Check that the links found are reachable
+        queue_wait_time (float): Admission wait if the job was admitted already, else None
+
+    Returns:
+        tuple: (response payload dict, HTTP status code, None)
+    """
+    preflight, preflight_time = run_preflight(pptx_source)
+    if queue_wait_time is None:
+        queue_wait_time = admit_job(admission, preflight)
+
+    extract_start = time.time()
+    with pipeline_stage('extract', scan_scope=_scope_key(scan_scope)) as span:
+        locations = locate_links_in_pptx(pptx_source, scan_scope, rule_set)
+        span.set_attribute('links_found', len(locations))
+    extract_time = time.time() - extract_start
+
+    links_found = list(dict.fromkeys(location["url"] for location in locations))
+    logger.info(f"Located {len(links_found)} links ({len(locations)} occurrences) in {extract_time:.3f}s")
+
+    link_status, link_check_wait_time = _finish_link_checks(
+        start_link_checks(links_found) if validate_links and links_found else None)
+    total_time = time.time() - start_time
+
+    return _with_link_status({
+        "success": True,
+        "links_found": links_found,
+        "locations": locations,
+        "slide_count": preflight["slide_count"],
+        "scan_scope": _scope_key(scan_scope),
+        "preflight": {key: preflight[key] for key in (
+            "decision", "slide_count", "member_count", "total_uncompressed", "compression_ratio", "media_share")},
+        "processing_time": round(total_time, 3),
+        "performance": {
+            "download_time": round(download_time, 3),
+            "preflight_time": round(preflight_time, 3),
+            "queue_wait_time": round(queue_wait_time, 3),
+            "extract_time": round(extract_time, 3),
+            "total_time": round(total_time, 3)
+        }
+    }, link_status, link_check_wait_time), 200, None
+
+@app.route('/files/<key>', methods=['GET'])
+def get_cached_file(key):
+    """
+    Serve a processed PPTX from the local output cache
+
+    The transfer itself is handed to nginx with X-Accel-Redirect, so the
+    worker only checks the cache and returns headers. Without an accel
+    prefix configured (e.g. running without nginx) Flask sends the file.
+    Misses return 404; the COS download_url remains the fallback.
+    """
+    path = output_cache.get(key)
+    if path is None:
         return jsonify({
             "success": False,
-            "message": f"Error downloading PPTX file: {str(e)}",
-            "error_type": "download_error"
-        }), 400
+            "message": f"File not in local cache: {key}",
+            "error_type": "not_found"
+        }), 404
 
-    except TimeoutException as e:
-        logger.error(f"Operation timed out: {str(e)}")
+    if not OUTPUT_CACHE_ACCEL_PREFIX:
+        return send_file(path, mimetype=PPTX_MIMETYPE, as_attachment=True, download_name=key)
+
+    response = Response(status=200, mimetype=PPTX_MIMETYPE)
+    response.headers['X-Accel-Redirect'] = f"{OUTPUT_CACHE_ACCEL_PREFIX}{key}"
+    response.headers['Content-Disposition'] = f'attachment; filename="{key}"'
+    return response
+
+def _is_admin_request():
+    """ADMIN_TOKEN in X-Admin-Token, or with no token configured a direct (not proxied) local request"""
+    if ADMIN_TOKEN:
+        return hmac.compare_digest(request.headers.get('X-Admin-Token', ''), ADMIN_TOKEN)
+    return request.remote_addr in ('127.0.0.1', '::1') and 'X-Forwarded-For' not in request.headers
+
+@app.route('/admin/inflight', methods=['GET'])
+def admin_inflight():
+    """
+    List in-flight jobs across all workers: source, stage, elapsed time,
+    progress counters and the Python stack of every thread working on them
+
+    Query parameters:
+        stacks: "0" to leave out the thread stacks
+    """
+    if not _is_admin_request():
         return jsonify({
             "success": False,
-            "message": "Operation timed out. Please try again with a smaller file.",
-            "error_type": "timeout_error"
-        }), 408
+            "message": "Admin access required",
+            "error_type": "forbidden"
+        }), 403
 
-    except RuntimeError as e:
-        logger.error(f"Configuration error: {str(e)}")
+    include_stacks = request.args.get('stacks', '1') != '0'
+    workers = inflight_jobs.all_workers(include_stacks)
+    return jsonify({
+        "success": True,
+        "workers": workers,
+        "jobs_in_flight": sum(len(worker["jobs"]) for worker in workers)
+    })
+
+@app.route('/admin/traces', methods=['GET'])
+def admin_traces():
+    """
+    Recent request traces kept by this worker (TRACE_BUFFER_SIZE), newest
+    first, each as an OTLP/JSON document as written to TRACE_FILE
+
+    Query parameters:
+        trace_id: only this trace (from performance.trace_id)
+        min_duration: only traces that took at least this many seconds
+        errors: "1" for failed requests only
+        limit: maximum number of traces, default 20
+    """
+    if not _is_admin_request():
         return jsonify({
             "success": False,
-            "message": f"Server configuration error: {str(e)}",
-            "error_type": "config_error"
-        }), 500
+            "message": "Admin access required",
+            "error_type": "forbidden"
+        }), 403
 
-    except Exception as e:
-        logger.error(f"Unexpected error processing PPTX: {str(e)}")
+    try:
+        min_duration = float(request.args.get('min_duration', '0'))
+        limit = int(request.args.get('limit', '20'))
+    except ValueError:
         return jsonify({
             "success": False,
-            "message": f"Unexpected error: {str(e)}",
-            "error_type": "server_error"
-        }), 500
+            "message": "'min_duration' and 'limit' must be numbers",
+            "error_type": "invalid_request"
+        }), 400
+
+    traces = trace_collector.recent(request.args.get('trace_id'), min_duration,
+                                    request.args.get('errors') == '1', limit)
+    return jsonify({"success": True, "pid": os.getpid(), "traces": traces})
 
 @app.route('/health', methods=['GET'])
 def health_check():
     """Health check endpoint"""
     return jsonify({"status": "healthy", "service": "PPT Hyperlink Converter"})
 
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    """Per-worker runtime metrics: admission queue depth, memory budget usage and wait times"""
+    return jsonify({
+        "pid": os.getpid(),
+        "admission": admission_controller.metrics(),
+        "heavy_lane": heavy_lane_controller.metrics(),
+        "part_scan_cache": part_scan_cache.metrics(),
+        "slide_rewrite_cache": slide_rewrite_cache.metrics(),
+        "link_classification_cache": {name: rule_set.cache.metrics() for name, rule_set in link_rule_sets.items()},
+        "link_check_cache": link_check_cache.metrics(),
+        "unchanged_upload_cache": unchanged_upload_cache.metrics(),
+        "output_cache": output_cache.metrics(),
+        "traces": trace_collector.metrics(),
+        "log_records_dropped": _log_queue_handler.dropped if _log_queue_handler is not None else 0
+    })
+
+@app.route('/startup', methods=['GET'])
+def startup_report():
+    """Startup timing report: where import and initialization time went"""
+    return jsonify({
+        "timings": STARTUP_TIMINGS,
+        "modules_loaded": {module._name: module._module is not None for module in (requests, etree, qcloud_cos)},
+        "cos_client_initialized": _cos_client_initialized
+    })
+
 @app.route('/', methods=['GET'])
 def index():
     """API documentation"""
@@ -532,19 +4125,67 @@ def index():
             "POST /process_pptx": {
                 "description": "Process PPTX file to add hyperlinks",
                 "payload": {
-                    "pptx_url": "URL of the PPTX file to process"
+                    "pptx_url": "URL of the PPTX file to process",
+                    "response_mode": "optional, 'url' (default) or 'inline' to receive the processed PPTX in the response body",
+                    "scan_scope": "optional, parts to scan: 'all' or any of slides,notes,layouts,masters (default SCAN_SCOPE)",
+                    "rule_set": "optional, name of the link rule set for the display text (default 'default', see LINK_RULES_FILE)",
+                    "validate_links": "optional, true to check that each link (the data_url JSON for game links) is reachable",
+                    "links": "optional, array of links to convert; skips link extraction",
+                    "outline": "optional, course outline JSON (nodes with url/children) to take the links from; skips link extraction",
+                    "compression": "optional, output compression: 'default', 'store_media' (store media as-is), 'fast' (also fast XML deflate) or 'max'"
                 },
                 "response": {
                     "success": "boolean",
                     "message": "string",
                     "download_url": "string (COS download URL)",
+                    "local_url": "string or null (GET path of the copy in the local output cache)",
+                    "links_found": "array of strings",
+                    "links_converted": "number",
+                    "unchanged": "true when nothing was converted: download_url is then the original file",
+                    "link_status": "with validate_links: array of {url, checked_url, reachable, status_code, error, cached}"
+                }
+            },
+            "POST /process_pptx_upload": {
+                "description": "Process an uploaded PPTX file (multipart/form-data) without downloading it first",
+                "payload": {
+                    "file": "PPTX file, at most MAX_FILE_SIZE bytes",
+                    "response_mode": "optional, 'url' (default) or 'inline'",
+                    "scan_scope": "optional, same as POST /process_pptx",
+                    "rule_set": "optional, same as POST /process_pptx",
+                    "validate_links": "optional, same as POST /process_pptx",
+                    "links": "optional, JSON array of links (form field); skips link extraction",
+                    "outline": "optional, course outline JSON (form field); skips link extraction",
+                    "compression": "optional, same as POST /process_pptx"
+                },
+                "response": "Same as POST /process_pptx"
+            },
+            "POST /extract_links": {
+                "description": "Only list the links in a PPTX and their slide/shape locations (no rewrite, no COS upload)",
+                "payload": {
+                    "pptx_url": "URL of the PPTX file (JSON), or 'file' as multipart/form-data",
+                    "scan_scope": "optional, same as POST /process_pptx",
+                    "rule_set": "optional, same as POST /process_pptx",
+                    "validate_links": "optional, same as POST /process_pptx"
+                },
+                "response": {
+                    "success": "boolean",
                     "links_found": "array of strings",
-                    "links_converted": "number"
+                    "locations": "array of {url, kind, display_text, part, slide, shape_id, shape_name}"
                 }
             },
-            "GET /health": "Health check endpoint"
+            "GET /files/<key>": "Download a processed PPTX from the local output cache (local_url); sent by nginx when OUTPUT_CACHE_ACCEL_PREFIX is set",
+            "GET /admin/inflight": "In-flight jobs across workers with stage, elapsed time, progress and thread stacks (X-Admin-Token)",
+            "GET /admin/traces": "Recent request traces of this worker in OTLP/JSON, filterable by trace_id, min_duration and errors (X-Admin-Token)",
+            "GET /health": "Health check endpoint",
+            "GET /startup": "Startup timing report (import and initialization times)",
+            "GET /metrics": "Per-worker metrics: admission queue depth, memory budget usage, queue wait times, cache hit rates"
         }
     })
 
+STARTUP_TIMINGS["app_module"] = round(time.perf_counter() - _MODULE_IMPORT_START, 4)
+if WARM_IMPORTS:
+    threading.Thread(target=_warm_imports, name="warm-imports", daemon=True).start()
+
 if __name__ == '__main__':
+    install_inflight_dump_signal()
     app.run(host='0.0.0.0', port=5000, debug=False)
@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+"""
+链接扫描器基准测试 - 对比融合字节扫描器与旧版的两遍字符串扫描
+
+用法:
+    python bench_scanner.py [pptx文件 ...]
+
+不指定文件时使用 ppt处理后案例/ 下的全部示例。每个XML/.rels部件分别用两种
+实现扫描，先检查结果是否一致，再统计各自耗时。
+"""
+
+import glob
+import html
+import os
+import re
+import sys
+import time
+import zipfile
+
+from app import _scan_part
+
+# 旧版实现：解码为str后，媒体和游戏正则各扫一遍，每个匹配再做两次re.sub
+LEGACY_MEDIA_REGEX = re.compile(r'https?://[^\s\)\(\（\）]+\.(?:mp3|mp4|wav|avi|mov|wmv|flv|ogg|webm)', re.IGNORECASE)
+LEGACY_GAME_REGEX = re.compile(r'https?://[^\s]+/index\.html\?data_url=https?://[^\s&]+\.json(?:&[^\s]*)?', re.IGNORECASE)
+LEGACY_SHAPE_PROPS_REGEX = re.compile(r'<p:cNvPr\b[^>]*>')
+LEGACY_XML_ATTR_REGEX = re.compile(r'(\w+)="([^"]*)"')
+
+def legacy_scan_part(raw):
+    """旧版 _scan_part：返回 ((url, shape id, shape name), ...)"""
+    content = raw.decode('utf-8', errors='ignore')
+    hits = []
+    seen = set()
+    for regex in (LEGACY_MEDIA_REGEX, LEGACY_GAME_REGEX):
+        for match in regex.finditer(content):
+            url = re.sub(r'<[^>]*>', '', match.group(0))
+            url = re.sub(r'&amp;', '&', url).strip()
+            if not url.startswith('http'):
+                continue
+            shape_id, shape_name = None, None
+            tag_start = content.rfind('<p:cNvPr', 0, match.start())
+            tag = LEGACY_SHAPE_PROPS_REGEX.match(content, tag_start) if tag_start != -1 else None
+            if tag:
+                attrs = dict(LEGACY_XML_ATTR_REGEX.findall(tag.group(0)))
+                shape_id = attrs.get('id')
+                shape_id = int(shape_id) if shape_id and shape_id.isdigit() else shape_id
+                shape_name = html.unescape(attrs.get('name', ''))
+            if (url, shape_id) in seen:
+                continue
+            seen.add((url, shape_id))
+            hits.append((url, shape_id, shape_name))
+    return tuple(hits)
+
+def load_parts(paths):
+    """读取所有文件的XML和.rels部件原始字节"""
+    parts = []
+    for path in paths:
+        with zipfile.ZipFile(path) as zip_file:
+            for name in zip_file.namelist():
+                if name.endswith('.xml') or name.endswith('.rels'):
+                    parts.append((f"{os.path.basename(path)}:{name}", zip_file.read(name)))
+    return parts
+
+def time_scanner(scanner, parts, rounds):
+    """返回每轮扫描全部部件的最短耗时（秒）"""
+    best = None
+    for _ in range(rounds):
+        start = time.perf_counter()
+        for name, raw in parts:
+            scanner(raw)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+def main():
+    paths = sys.argv[1:] or sorted(glob.glob(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                                          'ppt处理后案例', '*.pptx')))
+    if not paths:
+        print("没有找到要测试的PPTX文件")
+        return 1
+
+    parts = load_parts(paths)
+    total_bytes = sum(len(raw) for name, raw in parts)
+    print(f"{len(paths)} 个文件, {len(parts)} 个部件, {total_bytes / 1024 / 1024:.1f} MB")
+
+    # 1. 结果一致性（集合比较：新扫描器按出现顺序返回，旧版先媒体后游戏）
+    differences = 0
+    for name, raw in parts:
+        legacy, fused = set(legacy_scan_part(raw)), set(_scan_part(raw))
+        if legacy != fused:
+            differences += 1
+            print(f"  结果不同 {name}:")
+            print(f"    旧版: {sorted(legacy - fused, key=str)}")
+            print(f"    新版: {sorted(fused - legacy, key=str)}")
+    print(f"结果一致性: {len(parts) - differences}/{len(parts)} 个部件相同")
+
+    # 2. 耗时
+    rounds = 5
+    legacy_time = time_scanner(legacy_scan_part, parts, rounds)
+    fused_time = time_scanner(_scan_part, parts, rounds)
+    print(f"旧版两遍字符串扫描: {legacy_time * 1000:.1f} ms ({total_bytes / legacy_time / 1024 / 1024:.0f} MB/s)")
+    print(f"融合字节扫描器:     {fused_time * 1000:.1f} ms ({total_bytes / fused_time / 1024 / 1024:.0f} MB/s)")
+    print(f"加速比: {legacy_time / fused_time:.2f}x")
+    return 0 if differences == 0 else 2
+
+if __name__ == '__main__':
+    sys.exit(main())
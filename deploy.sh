@@ -45,6 +45,11 @@ preload_app = True
 accesslog = "/var/log/$PROJECT_NAME/access.log"
 errorlog = "/var/log/$PROJECT_NAME/error.log"
 loglevel = "info"
+
+# 每个worker启动后安装进行中任务的转储信号（worker启动时会重置信号处理）
+def post_worker_init(worker):
+    from app import install_inflight_dump_signal
+    install_inflight_dump_signal()
 EOF
 
 # 6. 创建日志目录
@@ -202,7 +202,9 @@ def extract_links_from_pptx(pptx_path):
         logger.error(f"Error extracting links from PPTX: {str(e)}")
         raise
 
-    logger.info(f"Extracted {len(links)} clean URLs: {list(links)}")
+    logger.info(f"Extracted {len(links)} clean URLs")
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(f"Clean URLs: {list(links)}")
     return links
 
 def _clean_extracted_url(url):
@@ -352,7 +354,8 @@ def add_hyperlinks_to_pptx(pptx_path, links, output_path):
                         # Process the paragraph to add hyperlinks while preserving formatting
                         if _process_paragraph_for_hyperlinks(paragraph, links_list):
                             conversions_made += 1
-                            logger.info(f"Added hyperlink in slide {slide_idx + 1}, shape {shape_idx + 1}, paragraph {para_idx + 1}")
+                            if logger.isEnabledFor(logging.DEBUG):
+                                logger.debug(f"Added hyperlink in slide {slide_idx + 1}, shape {shape_idx + 1}, paragraph {para_idx + 1}")
 
         # Save the modified presentation
         prs.save(output_path)
@@ -374,31 +377,39 @@ def _process_paragraph_for_hyperlinks(paragraph, links_list):
         bool: True if any conversions were made
     """
     conversions_made = False
-    logger.info(f"--- Analyzing paragraph: '{paragraph.text[:100]}...'")
-    for i, run in enumerate(paragraph.runs):
-        logger.info(f"    Run {i}: '{run.text}' | Has Hyperlink: {run.hyperlink.address is not None}")
+    # Per-run detail is DEBUG only, and not even built otherwise: this runs for every paragraph
+    detail = logger.isEnabledFor(logging.DEBUG)
+    if detail:
+        logger.debug(f"--- Analyzing paragraph: '{paragraph.text[:100]}...'")
+        for i, run in enumerate(paragraph.runs):
+            logger.debug(f"    Run {i}: '{run.text}' | Has Hyperlink: {run.hyperlink.address is not None}")
 
     for link in links_list:
         # Check if the link exists in the paragraph text at all
         if link in paragraph.text:
-            logger.info(f"Found potential link in paragraph: {link}")
+            if detail:
+                logger.debug(f"Found potential link in paragraph: {link}")
             # Now, check each run
             for run in paragraph.runs:
                 if link in run.text:
-                    logger.info(f"  >> Match found! Link '{link[:30]}...' is in run: '{run.text[:50]}...'")
+                    if detail:
+                        logger.debug(f"  >> Match found! Link '{link[:30]}...' is in run: '{run.text[:50]}...'")
                     if run.hyperlink.address is None:
                         friendly_text = get_friendly_link_text(link)
-                        logger.info(f"  >> Attempting to replace '{run.text}' with '{friendly_text}' and apply hyperlink.")
+                        if detail:
+                            logger.debug(f"  >> Attempting to replace '{run.text}' with '{friendly_text}' and apply hyperlink.")
 
                         # The actual replacement logic
                         run.text = run.text.replace(link, friendly_text)
                         run.hyperlink.address = link
                         conversions_made = True
-                        logger.info(f"  >> SUCCESS: Converted URL to hyperlink with friendly text '{friendly_text}'")
+                        if detail:
+                            logger.debug(f"  >> SUCCESS: Converted URL to hyperlink with friendly text '{friendly_text}'")
                         # Once we make a conversion in a paragraph, we move to the next to be safe
                         return True
                     else:
-                        logger.info(f"  >> Skipping, run already has a hyperlink: {run.hyperlink.address}")
+                        if detail:
+                            logger.debug(f"  >> Skipping, run already has a hyperlink: {run.hyperlink.address}")
     return conversions_made
 
 def _is_url_already_hyperlinked(paragraph, url):
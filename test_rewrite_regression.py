@@ -0,0 +1,306 @@
+#!/usr/bin/env python3
+"""
+Regression checks for the zip/lxml slide rewrite and the preflight parsers
+
+Runs without the Flask API, COS or network access:
+
+1. Known decks: every deck in ppt处理后案例/ is processed and the hyperlinks
+   in the output (slide, paragraph text, target of each run) are compared
+   with ppt处理后案例/expected_hyperlinks.json, which was produced by the
+   python-pptx implementation. Parts that were not rewritten must be
+   copied byte for byte.
+2. A link split across <a:r> runs, supplied by the caller.
+3. rId allocation: existing hyperlink relationships are reused, new ones
+   take a free rId, and slides without a relationships part get one.
+4. Scan scope: links only in notes, layouts, masters or unreferenced parts.
+5. Zip64 packages in the local and remote (HTTP Range) preflight.
+
+Usage:
+    python test_rewrite_regression.py
+    python test_rewrite_regression.py --update-expected   # after an intended output change
+"""
+
+import glob
+import io
+import json
+import os
+import sys
+import zipfile
+
+from lxml import etree
+
+import app
+from app import (extract_links_from_pptx, add_hyperlinks_to_pptx, get_friendly_link_text, get_scan_scope,
+                 preflight_pptx, remote_preflight, _slide_parts_in_order, _rels_name_for)
+
+SAMPLES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'ppt处理后案例')
+EXPECTED_FILE = os.path.join(SAMPLES_DIR, 'expected_hyperlinks.json')
+
+NS = {
+    'a': 'http://schemas.openxmlformats.org/drawingml/2006/main',
+    'r': 'http://schemas.openxmlformats.org/officeDocument/2006/relationships',
+    'p': 'http://schemas.openxmlformats.org/presentationml/2006/main',
+    'rel': 'http://schemas.openxmlformats.org/package/2006/relationships'
+}
+RT = 'http://schemas.openxmlformats.org/officeDocument/2006/relationships/'
+
+def read_rels(zip_file, part_name):
+    """{rId: (type, target)} of a part's relationships part"""
+    try:
+        root = etree.fromstring(zip_file.read(_rels_name_for(part_name)))
+    except KeyError:
+        return {}
+    return {rel.get('Id'): (rel.get('Type'), rel.get('Target')) for rel in root.iterfind('rel:Relationship', NS)}
+
+def hyperlink_signature(pptx_file):
+    """
+    Every paragraph with a hyperlinked run, as [slide number, paragraph text, [run targets]]
+
+    Runs without a hyperlink have a None target.
+    """
+    signature = []
+    with zipfile.ZipFile(pptx_file) as zip_file:
+        for slide_number, slide_part in enumerate(_slide_parts_in_order(zip_file), 1):
+            if not slide_part:
+                continue
+            rels = read_rels(zip_file, slide_part)
+            root = etree.fromstring(zip_file.read(slide_part))
+            for paragraph in root.iterfind('.//a:p', NS):
+                runs = paragraph.findall('a:r', NS)
+                targets = []
+                for run in runs:
+                    click = run.find('a:rPr/a:hlinkClick', NS)
+                    rid = click.get(f"{{{NS['r']}}}id") if click is not None else None
+                    targets.append(rels[rid][1] if rid in rels else (rid and f"missing:{rid}"))
+                if any(targets):
+                    text = ''.join(run.findtext('a:t', '', NS) for run in runs)
+                    signature.append([slide_number, text, targets])
+    return signature
+
+def process(pptx_file, links=None, scan_scope='all'):
+    """Run extraction (unless links are given) and the rewrite into memory; returns (output buffer, stats)"""
+    if links is None:
+        links = extract_links_from_pptx(pptx_file, scan_scope)
+    output = io.BytesIO()
+    stats = add_hyperlinks_to_pptx(pptx_file, links, output)
+    output.seek(0)
+    return output, stats
+
+def check(condition, message):
+    print(f"  {'OK  ' if condition else 'FAIL'} {message}")
+    return bool(condition)
+
+def test_known_decks(update_expected=False):
+    """Compare the hyperlinks written into the sample decks with the python-pptx output"""
+    print("Known decks")
+    decks = sorted(glob.glob(os.path.join(SAMPLES_DIR, '*.pptx')))
+    if not decks:
+        return check(False, f"no sample decks in {SAMPLES_DIR}")
+
+    expected = {}
+    if os.path.exists(EXPECTED_FILE):
+        with open(EXPECTED_FILE, encoding='utf-8') as f:
+            expected = json.load(f)
+
+    ok = True
+    actual = {}
+    for deck in decks:
+        name = os.path.basename(deck)
+        output, stats = process(deck)
+        actual[name] = hyperlink_signature(output)
+        if not update_expected:
+            ok &= check(name in expected and actual[name] == expected[name],
+                        f"{name}: {stats['conversions']} conversions, {len(actual[name])} hyperlinked paragraphs")
+
+        # The package keeps its member order; parts that were not rewritten are copied unchanged
+        with zipfile.ZipFile(deck) as source, zipfile.ZipFile(output) as result:
+            ok &= check(result.testzip() is None and source.namelist() == result.namelist(),
+                        f"{name}: valid zip with the same members in the same order")
+            changed = [member for member in source.namelist() if source.read(member) != result.read(member)]
+            ok &= check(all(member.startswith(('ppt/slides/slide', 'ppt/slides/_rels/')) for member in changed),
+                        f"{name}: only slide parts changed ({len(changed)} parts)")
+
+    if update_expected:
+        with open(EXPECTED_FILE, 'w', encoding='utf-8') as f:
+            json.dump(actual, f, ensure_ascii=False, indent=1)
+        print(f"  wrote {EXPECTED_FILE}")
+    return ok
+
+def _shape(shape_id, paragraphs):
+    """A text box <p:sp> whose paragraphs are given as lists of run texts"""
+    body = ''.join('<a:p>' + ''.join(f'<a:r><a:rPr lang="zh-CN"/><a:t>{text}</a:t></a:r>' for text in runs)
+                   + '<a:endParaRPr lang="zh-CN"/></a:p>' for runs in paragraphs)
+    return (f'<p:sp><p:nvSpPr><p:cNvPr id="{shape_id}" name="TextBox {shape_id}"/><p:cNvSpPr txBox="1"/><p:nvPr/>'
+            f'</p:nvSpPr><p:spPr/><p:txBody><a:bodyPr/><a:lstStyle/>{body}</p:txBody></p:sp>')
+
+def _part(root_tag, shapes):
+    return (f'<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+            f'<p:{root_tag} xmlns:a="{NS["a"]}" xmlns:r="{NS["r"]}" xmlns:p="{NS["p"]}"><p:cSld><p:spTree>'
+            f'<p:nvGrpSpPr><p:cNvPr id="1" name=""/><p:cNvGrpSpPr/><p:nvPr/></p:nvGrpSpPr><p:grpSpPr/>'
+            f'{"".join(shapes)}</p:spTree></p:cSld></p:{root_tag}>')
+
+def _rels(relationships):
+    """relationships: (rId, type suffix, target, external)"""
+    items = ''.join(f'<Relationship Id="{rid}" Type="{RT}{rel_type}" Target="{target}"'
+                    + (' TargetMode="External"' if external else '') + '/>'
+                    for rid, rel_type, target, external in relationships)
+    return (f'<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+            f'<Relationships xmlns="{NS["rel"]}">{items}</Relationships>')
+
+def build_deck(slides, notes=None, layout_shapes=(), master_shapes=(), extra_parts=None, zip64=False):
+    """
+    Build a minimal PPTX in memory
+
+    Args:
+        slides (list): (shapes, extra slide relationships or None to omit the slide's rels part)
+        notes (list): Shapes of the first slide's notes page, if any
+        layout_shapes / master_shapes: Shapes of the single layout and master
+        extra_parts (dict): Additional part name -> XML, not referenced from anywhere
+        zip64 (bool): Write zip64 end of central directory records
+    """
+    parts = {
+        '[Content_Types].xml': '<?xml version="1.0" encoding="UTF-8"?><Types '
+                               'xmlns="http://schemas.openxmlformats.org/package/2006/content-types"/>',
+        '_rels/.rels': _rels([('rId1', 'officeDocument', 'ppt/presentation.xml', False)]),
+        'ppt/slideMasters/slideMaster1.xml': _part('sldMaster', master_shapes),
+        'ppt/slideMasters/_rels/slideMaster1.xml.rels': _rels([('rId1', 'slideLayout',
+                                                                '../slideLayouts/slideLayout1.xml', False)]),
+        'ppt/slideLayouts/slideLayout1.xml': _part('sldLayout', layout_shapes),
+        'ppt/slideLayouts/_rels/slideLayout1.xml.rels': _rels([('rId1', 'slideMaster',
+                                                                '../slideMasters/slideMaster1.xml', False)]),
+    }
+    presentation_rels = [('rId1', 'slideMaster', 'slideMasters/slideMaster1.xml', False)]
+    slide_ids = ''
+    for number, (shapes, slide_rels) in enumerate(slides, 1):
+        parts[f'ppt/slides/slide{number}.xml'] = _part('sld', shapes)
+        if slide_rels is not None:
+            relationships = [('rId1', 'slideLayout', '../slideLayouts/slideLayout1.xml', False)] + list(slide_rels)
+            if number == 1 and notes is not None:
+                relationships.append((f'rId{len(relationships) + 1}', 'notesSlide',
+                                      '../notesSlides/notesSlide1.xml', False))
+            parts[f'ppt/slides/_rels/slide{number}.xml.rels'] = _rels(relationships)
+        presentation_rels.append((f'rId{number + 1}', 'slide', f'slides/slide{number}.xml', False))
+        slide_ids += f'<p:sldId id="{255 + number}" r:id="rId{number + 1}"/>'
+    if notes is not None:
+        parts['ppt/notesSlides/notesSlide1.xml'] = _part('notes', notes)
+    parts['ppt/presentation.xml'] = (
+        f'<?xml version="1.0" encoding="UTF-8" standalone="yes"?><p:presentation xmlns:a="{NS["a"]}" '
+        f'xmlns:r="{NS["r"]}" xmlns:p="{NS["p"]}"><p:sldMasterIdLst><p:sldMasterId id="2147483648" r:id="rId1"/>'
+        f'</p:sldMasterIdLst><p:sldIdLst>{slide_ids}</p:sldIdLst></p:presentation>')
+    parts['ppt/_rels/presentation.xml.rels'] = _rels(presentation_rels)
+    parts.update(extra_parts or {})
+
+    buffer = io.BytesIO()
+    filecount_limit = zipfile.ZIP_FILECOUNT_LIMIT
+    if zip64:
+        zipfile.ZIP_FILECOUNT_LIMIT = 1  # any member count then needs the zip64 end records
+    try:
+        with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_DEFLATED) as zip_file:
+            for name, xml in parts.items():
+                zip_file.writestr(name, xml)
+    finally:
+        zipfile.ZIP_FILECOUNT_LIMIT = filecount_limit
+    buffer.seek(0)
+    return buffer
+
+VIDEO_URL = 'https://cdn.example.com/video/clip.mp4'
+AUDIO_URL = 'https://cdn.example.com/audio/intro.mp3'
+
+def test_split_runs():
+    """A supplied link whose text PowerPoint split over several runs (not even 'http' in one text node)"""
+    print("Link split across runs")
+    deck = build_deck([([_shape(2, [['ht', 'tps://cdn.example.com/video/clip.m', 'p4']])], [])])
+    output, stats = process(deck, links=[VIDEO_URL])
+    return check(hyperlink_signature(output) == [[1, get_friendly_link_text(VIDEO_URL), [VIDEO_URL]]],
+                 f"paragraph replaced by one hyperlinked run ({stats['slides_parsed']} slides parsed)")
+
+def test_rid_allocation():
+    """Existing hyperlink relationships are reused and new rIds never collide"""
+    print("rId allocation")
+    ok = True
+    # rId1 is the layout, rId3 an existing hyperlink to VIDEO_URL: VIDEO_URL reuses rId3, AUDIO_URL gets rId2
+    deck = build_deck([
+        ([_shape(2, [[VIDEO_URL], [AUDIO_URL]])], [('rId3', 'hyperlink', VIDEO_URL, True)]),
+        ([_shape(2, [[AUDIO_URL]])], None),  # no relationships part at all
+    ])
+    output, stats = process(deck)
+    ok &= check(stats['conversions'] == 3, f"3 paragraphs converted (got {stats['conversions']})")
+    with zipfile.ZipFile(output) as zip_file:
+        rels = read_rels(zip_file, 'ppt/slides/slide1.xml')
+        ok &= check(rels.get('rId3') == (RT + 'hyperlink', VIDEO_URL) and rels.get('rId2') == (RT + 'hyperlink', AUDIO_URL)
+                    and len(rels) == 3, f"slide 1: existing rId3 reused, new link as rId2 ({sorted(rels)})")
+        rels = read_rels(zip_file, 'ppt/slides/slide2.xml')
+        ok &= check(rels == {'rId1': (RT + 'hyperlink', AUDIO_URL)}, f"slide 2: new rels part with rId1 ({rels})")
+    ok &= check(hyperlink_signature(output) == [
+        [1, get_friendly_link_text(VIDEO_URL), [VIDEO_URL]],
+        [1, get_friendly_link_text(AUDIO_URL), [AUDIO_URL]],
+        [2, get_friendly_link_text(AUDIO_URL), [AUDIO_URL]],
+    ], "every hlinkClick resolves to its link")
+    return ok
+
+def test_scan_scope():
+    """Links only in notes, layouts, masters or unreferenced parts are found only in the matching scope"""
+    print("Scan scope")
+    urls = {name: f'https://cdn.example.com/{name}/clip.mp3' for name in ('slide', 'notes', 'layout', 'master', 'orphan')}
+    deck = build_deck([([_shape(2, [[urls['slide']]])], [])],
+                      notes=[_shape(2, [[urls['notes']]])],
+                      layout_shapes=[_shape(2, [[urls['layout']]])],
+                      master_shapes=[_shape(2, [[urls['master']]])],
+                      extra_parts={'ppt/unused.xml': _part('sld', [_shape(2, [[urls['orphan']]])])})
+    ok = True
+    for scope, expected in (('slides', {'slide'}),
+                            ('slides,notes', {'slide', 'notes'}),
+                            ('slides,notes,layouts', {'slide', 'notes', 'layout'}),
+                            ('slides,notes,layouts,masters', {'slide', 'notes', 'layout', 'master'}),
+                            ('all', set(urls))):
+        links = set(extract_links_from_pptx(deck, get_scan_scope(scope)))
+        ok &= check(links == {urls[name] for name in expected}, f"{scope}: {sorted(expected)}")
+    return ok
+
+def test_zip64_preflight():
+    """Zip64 end records in the local preflight and in the Range-request remote preflight"""
+    print("Zip64 preflight")
+    deck = build_deck([([_shape(2, [[VIDEO_URL]])], [])], zip64=True)
+    data = deck.getvalue()
+    ok = check(data.rfind(app.ZIP64_EOCD_SIGNATURE) != -1, "package has a zip64 end of central directory")
+    local = preflight_pptx(deck)
+    ok &= check(local['decision'] == 'fast' and local['slide_count'] == 1, f"local preflight: {local['decision']}")
+
+    requests = []
+
+    def fetch_range(url, range_header):
+        """Serve byte ranges of the deck as an HTTP server with Range support would"""
+        requests.append(range_header)
+        start, end = range_header[len('bytes='):].split('-')
+        if start == '':
+            return data[-int(end):], len(data)
+        return data[int(start):int(end) + 1], len(data)
+
+    fetch, tail_size = app._fetch_range, app.REMOTE_PREFLIGHT_TAIL_SIZE
+    app._fetch_range = fetch_range
+    try:
+        for app.REMOTE_PREFLIGHT_TAIL_SIZE, request_count, how in ((len(data), 1, "whole file in the tail"),
+                                                                  (200, 2, "central directory fetched separately")):
+            requests.clear()
+            remote = remote_preflight('https://example.com/deck.pptx')
+            ok &= check(remote == local and len(requests) == request_count,
+                        f"remote preflight matches local ({how}, {len(requests)} requests)")
+    finally:
+        app._fetch_range, app.REMOTE_PREFLIGHT_TAIL_SIZE = fetch, tail_size
+    return ok
+
+def main():
+    import logging
+    logging.disable(logging.WARNING)  # keep the report readable; failures are printed below
+
+    update_expected = '--update-expected' in sys.argv[1:]
+    results = [test_known_decks(update_expected)]
+    if not update_expected:
+        results += [test_split_runs(), test_rid_allocation(), test_scan_scope(), test_zip64_preflight()]
+
+    print("=" * 50)
+    print("All checks passed" if all(results) else f"{results.count(False)} of {len(results)} tests failed")
+    return 0 if all(results) else 1
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,353 @@
+#!/usr/bin/env python3
+"""
+Checks for the request-handling machinery around the rewrite
+
+Runs without COS or network access (the Flask app is driven through its
+test client with inline responses):
+
+1. SingleFlight: one leader per key in a worker, followers marked coalesced,
+   cross-worker reuse through the flock directory, and coalesced responses
+   without the leader's trace_id/resources.
+2. AdmissionController: the memory budget and concurrency limit, the queue,
+   and a 429 with Retry-After on overload, for the normal and heavy-job lanes.
+3. LRUCache byte bound and OutputCache eviction.
+4. Link rule sets loaded from a custom rule file.
+5. Caller-supplied links and output compression profiles.
+
+Usage:
+    python test_services_regression.py
+"""
+
+import io
+import json
+import multiprocessing
+import os
+import sys
+import tempfile
+import threading
+import time
+import zipfile
+
+TEMP_DIR = tempfile.mkdtemp(prefix='pptx-services-test-')
+# Before importing app: keep the checks away from the shared /tmp/pptx_processing directories
+os.environ.update(SINGLE_FLIGHT_DIR='', INFLIGHT_DIR='', OUTPUT_CACHE_DIR=os.path.join(TEMP_DIR, 'outputs'))
+
+from werkzeug.exceptions import BadRequest
+
+import app
+from app import (SingleFlight, AdmissionController, AdmissionRejected, LRUCache, OutputCache,
+                 load_link_rule_sets, get_supplied_links, get_compression_profile, write_pptx_package)
+from test_rewrite_regression import check, build_deck, hyperlink_signature, process, _shape, VIDEO_URL, AUDIO_URL
+
+def test_single_flight():
+    """Concurrent calls with one key run once; the others get the leader's result"""
+    print("SingleFlight in one worker")
+    flight = SingleFlight()
+    calls = []
+    results = []
+    start = threading.Barrier(5)
+
+    def compute():
+        calls.append(1)
+        time.sleep(0.3)
+        return 'result'
+
+    def caller():
+        start.wait()
+        results.append(flight.do('key', compute))
+
+    threads = [threading.Thread(target=caller) for _ in range(5)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    ok = check(len(calls) == 1, f"one computation for 5 concurrent callers (got {len(calls)})")
+    ok &= check(sorted(coalesced for result, coalesced in results) == [False, True, True, True, True]
+                and all(result == 'result' for result, coalesced in results), "1 leader, 4 coalesced followers")
+
+    errors = []
+
+    def failing():
+        time.sleep(0.2)
+        raise ValueError("boom")
+
+    def failing_caller():
+        try:
+            flight.do('failing', failing)
+        except ValueError as e:
+            errors.append(str(e))
+
+    threads = [threading.Thread(target=failing_caller) for _ in range(3)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    ok &= check(errors == ['boom'] * 3, "the leader's exception reaches every follower")
+    ok &= check(flight.do('key', lambda: 'fresh') == ('fresh', False), "a later call computes afresh")
+
+    # Responses of followers do not carry the leader's trace or resource usage
+    payload = {"success": True, "performance": {"total_time": 1.0, "trace_id": "abc", "resources": {"total": {}}}}
+    with app.app.app_context():
+        leader = app.build_pipeline_response(payload, 200)[0].get_json()
+        follower = app.build_pipeline_response(payload, 200, coalesced=True)[0].get_json()
+    ok &= check("trace_id" in leader["performance"] and follower["coalesced"] is True
+                and set(follower["performance"]) == {"total_time"}, "coalesced response drops trace_id and resources")
+    return ok
+
+def _flight_worker(lock_dir, tag, delay, results):
+    time.sleep(delay)
+    result, coalesced = SingleFlight(lock_dir).do('key', lambda: (time.sleep(0.6), tag)[1])
+    results.put((tag, result, coalesced))
+
+def test_single_flight_across_workers():
+    """A worker that waited on another worker's flock reuses its result; later workers do not"""
+    print("SingleFlight across workers")
+    if app.fcntl is None:
+        return check(True, "skipped: no fcntl on this platform")
+    lock_dir = os.path.join(TEMP_DIR, 'singleflight')
+    context = multiprocessing.get_context('fork')
+    results = context.Queue()
+    workers = [context.Process(target=_flight_worker, args=(lock_dir, 'A', 0, results)),
+               context.Process(target=_flight_worker, args=(lock_dir, 'B', 0.2, results))]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    first = sorted([results.get(), results.get()])
+    ok = check(first == [('A', 'A', False), ('B', 'A', True)], f"B waited for A and reused its result ({first})")
+
+    worker = context.Process(target=_flight_worker, args=(lock_dir, 'C', 0, results))
+    worker.start()
+    worker.join()
+    later = results.get()
+    ok &= check(later == ('C', 'C', False), f"a worker arriving after A finished computes afresh ({later})")
+    return ok
+
+def test_admission_budget():
+    """Jobs wait for memory and slots in FIFO order; a full queue or a long wait is rejected"""
+    print("Admission budget")
+    controller = AdmissionController(memory_budget=100, max_concurrent=2, max_queue=1, max_wait=2)
+    ok = True
+    waits = []
+
+    with controller.admit(60):
+        ok &= check(controller.metrics()["memory_in_use"] == 60, "first job holds 60 of 100")
+
+        def second_job():
+            with controller.admit(60) as wait_time:
+                waits.append(wait_time)
+
+        thread = threading.Thread(target=second_job)
+        thread.start()
+        time.sleep(0.3)
+        ok &= check(controller.metrics()["queue_depth"] == 1, "second job (60) queues: it does not fit the budget")
+        try:
+            with controller.admit(10):
+                pass
+            ok &= check(False, "third job rejected while the queue is full")
+        except AdmissionRejected as e:
+            ok &= check(e.retry_after >= 1, f"third job rejected while the queue is full (Retry-After {e.retry_after})")
+    thread.join()
+    ok &= check(len(waits) == 1 and waits[0] >= 0.3, f"second job admitted once the first released (waited {waits})")
+
+    with controller.admit(10 ** 9):
+        ok &= check(controller.metrics()["memory_in_use"] == 100, "an oversized job is charged the whole budget")
+
+    controller = AdmissionController(memory_budget=100, max_concurrent=1, max_queue=4, max_wait=0.2)
+    with controller.admit(1):
+        try:
+            with controller.admit(1):
+                pass
+            ok &= check(False, "waiting longer than max_wait is rejected")
+        except AdmissionRejected:
+            ok &= check(True, "waiting longer than max_wait is rejected")
+    metrics = controller.metrics()
+    ok &= check(metrics["rejected_timeout_total"] == 1 and metrics["running_jobs"] == 0
+                and metrics["memory_in_use"] == 0, "metrics count the rejection and the budget is released")
+    return ok
+
+def _upload(client, deck, **form):
+    data = dict(form, file=(io.BytesIO(deck.getvalue()), 'deck.pptx'), response_mode='inline')
+    return client.post('/process_pptx_upload', data=data, content_type='multipart/form-data')
+
+def test_overload_responses():
+    """An overloaded worker answers 429 with Retry-After; large decks go through the heavy-job lane"""
+    print("429 on overload and the heavy-job lane")
+    client = app.app.test_client()
+    deck = build_deck([([_shape(2, [[VIDEO_URL]])], [])])
+    controllers = app.admission_controller, app.heavy_lane_controller
+    heavy_slide_count = app.HEAVY_SLIDE_COUNT
+    ok = True
+    try:
+        # No slots and no queue: every job is turned away
+        app.admission_controller = AdmissionController(max_concurrent=0, max_queue=0)
+        response = _upload(client, deck)
+        ok &= check(response.status_code == 429 and response.get_json()["error_type"] == "server_busy"
+                    and int(response.headers["Retry-After"]) >= 1,
+                    f"busy worker: {response.status_code}, Retry-After {response.headers.get('Retry-After')}")
+
+        # Every deck is heavy; the heavy lane is full while the normal lane has room
+        app.admission_controller = AdmissionController()
+        app.HEAVY_SLIDE_COUNT = 0
+        app.heavy_lane_controller = AdmissionController(max_concurrent=0, max_queue=0)
+        response = _upload(client, deck, compression='fast')
+        ok &= check(response.status_code == 429, f"heavy lane full: {response.status_code}")
+        ok &= check(app.admission_controller.metrics()["admitted_total"] == 0, "normal lane not entered")
+
+        app.heavy_lane_controller = AdmissionController(max_concurrent=1)
+        response = _upload(client, deck, compression='max')
+        ok &= check(response.status_code == 200 and app.heavy_lane_controller.metrics()["admitted_total"] == 1
+                    and app.admission_controller.metrics()["admitted_total"] == 1,
+                    f"heavy deck admitted through both lanes: {response.status_code}")
+        ok &= check(hyperlink_signature(io.BytesIO(response.data)) == [[1, app.get_friendly_link_text(VIDEO_URL), [VIDEO_URL]]],
+                    "heavy deck converted")
+    finally:
+        app.admission_controller, app.heavy_lane_controller = controllers
+        app.HEAVY_SLIDE_COUNT = heavy_slide_count
+    return ok
+
+def test_caches():
+    """LRUCache evicts by entries and by bytes; OutputCache evicts least recently used files"""
+    print("Cache limits")
+    cache = LRUCache(3, max_bytes=10, sizeof=len)
+    cache.put('a', b'12345')
+    cache.put('b', b'1234')
+    cache.get('a')
+    cache.put('c', b'123')
+    ok = check(cache.get('b') is None and cache.get('a') == b'12345' and cache.metrics()["bytes"] == 8,
+               "least recently used entry evicted when over 10 bytes")
+    cache.put('big', b'x' * 11)
+    ok &= check(cache.get('big') is None and cache.metrics()["bytes"] == 8, "a value larger than the limit is not stored")
+    cache.put('d', b'')
+    cache.put('e', b'')
+    ok &= check(cache.metrics()["size"] == 3, "entry count still bounded")
+
+    # The slide rewrite cache only pays bytes for slides that changed
+    deck = build_deck([([_shape(2, [[VIDEO_URL]])], []), ([_shape(2, [['no link here, http is only mentioned']])], [])])
+    app.slide_rewrite_cache = LRUCache(100, 10 ** 6, app._slide_rewrite_size)
+    process(deck, links=[VIDEO_URL])
+    entries = list(app.slide_rewrite_cache._data.values())
+    changed = [entry for entry in entries if entry is not app.SLIDE_UNCHANGED]
+    ok &= check(len(entries) == 2 and len(changed) == 1
+                and app.slide_rewrite_cache.metrics()["bytes"] == app._slide_rewrite_size(changed[0]),
+                "slide rewrite cache: unchanged slide stored as a marker, bytes count the rewritten slide")
+
+    directory = os.path.join(TEMP_DIR, 'output-cache')
+    output_cache = OutputCache(directory, max_bytes=250)
+    keys = [f"{str(n) * 64}.pptx" for n in range(4)]
+    for age, key in enumerate(keys[:2]):
+        output_cache.put(key, io.BytesIO(b'x' * 100))
+        os.utime(os.path.join(directory, key), (1000 + age, 1000 + age))
+    output_cache.get(keys[0])  # now the most recently used
+    output_cache.put(keys[2], io.BytesIO(b'y' * 100))
+    ok &= check(sorted(os.listdir(directory)) == sorted([keys[0], keys[2]]),
+                "output cache evicted the least recently used file")
+    ok &= check(not output_cache.put(keys[3], io.BytesIO(b'z' * 251)) and output_cache.get(keys[3]) is None,
+                "a file larger than the cache is not stored")
+    ok &= check(output_cache.path('../etc/passwd') is None, "keys other than <sha256>.pptx are refused")
+    ok &= check(output_cache.metrics()["evictions"] == 1, "eviction counted")
+    return ok
+
+def test_custom_rules():
+    """Rule sets from LINK_RULES_FILE classify links and give the display text"""
+    print("Custom link rule file")
+    path = os.path.join(TEMP_DIR, 'rules.json')
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump({"tenant": {"rules": [{"kind": "lesson", "label": "观看课程", "contains": ["/lesson/"]},
+                                        {"kind": "video", "label": "观看视频", "extensions": ["mp4"]}],
+                              "fallback": {"label": "打开链接"}}}, f, ensure_ascii=False)
+    rule_sets = load_link_rule_sets(path)
+    ok = check(sorted(rule_sets) == ['default', 'tenant'], "file rule set loaded next to the built-in rules")
+    tenant = rule_sets["tenant"]
+    ok &= check(tenant.classify('https://cdn.example.com/lesson/1.mp4') == ('lesson', '观看课程'),
+                "first matching rule wins")
+    ok &= check(tenant.classify(VIDEO_URL) == ('video', '观看视频'), "extension rule")
+    ok &= check(tenant.classify(AUDIO_URL) == ('link', '打开链接'), "fallback label")
+    ok &= check(rule_sets["default"].classify(AUDIO_URL) == ('audio', '点击音频'), "built-in rules unchanged")
+
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump({"broken": {"rules": [{"kind": "x", "label": "no condition"}]}}, f)
+    ok &= check(sorted(load_link_rule_sets(path)) == ['default'], "an invalid rule file falls back to the built-in rules")
+
+    link_rule_sets = app.link_rule_sets
+    app.link_rule_sets = rule_sets
+    try:
+        deck = build_deck([([_shape(2, [[VIDEO_URL]])], [])])
+        output = io.BytesIO()
+        app.add_hyperlinks_to_pptx(deck, [VIDEO_URL], output, rule_set='tenant')
+        output.seek(0)
+        ok &= check(hyperlink_signature(output) == [[1, '观看视频', [VIDEO_URL]]], "rewrite uses the tenant's label")
+    finally:
+        app.link_rule_sets = link_rule_sets
+    return ok
+
+def test_supplied_links():
+    """Caller-supplied links are filtered like deck text and matched in the caller's order"""
+    print("Caller-supplied links")
+    links, source = get_supplied_links([AUDIO_URL, 'https://cdn.example.com/logo.png', VIDEO_URL, AUDIO_URL])
+    ok = check((links, source) == ([AUDIO_URL, VIDEO_URL], 'links'), "non-media links dropped, duplicates removed")
+    outline = {"data": {"result": {"name": "课程", "url": None, "children": [
+        {"name": "1", "url": VIDEO_URL, "children": [{"name": "1.1", "url": AUDIO_URL}]}]}}}
+    ok &= check(get_supplied_links(outline=json.dumps(outline)) == ([VIDEO_URL, AUDIO_URL], 'outline'),
+                "outline URLs in document order")
+    ok &= check(get_supplied_links() == (None, 'extracted'), "no links: extract from the deck")
+    for arguments, problem in ((dict(links=[VIDEO_URL], outline=outline), "both links and outline"),
+                               (dict(links='not json'), "invalid JSON"),
+                               (dict(links=[VIDEO_URL] * (app.MAX_SUPPLIED_LINKS + 1)), "too many links")):
+        try:
+            get_supplied_links(**arguments)
+            ok &= check(False, f"{problem} rejected")
+        except BadRequest:
+            ok &= check(True, f"{problem} rejected")
+
+    # A paragraph mentioning both links gets the one listed first
+    deck = build_deck([([_shape(2, [[f'{VIDEO_URL} {AUDIO_URL}']])], [])])
+    for order in ([AUDIO_URL, VIDEO_URL], [VIDEO_URL, AUDIO_URL]):
+        output, stats = process(deck, links=order)
+        ok &= check(hyperlink_signature(output)[0][2] == [order[0]], f"first listed link wins ({order[0]})")
+    return ok
+
+def test_compression_profiles():
+    """Each profile stores or deflates parts as documented"""
+    print("Compression profiles")
+    source = io.BytesIO()
+    with zipfile.ZipFile(source, 'w') as zip_file:
+        zip_file.writestr('ppt/slides/slide1.xml', '<p:sld/>' * 200, compress_type=zipfile.ZIP_STORED)
+        zip_file.writestr('ppt/media/image1.png', os.urandom(2000), compress_type=zipfile.ZIP_DEFLATED)
+    expected = {
+        'default': (zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED),
+        'store_media': (zipfile.ZIP_DEFLATED, zipfile.ZIP_STORED),
+        'fast': (zipfile.ZIP_DEFLATED, zipfile.ZIP_STORED),
+        'max': (zipfile.ZIP_DEFLATED, zipfile.ZIP_DEFLATED),
+    }
+    ok = True
+    with zipfile.ZipFile(source) as zip_in:
+        for profile, (xml_type, media_type) in expected.items():
+            output = io.BytesIO()
+            write_pptx_package(zip_in, output, {}, get_compression_profile(profile))
+            with zipfile.ZipFile(output) as zip_out:
+                types = (zip_out.getinfo('ppt/slides/slide1.xml').compress_type,
+                         zip_out.getinfo('ppt/media/image1.png').compress_type)
+                same = all(zip_out.read(name) == zip_in.read(name) for name in zip_in.namelist())
+            ok &= check(types == (xml_type, media_type) and same, f"{profile}: xml/media compress types {types}")
+    try:
+        get_compression_profile('tiny')
+        ok &= check(False, "unknown profile rejected")
+    except BadRequest:
+        ok &= check(True, "unknown profile rejected")
+    return ok
+
+def main():
+    import logging
+    logging.disable(logging.ERROR)  # the invalid rule file check logs an expected error
+
+    results = [test_single_flight(), test_single_flight_across_workers(), test_admission_budget(),
+               test_overload_responses(), test_caches(), test_custom_rules(), test_supplied_links(),
+               test_compression_profiles()]
+
+    print("=" * 50)
+    print("All checks passed" if all(results) else f"{results.count(False)} of {len(results)} tests failed")
+    return 0 if all(results) else 1
+
+if __name__ == "__main__":
+    sys.exit(main())